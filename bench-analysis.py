@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+#
+# Benchmark of calc_file_bpm_histogram on synthetic tracks with known tempo, no music services needed.
+# Every analysis profile is run in separate process, so its CPU time and peak memory are measured separately.
+#
+
+import sys
+import os
+import time
+import json
+import resource
+import argparse
+import multiprocessing
+
+import logging
+from logging import debug, info, warning, error
+
+from exceptions import *
+from whoami import *
+from config import *
+from calc_bpm import *
+from synth_audio import *
+
+corpus_dir = 'data/bench-corpus'
+
+
+def histogram_peak(histogram):
+    """bpm with biggest share"""
+    return float(max(histogram.items(), key=lambda x: x[1])[0])
+
+
+def bpm_error(bpm, right_bpms, octave=False):
+    """
+    Distance from bpm to nearest right tempo
+    :param octave: treat half and double tempo as right too
+    """
+    candidates = right_bpms
+    if octave:
+        candidates = [x * mult for x in right_bpms for mult in (0.5, 1, 2)]
+    return min(abs(bpm - x) for x in candidates)
+
+
+def run_profile(profile, corpus, window_seconds):
+    """Analyze corpus with profile, runs in separate process"""
+    init_analysis_worker(profile)
+    results = []
+    started = time.monotonic()
+    cpu_started = time.process_time()
+    for track in corpus:
+        window = get_analysis_window(track["seconds"], window_seconds)
+        track_started = time.monotonic()
+        try:
+            histogram = calc_file_bpm_histogram(track["filename"], window, profile)
+        except ExBpmCrawlGeneric as e:
+            error(f"{profile}: failed to analyze {track['filename']}: {e}")
+            histogram = None
+        result = {"filename": track["filename"], "seconds": time.monotonic() - track_started}
+        if histogram:
+            peak = histogram_peak(histogram)
+            result.update({"peak_bpm": peak, "error": bpm_error(peak, track["bpms"]),
+                           "octave_error": bpm_error(peak, track["bpms"], octave=True)})
+        results.append(result)
+    return {
+        "wall_seconds": time.monotonic() - started,
+        "cpu_seconds": time.process_time() - cpu_started,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "tracks": results,
+    }
+
+
+def summarize(profile, corpus, run):
+    audio_minutes = sum(x["seconds"] for x in corpus) / 60
+    analyzed = [x for x in run["tracks"] if "error" in x]
+    errors = sorted(x["error"] for x in analyzed)
+    octave_errors = sorted(x["octave_error"] for x in analyzed)
+    return {
+        "profile": profile,
+        "tracks": len(corpus),
+        "failed": len(corpus) - len(analyzed),
+        "tracks_per_second": len(corpus) / run["wall_seconds"],
+        "cpu_seconds_per_audio_minute": run["cpu_seconds"] / audio_minutes,
+        "peak_rss_mb": run["peak_rss_mb"],
+        "median_bpm_error": errors[len(errors) // 2] if errors else None,
+        "max_bpm_error": errors[-1] if errors else None,
+        "within_2bpm": sum(x <= 2 for x in errors) / len(corpus),
+        "within_2bpm_octave": sum(x <= 2 for x in octave_errors) / len(corpus),
+    }
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        description=f'Benchmark analysis profiles on synthetic tracks with known tempo',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-P', '--profiles', default=list(analysis_profiles.keys()), nargs='+', choices=analysis_profiles.keys(),
+                        help=f'Analysis profiles to benchmark')
+    parser.add_argument('-k', '--kinds', default=synth_kinds, nargs='+', choices=synth_kinds,
+                        help=f'Kinds of synthetic tracks')
+    parser.add_argument('-b', '--bpms', default=[90, 128, 174], nargs='+', type=int,
+                        help=f'Tempos of synthetic tracks')
+    parser.add_argument('-L', '--lengths', default=[60, 240], nargs='+', type=int,
+                        help=f'Lengths of synthetic tracks, seconds')
+    parser.add_argument('-c', '--codecs', default=['mp3', 'ogg', 'wav'], nargs='+',
+                        help=f'Formats of synthetic tracks')
+    parser.add_argument('--window', default=analysis_window_seconds, type=float,
+                        help=f'Analyze only this many seconds of track, 0 for whole track')
+    parser.add_argument('--corpus-dir', default=corpus_dir, type=str,
+                        help=f'Where to keep generated tracks')
+    parser.add_argument('-o', '--output', type=str,
+                        help=f'Write results to this file as json')
+    parser.add_argument('-v', '--verbose', default=False, action='store_true',
+                        help=f'Print result for every track')
+    parser.add_argument('-d', '--debug', default=False, action='store_true',
+                        help=f'Enable debugging output')
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    info(f"generating corpus in {args.corpus_dir}")
+    corpus = generate_corpus(args.corpus_dir, args.kinds, args.bpms, args.lengths, args.codecs)
+    info(f"corpus: {len(corpus)} tracks, {sum(x['seconds'] for x in corpus) / 60:.1f} minutes of audio")
+
+    summaries = []
+    runs = {}
+    for profile in args.profiles:
+        info(f"running profile {profile}")
+        with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+            runs[profile] = pool.apply(run_profile, (profile, corpus, args.window))
+        summaries.append(summarize(profile, corpus, runs[profile]))
+        if args.verbose:
+            for track in runs[profile]["tracks"]:
+                print(f"  {profile:10} {track}")
+
+    print(f"{'profile':10} {'tracks/s':>9} {'cpu s/min':>10} {'rss MB':>8} {'median err':>11} {'max err':>8} {'<=2bpm':>7} {'<=2bpm oct':>11} {'failed':>7}")
+    for x in summaries:
+        print(f"{x['profile']:10} {x['tracks_per_second']:9.2f} {x['cpu_seconds_per_audio_minute']:10.3f} {x['peak_rss_mb']:8.0f}"
+              f" {x['median_bpm_error'] if x['median_bpm_error'] is not None else '-':>11} {x['max_bpm_error'] if x['max_bpm_error'] is not None else '-':>8}"
+              f" {x['within_2bpm']:7.0%} {x['within_2bpm_octave']:11.0%} {x['failed']:7}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"window": args.window, "corpus": corpus, "summaries": summaries, "runs": runs}, f, indent=2)
+        info(f"results are written to {args.output}")
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+#
+# End-to-end benchmark of bpmcrawld and bpmcrawl-pick against synthetic music service (see synth_service.py),
+# to tune concurrency without real music services and their quotas.
+# For every count of workers, bpmcrawld crawls the catalogue into new database, then bpmcrawl-pick fills playlist from it.
+#
+
+import sys
+import os
+import time
+import json
+import tempfile
+import argparse
+import subprocess
+
+import logging
+from logging import debug, info, warning, error
+
+from exceptions import *
+from whoami import *
+from synth_service import *
+
+
+def run_script(script, script_args, service, stats_file):
+    """
+    Run script with synthetic service
+    :return: (stats written by script, stats of service requests made by script)
+    """
+    service_before = service.get_stats()
+    env = dict(os.environ, SYNTH_MUSIC_URL=service.url)
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), script),
+               "-s", "synthetic", "--stats-out", stats_file] + script_args
+    debug(f"running {' '.join(command)}")
+    started = time.monotonic()
+    result = subprocess.run(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    seconds = time.monotonic() - started
+    if result.returncode:
+        raise ExBpmCrawlGeneric(f"{script} failed with code {result.returncode}: {result.stderr[-2000:]}")
+    with open(stats_file) as f:
+        stats = json.load(f)
+    stats["wall_seconds"] = seconds
+    service_after = service.get_stats()
+    return stats, {x: service_after.get(x, 0) - service_before.get(x, 0) for x in service_after}
+
+
+def run_benchmark(service, workers, args, work_dir):
+    db_file = os.path.join(work_dir, f"histograms-w{workers}.db")
+    source = ["-p", synth_catalogue_playlist] if args.source == "playlist" else \
+        ["-A", "a00000"] if args.source == "artist" else ["--station", "IFL"]
+    crawl, crawl_service = run_script("bpmcrawld.py", source + [
+        "-f", db_file, "-w", str(workers), "--prefetch", str(args.prefetch), "--downloads", str(args.downloads),
+        "-P", args.profile,
+        "--window", str(args.window), "-l", str(args.limit)] + ([] if args.dedupe else ["--no-dedupe"]),
+        service, os.path.join(work_dir, "crawl.json"))
+    pick, pick_service = run_script("bpmcrawl-pick.py", [
+        "-f", db_file, "-p", f"bench-w{workers}", "-b", args.bpm], service, os.path.join(work_dir, "pick.json"))
+    return {
+        "workers": workers,
+        # tracks with already analyzed audio are counted too, otherwise dedupe would lower throughput
+        "tracks_per_hour": (crawl["new"] + crawl["duplicate"]) / crawl["seconds"] * 3600 if crawl["seconds"] else 0,
+        "crawl": crawl,
+        "crawl_service": crawl_service,
+        "pick": pick,
+        "pick_service": pick_service,
+    }
+
+
+def print_results(results):
+    print(f"{'workers':>7} {'tracks':>7} {'dups':>6} {'failed':>7} {'tracks/h':>9} {'seconds':>8}"
+          f" {'network':>8} {'decode':>8} {'analysis':>9} {'db':>6}"
+          f" {'pick':>6} {'sync':>6} {'added':>6} {'api calls':>9}")
+    for x in results:
+        crawl = x["crawl"]
+        stages = crawl["stages"]
+        pick = x["pick"]
+        analysis = sum(stages.get(stage, 0) for stage in ("rhythm", "histogram", "provider_analysis"))
+        print(f"{x['workers']:7} {crawl['new']:7} {crawl['duplicate']:6} {crawl['failed']:7} {x['tracks_per_hour']:9.0f} {crawl['seconds']:8.1f}"
+              f" {stages.get('download', 0):8.1f} {stages.get('decode', 0):8.1f} {analysis:9.1f}"
+              f" {stages.get('db_read', 0) + stages.get('db_write', 0):6.2f}"
+              f" {pick.get('pick_seconds', 0):6.2f} {pick.get('sync_seconds', 0):6.2f} {pick['tracks_added']:6}"
+              f" {x['pick_service'].get('api_requests', 0):9}")
+    print(f"network, decode and analysis are summed over all workers, so they may exceed wall time")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        description=f'End-to-end benchmark of bpmcrawld and bpmcrawl-pick with synthetic music service',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-t', '--tracks', default=100, type=int,
+                        help=f'Tracks in catalogue')
+    parser.add_argument('-L', '--lengths', default=[60], nargs='+', type=int,
+                        help=f'Lengths of tracks, seconds')
+    parser.add_argument('--latency', default=50, type=float,
+                        help=f'Latency of every request, ms')
+    parser.add_argument('--bandwidth', default=1024, type=float,
+                        help=f'Download bandwidth of every connection, KB/s, 0 for unlimited')
+    parser.add_argument('--error-rate', default=0, type=float,
+                        help=f'Share of requests failed with HTTP 503')
+    parser.add_argument('--source', default='playlist', choices=['playlist', 'station', 'artist'],
+                        help=f'What bpmcrawld crawls: catalogue playlist, IFL station or first artist')
+    parser.add_argument('-w', '--workers', default=[1, 2, 4], nargs='+', type=int,
+                        help=f'Counts of analysis workers to benchmark')
+    parser.add_argument('--prefetch', default=2, type=int,
+                        help=f'Passed to bpmcrawld')
+    parser.add_argument('--downloads', default=2, type=int,
+                        help=f'Passed to bpmcrawld')
+    parser.add_argument('-P', '--profile', default='accurate', type=str,
+                        help=f'Analysis profile, passed to bpmcrawld')
+    parser.add_argument('--window', default=0, type=float,
+                        help=f'Analysis window, passed to bpmcrawld')
+    parser.add_argument('-l', '--limit', default=0, type=int,
+                        help=f'Passed to bpmcrawld')
+    parser.add_argument('--dedupe', default=False, action='store_true',
+                        help=f'Let bpmcrawld skip analysis of audio it already analyzed for another track')
+    parser.add_argument('-b', '--bpm', default='172-180', type=str,
+                        help=f'BPM range, passed to bpmcrawl-pick')
+    parser.add_argument('-o', '--output', type=str,
+                        help=f'Write results to this file as json')
+    parser.add_argument('-d', '--debug', default=False, action='store_true',
+                        help=f'Enable debugging output')
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    catalogue = SynthCatalogue(args.tracks, lengths=args.lengths)
+    service = SynthMusicService(catalogue, latency=args.latency / 1000, bandwidth=args.bandwidth * 1024,
+                                error_rate=args.error_rate).start()
+    results = []
+    try:
+        with tempfile.TemporaryDirectory(prefix="bench-crawl") as work_dir:
+            for workers in args.workers:
+                info(f"crawling {args.tracks} tracks with {workers} workers")
+                results.append(run_benchmark(service, workers, args, work_dir))
+    except ExBpmCrawlGeneric as e:
+        error(str(e))
+        sys.exit(1)
+    finally:
+        service.stop()
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+        info(f"results are written to {args.output}")
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+#
+# Benchmark of picking tracks from big cache databases, as bpmcrawl-pick does.
+# Databases of requested sizes are generated once (with realistic histograms) and reused by next runs.
+# Every database is measured in separate process: scan (load of all histograms) with cold and warm
+# OS page cache, then picking with several BPM ranges and multipliers.
+#
+
+import sys
+import os
+import time
+import json
+import math
+import random
+import platform
+import resource
+import argparse
+import datetime
+import multiprocessing
+
+import numpy
+
+import logging
+from logging import debug, info, warning, error
+
+from exceptions import *
+from whoami import *
+from config import *
+from pick_engine import *
+
+bench_dir = 'data/bench-pick'
+bench_music_service = 'bench'
+bench_insert_batch = 10000
+
+# bpm values of histogram bins made by BpmHistogramDescriptors: tempo of beat interval of n frames of 512 samples
+histogram_bpm_grid = sorted(set(round(44100 * 60 / 512 / n) for n in range(25, 91)))
+# tempos of tracks are spread like in real database: mostly 90-150, few below 70 or above 180
+synth_tempo_mean = 122
+synth_tempo_sd = 26
+
+default_picks = [
+    {"bpm": "172-180", "mult": [1, 0.5]},
+    {"bpm": "118-124", "mult": [1]},
+    {"bpm": "85-95", "mult": [1, 2]},
+    {"bpm": "60-200", "mult": [1]},
+]
+
+
+def synth_histogram(rng):
+    """
+    Realistic histogram { bpm: share }: peak at tempo of track, bins around it decaying with distance on bpm grid,
+    sometimes second peak at double or half tempo. Count of bins and share of peak are close to real tracks
+    (median 7 bins, share of peak about 0.5).
+    """
+    tempo = min(max(rng.gauss(synth_tempo_mean, synth_tempo_sd), histogram_bpm_grid[0]), histogram_bpm_grid[-1])
+    peak = min(range(len(histogram_bpm_grid)), key=lambda x: abs(histogram_bpm_grid[x] - tempo))
+    count = min(max(int(rng.lognormvariate(math.log(7), 0.6)), 2), 44)
+    spread = max(count / 3, 0.5)
+    weights = {peak: 1.0 + rng.random() * 2}
+    while len(weights) < count:
+        offset = round(rng.expovariate(1 / spread)) * rng.choice((-1, 1))
+        n = peak + offset
+        if 0 <= n < len(histogram_bpm_grid) and n not in weights:
+            weights[n] = rng.random() * math.exp(-abs(offset) / spread)
+    if rng.random() < 0.3:
+        octave = histogram_bpm_grid[peak] * rng.choice((0.5, 2))
+        n = min(range(len(histogram_bpm_grid)), key=lambda x: abs(histogram_bpm_grid[x] - octave))
+        weights[n] = weights.get(n, 0) + rng.random() * weights[peak]
+    total = sum(weights.values())
+    histogram = {}
+    for n, weight in weights.items():
+        share = round(weight / total, 2)
+        if share > 0:
+            histogram[histogram_bpm_grid[n]] = share
+    return histogram or {histogram_bpm_grid[peak]: 1.0}
+
+
+def get_bench_db(tracks, encoding, seed=0):
+    """Return filename of database with given count of tracks, generating it if it does not exist yet"""
+    filename = os.path.join(bench_dir, f"histograms-{tracks}-{encoding}.db")
+    if os.path.exists(filename):
+        return filename
+    os.makedirs(bench_dir, exist_ok=True)
+    info(f"generating {filename}")
+    rng = random.Random(seed)
+    started = time.monotonic()
+    store = HistogramStore(filename + ".new", commit_every=1)
+    for start in range(0, tracks, bench_insert_batch):
+        store.insert_histograms(bench_music_service, [(f"t{n:08d}", synth_histogram(rng))
+                                                      for n in range(start, min(start + bench_insert_batch, tracks))],
+                                encoding)
+        if start and start % (bench_insert_batch * 100) == 0:
+            info(f"generated {start} tracks ({start / (time.monotonic() - started):.0f} tracks/s)")
+    store.close()
+    os.rename(filename + ".new", filename)
+    info(f"generated {filename} in {time.monotonic() - started:.1f} s")
+    return filename
+
+
+def drop_file_cache(filename):
+    """Evict file from OS page cache, so next read is cold"""
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def parse_bpm_range(pick):
+    bpm_min, bpm_max = pick["bpm"].split("-")
+    return {"min": float(bpm_min), "max": float(bpm_max), "mult": pick["mult"]}
+
+
+def run_db_benchmark(filename, picks, min_share, repeat, sql):
+    """Measure scan and picks on database, runs in separate process"""
+    result = {}
+    if hasattr(os, "posix_fadvise"):
+        drop_file_cache(filename)
+    else:
+        warning(f"can't drop OS page cache on this platform, cold scan is not really cold")
+    for scan in ("cold", "warm"):
+        store = HistogramStore(filename)
+        started = time.monotonic()
+        matrix = HistogramMatrix.from_store(store, bench_music_service)
+        result[f"{scan}_scan_seconds"] = time.monotonic() - started
+        store.close()
+    result["bins"] = len(matrix.shares)
+    result["picks"] = []
+    store = HistogramStore(filename)
+    for pick in picks:
+        good_bpm = parse_bpm_range(pick)
+        times = []
+        for n in range(repeat):
+            started = time.monotonic()
+            picked = matrix.pick(good_bpm, min_share)
+            times.append(time.monotonic() - started)
+        pick_result = {"bpm": pick["bpm"], "mult": pick["mult"], "picked": len(picked),
+                       "seconds": min(times), "median_seconds": sorted(times)[len(times) // 2]}
+        if sql:
+            started = time.monotonic()
+            sql_picked = store.find_tracks(bench_music_service, good_bpm, min_share)
+            pick_result["sql_seconds"] = time.monotonic() - started
+            pick_result["sql_picked"] = len(sql_picked)
+        result["picks"].append(pick_result)
+    store.close()
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return result
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        description=f'Benchmark picking tracks from generated cache databases of different sizes',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-t', '--tracks', default=[10000, 100000, 1000000, 5000000], nargs='+', type=int,
+                        help=f'Sizes of databases, tracks')
+    parser.add_argument('-e', '--encoding', default=histogram_encoding, choices=["sparse", "dense", "bins"],
+                        help=f'Encoding of histograms in generated databases')
+    parser.add_argument('-p', '--picks', type=str,
+                        help=f'BPM ranges and multipliers to pick, json list like {json.dumps(default_picks[:1])};'
+                             f' default is {json.dumps(default_picks)}')
+    parser.add_argument('--min-share', default=0.85, type=float,
+                        help=f'Minimal summary share of good bpms, as in bpmcrawl-pick')
+    parser.add_argument('-r', '--repeat', default=5, type=int,
+                        help=f'Repeat every pick this many times, best time is reported')
+    parser.add_argument('--sql', default=False, action='store_true',
+                        help=f'Also time HistogramStore.find_tracks (makes sense for bins encoding only)')
+    parser.add_argument('-o', '--output', type=str,
+                        help=f'Write results to this file as json')
+    parser.add_argument('-d', '--debug', default=False, action='store_true',
+                        help=f'Enable debugging output')
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    picks = json.loads(args.picks) if args.picks else default_picks
+
+    results = []
+    for tracks in args.tracks:
+        filename = get_bench_db(tracks, args.encoding)
+        info(f"benchmarking {filename}")
+        with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+            result = pool.apply(run_db_benchmark, (filename, picks, args.min_share, args.repeat, args.sql))
+        result.update({"tracks": tracks, "file_bytes": os.path.getsize(filename)})
+        results.append(result)
+
+    print(f"{'tracks':>9} {'MB':>7} {'cold scan':>10} {'warm scan':>10} {'rss MB':>7}  picks (bpm x mult: seconds, picked)")
+    for x in results:
+        picks_text = ", ".join(f"{p['bpm']}x{p['mult']}: {p['seconds']:.4f}s {p['picked']}" for p in x["picks"])
+        print(f"{x['tracks']:9} {x['file_bytes'] / 2**20:7.1f} {x['cold_scan_seconds']:10.3f} {x['warm_scan_seconds']:10.3f}"
+              f" {x['peak_rss_mb']:7.0f}  {picks_text}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "numpy": numpy.__version__,
+                "sqlite": sqlite3.sqlite_version,
+                "encoding": args.encoding,
+                "min_share": args.min_share,
+                "results": results,
+            }, f, indent=2)
+        info(f"results are written to {args.output}")
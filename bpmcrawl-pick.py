@@ -6,12 +6,12 @@ import urllib.parse
 import tempfile
 import requests
 import re
+import json
+import time
 import argparse
 
 from music_api import *
 
-from sqlitedict import SqliteDict
-
 import logging
 from logging import debug, info, warning, error
 
@@ -19,8 +19,12 @@ from exceptions import *
 from whoami import *
 from config import *
 from calc_bpm import *
+from pick_engine import *
+from tracing import *
 
 playlist_name = "bpmcrawl"
+# minimal summary share of "good" bpms in track's histogram
+good_bpms_min_share = 0.85
 
 api = None
 
@@ -46,7 +50,7 @@ def get_avg_bpm(histogram: dict):
     return sum/sum_shares
 
 
-def get_good_bpms(histogram: dict, good_bpm, min_share=0.85):
+def get_good_bpms(histogram: dict, good_bpm, min_share=good_bpms_min_share):
     """
     Если доля "хороших" bpm >= min_share, то вернёт dict:
         {bpm1: share1, bpm2: share2}
@@ -106,6 +110,13 @@ if __name__ == '__main__':
                             help=
                             f'Do not rely on locally cached info about whether track was already added to playlist or not.\n'
                             f'Without this option, you may remove tracks from playlist manually and they will not be re-added')
+        parser.add_argument('--stats-out', type=str,
+                            help=f'Write stats and time spent to this file as json when finished')
+        parser.add_argument('--profile-out', type=str,
+                            help=f'Write timeline of stages, provider calls and db commits to this file'
+                                 f' (Chrome trace json, open it in https://ui.perfetto.dev)')
+        parser.add_argument('--profile-pstats', type=str,
+                            help=f'With --profile-out, also profile stages with cProfile and write stats to this dir')
         parser.add_argument('-d', '--debug', default=False, action='store_true',
                             help=f'Enable debugging output')
 
@@ -132,11 +143,16 @@ if __name__ == '__main__':
         debug(f"accept_bpm    = {accept_bpm}")
         debug(f"reload        = {args.reload}")
 
-        if not is_cache_version_ok():
+        if not is_cache_version_ok(tracks_histogram_db):
             print(f"wrong cache version ({tracks_histogram_db}), delete it or convert it with db_convert", file=sys.stderr)
             sys.exit(1)
 
+        if args.profile_out:
+            tracer.start(args.profile_pstats)
+        started = time.monotonic()
         api = get_music_provider(music_service)
+        if args.profile_out:
+            api = TracedProvider(api, tracer)
         api.login()
         debug("logged in")
 
@@ -145,53 +161,60 @@ if __name__ == '__main__':
         playlist_id = api.get_playlist_id(playlist)
         debug(f"found target playlist")
 
-        tracks_in_playlist = []
-        for track in api.get_playlist_tracks(playlist):
-            tracks_in_playlist.append(api.get_track_id(track))
+        tracks_in_playlist = set(api.get_track_id(track) for track in api.get_playlist_tracks(playlist))
 
         stats = {"tracks_before": len(tracks_in_playlist), "tracks_added": 0, "failures": 0}
 
-        with SqliteDict(tracks_histogram_db, autocommit=True, encode=json.dumps, decode=json.loads) as cache:
-            for track in cache:
-                if track == cache_db_version_recordid:
-                    continue
-                if get_track_provider_from_cache_id(track) != music_service:
-                    continue
-                track_id = get_track_id_from_cache_id(track)
-                cached = cache[track]
-                good_bpms = get_good_bpms(cached["histogram"], accept_bpm)
+        cache = HistogramStore(tracks_histogram_db)
+        try:
+            # all histograms are scored at once by HistogramMatrix, get_good_bpms gives details for picked tracks
+            pick_started = time.monotonic()
+            with tracer.span("load"):
+                histograms = HistogramMatrix.from_store(cache, music_service)
+            with tracer.span("pick"):
+                picked = histograms.pick(accept_bpm, good_bpms_min_share)
+            debug(f"picked {len(picked)} of {len(histograms)} tracks")
+            stats["pick_seconds"] = time.monotonic() - pick_started
+            sync_started = time.monotonic()
+            # picked tracks missing in playlist are added by batches, then playlist is reloaded once to check them
+            to_add = []
+            for track_id in picked:
+                good_bpms = get_good_bpms(cache.get_histogram(music_service, track_id), accept_bpm)
                 if good_bpms:
-                    if not args.reload and "in_playlists" in cached and playlist_id in cached["in_playlists"]:
+                    if not args.reload and str(playlist_id) in cache.get_track_playlists(music_service, track_id):
                         # cache says that we already added this track, and no -r option given
                         debug(f"track {track_id} was added to playlist earlier (got this from cache)")
                     else:
                         if track_id in tracks_in_playlist:
-                            if "in_playlists" not in cached:
-                                cached["in_playlists"] = []
-                            if playlist_id not in cached["in_playlists"]:
-                                cached["in_playlists"].append(playlist_id)
-                            cache[track] = cached
+                            cache.add_track_playlist(music_service, track_id, playlist_id)
                             debug(f"track {track_id} is already in playlist (added this info to cache)")
                         else:
                             info(f"adding track {track_id} to playlist (avg={round(get_avg_bpm(good_bpms),2)}, {good_bpms})")
-                            try:
-                                if api.add_track_to_playlist(playlist, track_id):
-                                    if "in_playlists" not in cached:
-                                        cached["in_playlists"] = []
-                                    if playlist_id not in cached["in_playlists"]:
-                                        cached["in_playlists"].append(playlist_id)
-                                    cache[track] = cached
-                                    stats["tracks_added"] += 1
-                                    info(f"added track {track_id} to playlist {playlist_name}, loading updated playlist")
-                                    playlist = api.get_or_create_my_playlist(playlist_name)
-                                    playlist_id = api.get_playlist_id(playlist)
-                                else:
-                                    stats["failures"] += 1
-                                    error(f"failed to add track {track_id} to playlist (no reason given)")
-                            except ExBpmCrawlGeneric as e:
-                                stats["failures"] += 1
-                                error(f"failed to add track {track_id}: {e}")
+                            to_add.append(track_id)
+                            tracks_in_playlist.add(track_id)
+            if to_add:
+                added = set(api.add_tracks_to_playlist(playlist, to_add))
+                info(f"added {len(added)} of {len(to_add)} tracks to playlist {playlist_name}, loading updated playlist")
+                playlist = api.get_or_create_my_playlist(playlist_name)
+                playlist_id = api.get_playlist_id(playlist)
+                added |= set(api.get_track_id(track) for track in api.get_playlist_tracks(playlist)) & set(to_add)
+                for track_id in to_add:
+                    if track_id in added:
+                        cache.add_track_playlist(music_service, track_id, playlist_id)
+                        stats["tracks_added"] += 1
+                    else:
+                        stats["failures"] += 1
+                        error(f"failed to add track {track_id} to playlist")
+            stats["sync_seconds"] = time.monotonic() - sync_started
+            tracer.add_span("sync", "stage", sync_started, stats["sync_seconds"], tracks=len(picked))
+        finally:
+            cache.close()
+        if args.profile_out:
+            tracer.save(args.profile_out)
         info(f"bpmcrawl-pick exiting; stats: {stats}")
+        if args.stats_out:
+            with open(args.stats_out, "w") as f:
+                json.dump({**stats, "seconds": time.monotonic() - started}, f, indent=2)
     except ExBpmCrawlGeneric as e:
         debug(f"Got exception:", exc_info=True)
         error(str(e))
@@ -4,6 +4,7 @@
 # If run without parameters, it will crawl on I'm Feeling Lucky station
 # If single parameter given - it will be treated as station URL
 # If -p playlist given, playlist will be treated as own playlist name or as shared playlist url (if begins with http...)
+# With --daemon, it crawls sources listed in file (see crawl_sources.py) by schedule, until stopped by SIGTERM or Ctrl-C
 #
 # TODO: implement mp3 download for spotify and fix MusicProviderSpotify.calc_bpm_histogram
 # TODO: implement usage of spotipy's API named "recommendations".
@@ -18,41 +19,110 @@ import requests
 import time
 import json
 import argparse
+import signal
 
 from music_api import *
 
-from sqlitedict import SqliteDict
-
 import logging
 from logging import debug, info, warning, error
 
 from exceptions import *
 from whoami import *
 from config import *
+from pipeline import *
+from known_tracks import *
+from metrics import *
+from tracing import *
+from downloader import *
+from crawl_sources import *
 
-station_url = None
-playlist_name = None
+apis = {}  # logged in providers by music service, one per service
+known_tracks = {}  # KnownTracks by music service
+dedupe = None
+stopping = False
 
-api = None
 
-def get_cached_track(music_service, track_id):
-    with SqliteDict(tracks_histogram_db, autocommit=True, encode=json.dumps, decode=json.loads) as cache:
-        try:
-            key = music_service + ":" + track_id
-            cached = cache[music_service + ":" + track_id]
-        except KeyError:
-            return None
-        try:
-            return cached["histogram"]
-        except KeyError:
-            error(f"{whoami()}: internal error loading data from cache for track {track_id}")
-            sys.exit(1)
+def count_track(stats, result):
+    stats[result] += 1
+    metrics.inc("bpmcrawl_tracks_total", result=result)
+
+
+def get_api(music_service, provider_logging_level, traced=False):
+    """Return logged in provider of music service, it's created once for all sources of service"""
+    if music_service not in apis:
+        api = get_music_provider(music_service, provider_logging_level)
+        if traced:
+            api = TracedProvider(api, tracer)
+        api.login()
+        apis[music_service] = api
+    return apis[music_service]
+
 
+def get_known(store, music_service, max_set_size, profile=None):
+    """Return KnownTracks of music service, they are loaded once for all sources of service"""
+    if music_service not in known_tracks:
+        known_tracks[music_service] = KnownTracks(store, music_service, max_set_size, profile)
+    return known_tracks[music_service]
+
+
+def crawl_track(pipeline, source, track, stats):
+    """Queue track got from source for analysis, unless it's analyzed already"""
+    track_id = source.api.get_track_id(track)
+    count_track(stats, "processed")
+    with metrics.time("bpmcrawl_stage_seconds", stage="db_read"):
+        is_known = track_id in source.known
+    if not is_known or source.api.is_track_changed(track):
+        pipeline.put(track_id, track, source.api, source)
+    else:
+        count_track(stats, "cached")
+        source.api.mark_track_analyzed(track_id)
+        source.done(track_id)
+        info(f"already have cached histogram for track {track_id}")
+
+
+def save_analysis_result(store, source, track_id, histogram, analysis, audio, stats):
+    music_service = source.music_service
+    if audio and "same_as" in audio:
+        # the same audio was analyzed already, histogram is copied
+        histogram = store.get_histogram(*audio["same_as"])
+        if histogram:
+            count_track(stats, "duplicate")
+            metrics.inc("bpmcrawl_dedupe_saved_seconds_total", audio["saved_seconds"])
+            info(f"track {track_id} has the same audio as {':'.join(audio['same_as'])}, copied its histogram")
+    elif histogram:
+        count_track(stats, "new")
+        if audio:
+            store.save_audio_hash(music_service, track_id, audio["hash"], audio["seconds"])
+            dedupe.add(audio["hash"], music_service, track_id, audio["seconds"])
+    if histogram:
+        store.save_histogram(music_service, track_id, histogram, analysis)
+        source.known.add(track_id)
+        source.api.mark_track_analyzed(track_id)
+        info(f"saved histogram for track {track_id}: {histogram}")
+    else:
+        count_track(stats, "failed")
+        error(f"Failed to get histogram for {track_id}, skipping")
+    source.done(track_id)
 
-def save_cached_track(music_service, track_id, histogram):
-    """warning: for now, it will override all data saved for this track"""
-    with SqliteDict(tracks_histogram_db, autocommit=True, encode=json.dumps, decode=json.loads) as cache:
-        cache[music_service + ":" + track_id] = {"histogram": histogram}
+
+def save_results(store, results, sources, stats):
+    """Save results of analysis; when they are committed, checkpoints of sources are saved"""
+    with metrics.time("bpmcrawl_stage_seconds", stage="db_write"):
+        for track_id, histogram, analysis, audio, source in results:
+            save_analysis_result(store, source, track_id, histogram, analysis, audio, stats)
+        store.maybe_commit()
+        if not store.uncommitted:
+            # only position of committed tracks is saved
+            for source in sources:
+                source.maybe_save()
+
+
+def stop_daemon(signum, frame):
+    global stopping
+    info(f"got signal {signum}, stopping when tracks in work are done (repeat to stop at once)")
+    stopping = True
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
 
 if __name__ == '__main__':
@@ -64,8 +134,8 @@ if __name__ == '__main__':
         description=f'Get the tracks from playlist, analyze them and add info to cache database ({tracks_histogram_db})',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-s', '--service', type=str,
-                        required=True, choices=music_service_mapping.keys(),
-                        help=f'Specify which music service provider to use')
+                        choices=music_service_mapping.keys(),
+                        help=f'Specify which music service provider to use (required unless --daemon is given)')
     parser.add_argument('-f', '--db-file', type=str,
                         help=f'File to use instead of {tracks_histogram_db}')
     parser.add_argument('--station', type=str,
@@ -78,13 +148,65 @@ if __name__ == '__main__':
     parser.add_argument('-A', '--artist-id', type=str,
                         help=f'Artist id.')
     parser.add_argument('-l', '--limit', default=0, type=int,
-                        help=f'Process no more than this amount of tracks (useful for testing), 0 for no limit.')
+                        help=f'Process no more than this amount of tracks (useful for testing), 0 for no limit.'
+                             f' For daemon, limit is set per source in sources file')
+    parser.add_argument('--daemon', default=False, action='store_true',
+                        help=f'Run until stopped, crawling sources listed in --sources file by their schedules')
+    parser.add_argument('--sources', default=crawl_sources_file, type=str,
+                        help=f'For daemon: json file with list of sources, e.g. [{{"service": "yandexmusic", "playlist": "LIKED",'
+                             f' "interval": 3600, "priority": 2}}, {{"service": "synthetic", "artist": "a00001"}}]')
+    parser.add_argument('--active-sources', default=crawl_active_sources, type=int,
+                        help=f'For daemon: how many sources are crawled at once (tracks of all of them are analyzed'
+                             f' by the same workers)')
+    parser.add_argument('--resume', default=False, action='store_true',
+                        help=f'Continue crawl of playlist or artist from the position where the last run stopped'
+                             f' (checkpoints are kept in {crawl_checkpoints_dir}; stations are always continued)')
+    parser.add_argument('--checkpoint-every', default=crawl_checkpoint_every, type=int,
+                        help=f'Save position of crawl after this many processed tracks')
+    parser.add_argument('-w', '--workers', default=1, type=int,
+                        help=f'Number of analysis processes; with more than 1, tracks are analyzed in process pool')
+    parser.add_argument('--prefetch', default=2, type=int,
+                        help=f'How many tracks to download ahead while analyzing current one')
+    parser.add_argument('--downloads', default=download_concurrency, type=int,
+                        help=f'How many tracks to download at a time')
+    parser.add_argument('--host-bandwidth', default=download_host_bandwidth // 1024, type=int,
+                        help=f'Limit of download bandwidth per host, KB/s, 0 for unlimited')
+    parser.add_argument('--max-temp-mb', default=temp_dir_max_bytes // 2**20, type=int,
+                        help=f'Stop downloading ahead when downloaded tracks take this much space in {temp_dir}')
+    parser.add_argument('-P', '--profile', default=analysis_profile, choices=analysis_profiles.keys(),
+                        help=f'Analysis profile: accurate is slowest, fast is several times faster, fastest is for quick estimates')
+    parser.add_argument('-R', '--reanalyze', default=False, action='store_true',
+                        help=f'Analyze again tracks that were analyzed with other profile or older version of it')
+    parser.add_argument('--no-dedupe', dest='dedupe', default=audio_dedupe, action='store_false',
+                        help=f'Analyze downloaded audio even if the same audio was already analyzed for another track')
+    parser.add_argument('--window', default=analysis_window_seconds, type=float,
+                        help=f'Analyze only this many seconds of track (and download only them, if provider supports it), 0 for whole track')
+    parser.add_argument('--window-position', default=analysis_window_position, type=float,
+                        help=f'Position of center of analysis window, relative to track duration')
+    parser.add_argument('--known-max-set-size', default=known_tracks_max_set_size, type=int,
+                        help=f'Keep ids of cached tracks in memory as set up to this count, as bloom filter above it')
+    parser.add_argument('--stats-out', type=str,
+                        help=f'Write stats and time spent by stages to this file as json when finished')
+    parser.add_argument('--metrics-port', type=int,
+                        help=f'Serve metrics in Prometheus format at http://localhost:PORT/metrics')
+    parser.add_argument('--metrics-file', type=str,
+                        help=f'Write metrics in Prometheus format to this file periodically (e.g. for node_exporter textfile collector)')
+    parser.add_argument('--progress-interval', default=60, type=float,
+                        help=f'Log throughput and ETA every this many seconds, 0 to disable')
+    parser.add_argument('--profile-out', type=str,
+                        help=f'Write timeline of tracks, stages, provider calls and db commits to this file'
+                             f' (Chrome trace json, open it in https://ui.perfetto.dev)')
+    parser.add_argument('--profile-pstats', type=str,
+                        help=f'With --profile-out, also profile stages with cProfile and write stats to this dir'
+                             f' (analysis is not profiled when it is done in process pool)')
     parser.add_argument('-d', '--debug', default=False, action='store_true',
                         help=f'Enable debugging output')
     parser.add_argument('-D', '--provider-debug', default=False, action='store_true',
                         help=f'Enable debugging output for music provider library')
 
     args = parser.parse_args()
+    if not args.service and not args.daemon:
+        parser.error(f'the following arguments are required: -s/--service')
 
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
@@ -94,9 +216,20 @@ if __name__ == '__main__':
     if args.provider_debug:
         provider_logging_level = logging.DEBUG
 
-    music_service = args.service
-    station_url = args.station
-    playlist_name = args.playlist
+    sources = None
+    if args.daemon:
+        sources = load_crawl_sources(args.sources)
+    elif args.playlist:
+        source = CrawlSource(args.service, "playlist", args.playlist, limit=args.limit)
+    elif args.artist_id:
+        source = CrawlSource(args.service, "artist", args.artist_id, limit=args.limit)
+    elif args.artist:
+        raise ExBpmCrawlGeneric(f"artist by name is not implemented yet")
+    else:
+        source = CrawlSource(args.service, "station", args.station, limit=args.limit)
+
+    if args.profile_out:
+        tracer.start(args.profile_pstats)
 
     if args.db_file:
         tracks_histogram_db = args.db_file
@@ -105,82 +238,109 @@ if __name__ == '__main__':
     os.makedirs(temp_dir, exist_ok=True)
     os.makedirs(os.path.dirname(tracks_histogram_db), exist_ok=True)
 
-    if not is_cache_version_ok():
+    if not is_cache_version_ok(tracks_histogram_db):
         print(f"wrong cache version, convert or delete it ({tracks_histogram_db})", file=sys.stderr)
         sys.exit(1)
+    store = HistogramStore(tracks_histogram_db)
+    if args.dedupe:
+        dedupe = AudioHashIndex(store)
+    known_profile = args.profile if args.reanalyze else None
 
-    api = get_music_provider(music_service, provider_logging_level)
-    api.login()
+    downloader.configure(concurrency=args.downloads, host_bandwidth=args.host_bandwidth * 1024)
+    api = None
+    if not args.daemon:
+        api = get_api(args.service, provider_logging_level, bool(args.profile_out))
 
-    station = None
+    stats = {"processed": 0, "new": 0, "failed": 0, "cached": 0, "duplicate": 0}
+    started = time.monotonic()
+    exporter = MetricsExporter(metrics, args.metrics_port, args.metrics_file)
 
-    stats = {"processed": 0, "new": 0, "failed": 0}
+    # in daemon, tracks of all providers are analyzed by the same pipeline
+    pipeline = CrawlPipeline(api, workers=args.workers, prefetch=args.prefetch,
+                             max_temp_bytes=args.max_temp_mb * 2**20, profile=args.profile,
+                             window_seconds=args.window, window_position=args.window_position, dedupe=dedupe,
+                             downloads=args.downloads)
 
-    mode = None
-    if playlist_name:
-        mode = 'playlist'
-        playlist_tracks = api.get_playlist_tracks(api.get_playlist(playlist_name))
-        if playlist_tracks is None:
-            info(f"Playlist not found: {playlist_name}")
-            sys.exit(1)
-        playlist_current_track = 0
-        info(f"Now crawling on playlist {playlist_name} ({len(playlist_tracks)} tracks)")
-    elif args.artist or args.artist_id:
-        mode = 'artist'
-        artist_id = None
-        if args.artist_id:
-            artist_id = args.artist_id
-        elif args.artist:
-            raise ExBpmCrawlGeneric(f"artist by name is not implemented yet")
-        artist = api.get_artist(artist_id)
-        if not artist:
-            raise ExBpmCrawlGeneric(f"Failed to find artist with id {artist_id}")
-        api.artist_pager_init(artist)
-    else:
-        mode = 'stations'
-        # this is what was for google music, there were "stations"
-        station = api.get_station_from_url(station_url)
-        api.station_prepare(station)
-        info(f"Now crawling on station {api.get_station_name(station)}")
-
-    stop = False
-    while not stop:
-        if mode == 'stations':
-            track = api.station_get_next_track()
-        elif mode == 'playlist':
-            if playlist_current_track < len(playlist_tracks):
-                track = playlist_tracks[playlist_current_track]
-                playlist_current_track += 1
-            else:
-                track = None
-        elif mode == 'artist':
-            track = api.artist_pager_get_next_track(artist)
-        else:
-            raise ExBpmCrawlGeneric(f"Internal error: unknown mode :'{mode}'")
-        if not track:
-            stop = True
-            break
-        track_id = api.get_track_id(track)
-        stats["processed"] += 1
-        histogram = get_cached_track(music_service, track_id)
-        if not histogram:
-            try:
-                histogram = api.calc_bpm_histogram(track)
-            except ExBpmCrawlGeneric as e:
-                error(f"Got error instead of histogram: ${e}")
-            if histogram:
-                stats["new"] += 1
-                save_cached_track(music_service, track_id, histogram)
-                info(f"saved histogram for track {track_id}: {histogram}")
+    if args.daemon:
+        signal.signal(signal.SIGINT, stop_daemon)
+        signal.signal(signal.SIGTERM, stop_daemon)
+        scheduler = CrawlScheduler(sources, args.active_sources)
+        progress = ProgressLog(metrics, args.progress_interval)
+        while not stopping:
+            now = time.monotonic()
+            for source in scheduler.start_due(now):
+                try:
+                    with metrics.time("bpmcrawl_stage_seconds", stage="fetch"):
+                        source.open(get_api(source.music_service, provider_logging_level, bool(args.profile_out)),
+                                    get_known(store, source.music_service, args.known_max_set_size, known_profile),
+                                    tracks_histogram_db, resume=True, checkpoint_every=args.checkpoint_every)
+                except Exception as e:
+                    debug(f"Got exception:", exc_info=True)
+                    error(f"Failed to start crawl of {source}: {e}")
+                    scheduler.finish(source)
+            source = scheduler.next_source()
+            if source:
+                try:
+                    with metrics.time("bpmcrawl_stage_seconds", stage="fetch"):
+                        track = source.get_next_track()
+                except Exception as e:
+                    debug(f"Got exception:", exc_info=True)
+                    error(f"Failed to get next track of {source}: {e}")
+                    track = None
+                if track:
+                    crawl_track(pipeline, source, track, stats)
+                else:
+                    scheduler.finish(source)
+                    info(f"crawl of {source} is {'finished' if source.exhausted else 'stopped'} after"
+                         f" {source.fetched} tracks, next one in {max(source.next_run - time.monotonic(), 0):.0f} s")
             else:
-                stats["failed"] += 1
-                error(f"Failed to get histogram for {track_id}, skipping")
-        else:
-            info(f"already have cached histogram for track {track_id}: {histogram}")
-        if args.limit:
-            if stats["processed"] >= args.limit:
-                info(f"Reached limit of {args.limit} tracks, stopping.")
-                stop = True
-        time.sleep(0.1)
+                # nothing to crawl now, results of tracks in work are still saved while waiting
+                time.sleep(min(scheduler.get_wait(now), 1))
+            save_results(store, pipeline.get_results(), scheduler.active + scheduler.draining, stats)
+            for source in scheduler.get_drained():
+                source.close()
+            progress.maybe_log()
+            exporter.maybe_write()
+        sources = scheduler.active + scheduler.draining
+    else:
+        try:
+            with metrics.time("bpmcrawl_stage_seconds", stage="fetch"):
+                source.open(api, get_known(store, args.service, args.known_max_set_size, known_profile),
+                            tracks_histogram_db, resume=args.resume, checkpoint_every=args.checkpoint_every)
+        except ExBpmCrawlPlaylistNotExists as e:
+            info(str(e))
+            sys.exit(1)
+        progress = ProgressLog(metrics, args.progress_interval, source.total)
+        while True:
+            with metrics.time("bpmcrawl_stage_seconds", stage="fetch"):
+                track = source.get_next_track()
+            if not track:
+                break
+            crawl_track(pipeline, source, track, stats)
+            save_results(store, pipeline.get_results(), [source], stats)
+            progress.maybe_log()
+            exporter.maybe_write()
+        if not source.exhausted:
+            info(f"Reached limit of {args.limit} tracks, stopping.")
+        sources = [source]
+    results = pipeline.close()
+    save_results(store, results, [], stats)
+    with metrics.time("bpmcrawl_stage_seconds", stage="db_write"):
+        store.close()
+    for source in sources:
+        source.close()
+    if args.progress_interval:
+        progress.log()
+    exporter.close()
+    if args.profile_out:
+        tracer.save(args.profile_out)
+    if stats["duplicate"]:
+        info(f"{stats['duplicate']} tracks had already analyzed audio, analysis of them would take"
+             f" {metrics.get('bpmcrawl_dedupe_saved_seconds_total'):.0f} s")
     info(f"bpmcrawld exiting; stats: {stats}")
-
+    if args.stats_out:
+        with open(args.stats_out, "w") as f:
+            json.dump({**stats, "seconds": time.monotonic() - started,
+                       "download_bytes": metrics.get("bpmcrawl_download_bytes_total"),
+                       "dedupe_saved_seconds": metrics.get("bpmcrawl_dedupe_saved_seconds_total"),
+                       "stages": metrics.get_sums("bpmcrawl_stage_seconds", "stage")}, f, indent=2)
@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import os
+import time
+import json
+import hashlib
 from collections import OrderedDict
 
 from essentia import log
@@ -11,21 +15,102 @@ from essentia.standard import *
 from logging import debug, info, warning, error
 
 from exceptions import *
+from config import *
 
-def calc_file_bpm_histogram(filename):
+# Analysis profiles: name -> parameters.
+# Version of profile is saved with histogram; increase it when changing parameters of profile,
+# so tracks analyzed with older version may be found and reanalyzed.
+#   accurate: what was always used before profiles appeared
+#   fast: degara beat tracker is several times faster than multifeature one;
+#     RhythmExtractor2013 works only at 44100 Hz, so sample rate is not lowered for it
+#   fastest: PercivalBpmEstimator at low sample rate, applied to consecutive segments of track,
+#     histogram is made of bpm of segments; resampled with the fastest quality, as default quality of resampling
+#     costs more than estimation itself (version 2: window of track is resampled so too;
+#     version 3: estimator is reset before every segment, before that it repeated bpm of its first segment)
+analysis_profiles = {
+    "accurate": {"version": 1, "sample_rate": 44100, "method": "multifeature"},
+    "fast": {"version": 1, "sample_rate": 44100, "method": "degara"},
+    "fastest": {"version": 3, "sample_rate": 11025, "resample_quality": 4, "method": "percival", "segment_seconds": 10},
+}
+
+# essentia algorithms of this process, built once by init_analysis_worker() and reused for every track
+analyzers = None
+
+
+def init_analysis_worker(profile=analysis_profile):
+    """Build essentia algorithms for this process.
+    Used as initializer of analysis process pool, and called on first use when analyzing in main process.
+    """
+    global analyzers
+    if profile not in analysis_profiles:
+        raise ExBpmCrawlGeneric(f"Unknown analysis profile '{profile}'")
+    params = analysis_profiles[profile]
+    analyzers = {
+        "profile": profile,
+        "loader": MonoLoader(),
+    }
+    if params["method"] == "percival":
+        analyzers["rhythm"] = PercivalBpmEstimator(sampleRate=params["sample_rate"])
+    else:
+        analyzers["rhythm"] = RhythmExtractor2013(method=params["method"])
+        analyzers["histogram"] = BpmHistogramDescriptors()
+
+
+def get_analysis_params(profile=analysis_profile):
+    """Get analysis parameters to be saved with histogram"""
+    return {"profile": profile, "profile_version": analysis_profiles[profile]["version"]}
+
+
+def get_analysis_window(duration, length, position=0.5):
+    """
+    Get part of track to analyze
+    :param duration: duration of track in seconds (None if unknown)
+    :param length: length of window in seconds, 0 for whole track
+    :param position: position of center of window, relative to track duration
+    :return: (start, end) in seconds, or None for whole track
+    """
+    if not length or not duration or duration <= length:
+        return None
+    start = min(max(duration * position - length / 2, 0), duration - length)
+    return (round(start, 1), round(start + length, 1))
+
+
+def calc_file_bpm_histogram(filename, window=None, profile=analysis_profile, timings=None):
     """Analyze filename, get average BPM and calculate DPB histogram
+    :param window: (start, end) in seconds to analyze only this part of file, None for whole file
+    :param profile: name of analysis profile (see analysis_profiles)
+    :param timings: if dict is given, seconds spent on "decode", "rhythm" (beat tracking or bpm estimation)
+                    and "histogram" are added to it
     :returns dict: { bpm(int): bpm_share(float) }
     :raises ExcBpmCrawlGeneric on error
     """
 
-    bpm = None
-    beats_intervals = None
-    beats = None
-    beats_confidence = None
+    if analyzers is None or analyzers["profile"] != profile:
+        init_analysis_worker(profile)
+    params = analysis_profiles[profile]
+    if timings is None:
+        timings = {}
+    started = time.monotonic()
+
     try:
-        audio = MonoLoader(filename=filename)()
-        rhythm_extractor = RhythmExtractor2013(method="multifeature")
-        (bpm, beats, beats_confidence, _, beats_intervals) = rhythm_extractor(audio)
+        # window is cut from decoded track (EasyLoader decodes whole track too, but has no resampleQuality),
+        # so window and whole track are resampled the same way
+        resample = {"resampleQuality": params["resample_quality"]} if "resample_quality" in params else {}
+        analyzers["loader"].configure(filename=filename, sampleRate=params["sample_rate"], **resample)
+        audio = analyzers["loader"]()
+        if window:
+            audio = audio[int(window[0] * params["sample_rate"]):int(window[1] * params["sample_rate"])]
+        decoded = time.monotonic()
+        timings["decode"] = timings.get("decode", 0) + decoded - started
+        if params["method"] == "percival":
+            histogram = calc_segments_bpm_histogram(audio, params)
+            timings["rhythm"] = timings.get("rhythm", 0) + time.monotonic() - decoded
+            return histogram
+        (bpm, beats, beats_confidence, _, beats_intervals) = analyzers["rhythm"](audio)
+        rhythm_done = time.monotonic()
+        timings["rhythm"] = timings.get("rhythm", 0) + rhythm_done - decoded
+    except ExBpmCrawlGeneric:
+        raise
     except Exception as e:
         raise ExBpmCrawlGeneric(str(e))
         #if re.search('Could not find stream information', str(e)):
@@ -34,10 +119,10 @@ def calc_file_bpm_histogram(filename):
         #    print( "Failed on '%s': %s(%s)" % (filename, type(e).__name__, str(e)) )
 
     if bpm == None:
-        raise ExcBpmCrawlGeneric(f"Failed to calculate BPM for {filename}")
+        raise ExBpmCrawlGeneric(f"Failed to calculate BPM for {filename}")
     debug(f"Analyzed {filename}, got average bpm: {bpm}")
 
-    peak1_bpm, peak1_weight, peak1_spread, peak2_bpm, peak2_weight, peak2_spread, histogram = BpmHistogramDescriptors()(beats_intervals)
+    peak1_bpm, peak1_weight, peak1_spread, peak2_bpm, peak2_weight, peak2_spread, histogram = analyzers["histogram"](beats_intervals)
     #debug(histogram)
 
     hist_hash = {}
@@ -48,5 +133,69 @@ def calc_file_bpm_histogram(filename):
             hist_hash[hist_bpm] = hval
         hist_bpm += 1
     #debug(hist_hash)
+    timings["histogram"] = timings.get("histogram", 0) + time.monotonic() - rhythm_done
     return hist_hash
 
+
+def calc_file_bpm_histogram_timed(filename, window=None, profile=analysis_profile):
+    """Same as calc_file_bpm_histogram, for process pool: returns (histogram, timings) (see timings param)"""
+    timings = {}
+    histogram = calc_file_bpm_histogram(filename, window, profile, timings)
+    return histogram, timings
+
+
+def calc_file_audio_hash(filename, window=None, profile=analysis_profile):
+    """
+    Digest of audio file together with parameters of its analysis: histograms of files with the same digest are equal.
+    Files are compared as is, without decoding (which would cost a noticeable part of analysis),
+    but ID3 tags are skipped, so copies of the same mp3 with different tags have the same digest.
+    :return: 16 bytes
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps([get_analysis_params(profile), window]).encode())
+    with open(filename, "rb") as f:
+        start, end = get_audio_data_range(f)
+        f.seek(start)
+        left = end - start
+        while left > 0:
+            chunk = f.read(min(left, 2**20))
+            if not chunk:
+                break
+            digest.update(chunk)
+            left -= len(chunk)
+    return digest.digest()
+
+
+def get_audio_data_range(f):
+    """:return: (start, end) offsets of file without ID3v2 tag at start and ID3v1 tag at end"""
+    size = os.fstat(f.fileno()).st_size
+    start = 0
+    header = f.read(10)
+    if len(header) == 10 and header[:3] == b"ID3":
+        # size of ID3v2 tag is 4 bytes of 7 bits, without header and footer
+        start = 10 + (header[6] << 21 | header[7] << 14 | header[8] << 7 | header[9]) + (10 if header[5] & 0x10 else 0)
+    end = size
+    if size - start >= 128:
+        f.seek(size - 128)
+        if f.read(3) == b"TAG":
+            end = size - 128
+    return min(start, end), end
+
+
+def calc_segments_bpm_histogram(audio, params):
+    """Estimate bpm of consecutive segments of audio, return histogram of them: { bpm(int): share(float) }"""
+    segment = int(params["segment_seconds"] * params["sample_rate"])
+    counts = {}
+    total = 0
+    for start in range(0, len(audio), segment):
+        if len(audio) - start < segment / 2 and total:
+            break  # too short tail
+        # estimator keeps state between calls, without reset it returns result of its first call again
+        analyzers["rhythm"].reset()
+        bpm = round(float(analyzers["rhythm"](audio[start:start + segment])))
+        if bpm > 0:
+            counts[bpm] = counts.get(bpm, 0) + 1
+            total += 1
+    if not total:
+        raise ExBpmCrawlGeneric(f"Failed to calculate BPM")
+    return {bpm: round(count / total, 2) for bpm, count in sorted(counts.items())}
@@ -0,0 +1,107 @@
+import os
+import re
+import json
+import time
+import hashlib
+import collections
+
+from logging import debug, info, warning, error
+
+from exceptions import *
+from whoami import *
+from config import *
+
+
+class CrawlCheckpoint(WhoamiObject):
+    """
+    Position of crawl in source of tracks (playlist or artist pager), kept between runs, so bpmcrawld --resume
+    starts where the last run stopped.
+    Cursor of source is saved for the oldest track which is not finished yet (it may be still downloaded or analyzed
+    while later tracks are fetched), so no track is lost if process dies; file is rewritten by maybe_save() after
+    `every` finished tracks, it must be called when results of finished tracks are committed.
+    Cursor is a dict given by caller, e.g. {"index": 10, "track_id": "..."} for playlist.
+    Checkpoint belongs to database of histograms it was saved with: path of database is part of file name (as digest)
+    and is kept in file, checkpoint is ignored when crawl uses other database.
+    Station sessions are not here, they keep done tracks by themselves (see StationSession in music_api.py).
+    """
+    def __init__(self, music_service, source, source_id, db_file=tracks_histogram_db, every=crawl_checkpoint_every,
+                 dirname=crawl_checkpoints_dir):
+        os.makedirs(dirname, exist_ok=True)
+        source_name = re.sub(r'[^\w.-]', '_', str(source_id))
+        db_file = os.path.realpath(db_file)
+        db_digest = hashlib.blake2b(db_file.encode(), digest_size=4).hexdigest()
+        self.filename = os.path.join(dirname, f"{music_service}-{source}-{source_name}-{db_digest}.json")
+        self.source = {"service": music_service, "source": source, "id": str(source_id), "db": db_file}
+        self.every = every
+        self.snapshot = None  # version of source contents, if provider has it
+        self.pending = collections.OrderedDict()  # fetch number -> cursor of tracks not finished yet
+        self.track_fetches = {}  # track id -> fetch numbers of it in pending
+        self.fetches = 0
+        self.next_cursor = None  # cursor of track after the last fetched one
+        self.finished_tracks = 0  # since last save
+        self.finished = False
+
+    def load(self):
+        """:return: saved checkpoint as dict with cursor and snapshot, None if there is no checkpoint"""
+        try:
+            with open(self.filename) as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            warning(f"{self.whoami()}: ignoring broken checkpoint {self.filename}: {e}")
+            return None
+        if checkpoint.get("db") != self.source["db"]:
+            warning(f"{self.whoami()}: ignoring checkpoint {self.filename} of other database ({checkpoint.get('db')})")
+            return None
+        if {key: checkpoint.get(key) for key in self.source} != self.source:
+            warning(f"{self.whoami()}: ignoring checkpoint {self.filename} of other source")
+            return None
+        return checkpoint
+
+    def fetched(self, track_id, cursor, next_cursor):
+        """Track was fetched from source at cursor, next_cursor is position after it"""
+        self.fetches += 1
+        self.pending[self.fetches] = cursor
+        self.track_fetches.setdefault(track_id, collections.deque()).append(self.fetches)
+        self.next_cursor = next_cursor
+
+    def done(self, track_id):
+        """Track is finished (found in cache, analyzed or failed)"""
+        fetches = self.track_fetches.get(track_id)
+        if fetches:
+            del self.pending[fetches.popleft()]
+            if not fetches:
+                del self.track_fetches[track_id]
+        self.finished_tracks += 1
+
+    def maybe_save(self):
+        """Save checkpoint if `every` tracks were finished since last save"""
+        if self.finished_tracks >= self.every:
+            self.save()
+
+    def get_cursor(self):
+        if self.pending:
+            return next(iter(self.pending.values()))
+        return self.next_cursor
+
+    def save(self):
+        self.finished_tracks = 0
+        cursor = self.get_cursor()
+        if cursor is None or self.finished:
+            return
+        debug(f"{self.whoami()}: saving checkpoint {cursor} to {self.filename}")
+        # written to temp file and renamed, so checkpoint is never half-written
+        with open(f"{self.filename}.tmp", "w") as f:
+            json.dump({**self.source, "cursor": cursor, "snapshot": self.snapshot, "saved": time.time()}, f)
+        os.replace(f"{self.filename}.tmp", self.filename)
+
+    def finish(self):
+        """Source is crawled to the end: remove checkpoint, next run starts from beginning"""
+        self.finished = True
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+            debug(f"{self.whoami()}: removed checkpoint {self.filename}")
+
+    def close(self):
+        self.save()
@@ -1,43 +1,160 @@
 import os
+import sys
 import json
 import re
+import time
+import atexit
+import signal
+import threading
+import sqlite3
 from sqlitedict import SqliteDict
+from histogram_codec import *
+from tracing import *
 from exceptions import *
 from whoami import *
 from logging import debug, info, warning, error
 
 gmusic_client_id = '3ae9278a98fd8efe'
 
-# key-value database of all track's histograms ever found
+# database of all track's histograms ever found
 tracks_histogram_db = 'data/histograms.db'
 temp_dir = 'data/tmp'
+# how many bytes downloaded tracks waiting for analysis may occupy in temp_dir
+temp_dir_max_bytes = 256 * 2**20
+# known tracks are kept in memory as set up to this count, as bloom filter above it
+known_tracks_max_set_size = 1000000
+known_tracks_bloom_error_rate = 0.001
+# how to store histograms of new tracks (see histogram_codec.py):
+#   "sparse" or "dense": binary encoded, in tracks.histogram
+#   "bins": one row per bin in bins table, allows to search by bpm with SQL (HistogramStore.find_tracks)
+histogram_encoding = "sparse"
+# analysis profile for new tracks (see analysis_profiles in calc_bpm.py)
+analysis_profile = "accurate"
+# analyze only this many seconds around analysis_window_position (relative to track duration), 0 for whole track
+analysis_window_seconds = 0
+analysis_window_position = 0.5
+# downloads of tracks (see downloader.py): how many at a time (it is also count of download threads of crawl pipeline),
+# bandwidth limit per host in bytes/s (0 for unlimited), size of chunks read from network and of file write buffer
+download_concurrency = 2
+download_host_bandwidth = 0
+download_chunk_size = 256 * 2**10
+download_buffer_size = 2**20
+# limits of requests to API of music providers (see ratelimit.py): requests per second and burst,
+# retries of failed requests with exponential backoff from provider_backoff_seconds up to provider_backoff_max_seconds,
+# and how many consecutive failures stop requests for provider_breaker_seconds
+provider_rate_limits = {
+    "default": {"rate": 10, "burst": 20},
+    "spotify": {"rate": 5, "burst": 10},
+    "synthetic": {"rate": 1000, "burst": 1000},
+}
+provider_api_retries = 5
+provider_backoff_seconds = 0.5
+provider_backoff_max_seconds = 60
+provider_breaker_failures = 10
+provider_breaker_seconds = 60
+# don't analyze audio which was already analyzed under another track id (see calc_file_audio_hash in calc_bpm.py)
+audio_dedupe = True
+# local music provider: state of scanned files (to skip unchanged ones), threads scanning directories,
+# extensions of audio files, and where playlists created by bpmcrawl-pick are saved (as m3u)
+local_scan_db = 'data/local-files.db'
+local_scan_workers = 8
+local_audio_extensions = ('.mp3', '.flac', '.ogg', '.opus', '.m4a', '.aac', '.wav', '.wma')
+local_playlists_dir = 'data/playlists'
+# station playback sessions (see StationSession in music_api.py): where ids of seen tracks are kept between runs,
+# how many last of them are sent to service as recently played, and how many batches of tracks in a row
+# without unseen tracks end the playback
+station_sessions_dir = 'data/stations'
+station_recent_size = 500
+station_seen_batches_to_stop = 3
+# checkpoints of crawl (see CrawlCheckpoint in checkpoint.py): where cursors of playlists and artist pagers are kept
+# for bpmcrawld --resume, and how many finished tracks make the checkpoint to be saved
+crawl_checkpoints_dir = 'data/checkpoints'
+crawl_checkpoint_every = 20
+# daemon mode of bpmcrawld (see crawl_sources.py): file with sources to crawl, default interval between starts
+# of crawls of source (seconds) and its priority, and how many sources are crawled at once
+crawl_sources_file = 'data/sources.json'
+crawl_source_interval = 3600
+crawl_source_priority = 1
+crawl_active_sources = 4
+# artist pager (see ArtistPager in music_api.py): tracks per page (for spotify, albums per page, up to 50),
+# and how many albums of spotify artist get their tracks fetched at once
+artist_page_size = 50
+artist_album_fetch_workers = 8
 
-cache_db_version = "3"
+cache_db_version = "7"
 cache_db_version_recordid = "bpmcrawl_db_version"
 cache_db_regexp_cache_id = '^([^:]+):(.+)$'
 
+# since version 4 database is relational:
+#   tracks: one row per track of music provider, with binary encoded histogram (since version 5)
+#     and parameters of analysis which produced histogram, json (since version 6)
+#   bins: one row per histogram bin of track, indexed by bpm for range queries (if histogram is not encoded)
+#   playlist_tracks: which tracks were found (or added by bpmcrawl-pick) in which playlists
+#   audio_hashes: digest of analyzed audio -> track whose histogram was calculated from it, and seconds spent
+#     on analysis (since version 7)
+cache_db_schema_audio_hashes = """
+CREATE TABLE IF NOT EXISTS audio_hashes (
+    hash BLOB PRIMARY KEY,
+    track INTEGER NOT NULL REFERENCES tracks(id) ON DELETE CASCADE,
+    seconds REAL
+);
+"""
+cache_db_schema = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY,
+    provider TEXT NOT NULL,
+    track_id TEXT NOT NULL,
+    histogram BLOB,
+    analysis TEXT,
+    UNIQUE (provider, track_id)
+);
+CREATE TABLE IF NOT EXISTS bins (
+    track INTEGER NOT NULL REFERENCES tracks(id) ON DELETE CASCADE,
+    bpm REAL NOT NULL,
+    share REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bins_track ON bins (track);
+CREATE INDEX IF NOT EXISTS bins_bpm ON bins (bpm, track, share);
+CREATE TABLE IF NOT EXISTS playlist_tracks (
+    playlist_id TEXT NOT NULL,
+    track INTEGER NOT NULL REFERENCES tracks(id) ON DELETE CASCADE,
+    PRIMARY KEY (playlist_id, track)
+);
+""" + cache_db_schema_audio_hashes
+
+
 def get_cache_version(filename=tracks_histogram_db):
-    """Return cache version or None if it is not defined"""
+    """Return cache version or None if it is not defined. Creates database of current version if there is no file."""
     if not os.path.exists(filename):
-        debug(f"{whoami()}: creating new cache database {filename}")
-        with SqliteDict(filename, autocommit=True, encode=json.dumps, decode=json.loads) as cache:
-            cache[cache_db_version_recordid] = cache_db_version
-            return True
+        HistogramStore(filename).close()
+        return cache_db_version
+
+    conn = sqlite3.connect(filename)
+    try:
+        tables = [x[0] for x in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        if "meta" in tables:
+            row = conn.execute("SELECT value FROM meta WHERE key = ?", (cache_db_version_recordid,)).fetchone()
+            return row[0] if row else None
+    finally:
+        conn.close()
 
-    with SqliteDict(filename, autocommit=True, encode=json.dumps, decode=json.loads) as cache:
+    # versions before 4 are key-value sqlitedict databases
+    with SqliteDict(filename, flag='r', encode=json.dumps, decode=json.loads) as cache:
         try:
             cached = cache[cache_db_version_recordid]
         except KeyError:
             debug(f"{whoami()}: failed to load db version from {filename}")
             return None
         return cached
-    debug(f"{whoami()}: internal error: should not be here")
-    return False
 
 
-def is_cache_version_ok():
+def is_cache_version_ok(filename=tracks_histogram_db):
     """Return True if cache version is compatible"""
-    db_version = get_cache_version()
+    db_version = get_cache_version(filename)
     if db_version == cache_db_version:
         debug(f"{whoami()}: db version ok ({cache_db_version})")
         return True
@@ -62,3 +179,239 @@ def get_track_id_from_cache_id(cache_id):
         return track_id
     else:
         raise ExBpmCrawlGeneric(f"Bad cache record found, can't extract track id from cache id '{cache_id}'")
+
+
+class HistogramStore(WhoamiObject):
+    """
+    Cache database of track histograms with one connection kept open for the whole process.
+    Writes are grouped into transactions, which are committed after commit_every writes or
+    commit_interval seconds, and on close(). close() is called at exit and on SIGTERM.
+    """
+    def __init__(self, filename=tracks_histogram_db, commit_every=500, commit_interval=10):
+        self.filename = filename
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.uncommitted = 0
+        self.last_commit = time.monotonic()
+        create = not os.path.exists(filename)
+        self.db = sqlite3.connect(filename)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        if create:
+            debug(f"{self.whoami()}: creating new cache database {filename}")
+            self.db.executescript(cache_db_schema)
+            self.set_version(cache_db_version)
+            self.commit()
+        atexit.register(self.close)
+        if threading.current_thread() is threading.main_thread() \
+                and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            # exit normally on SIGTERM, so atexit handlers will commit the rest
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+    def get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        """Set value of meta record, None deletes it"""
+        if value is None:
+            self.db.execute("DELETE FROM meta WHERE key = ?", (key,))
+        else:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+        self.written()
+
+    def get_version(self):
+        return self.get_meta(cache_db_version_recordid)
+
+    def set_version(self, version):
+        self.set_meta(cache_db_version_recordid, version)
+
+    def get_track_rowid(self, music_service, track_id, create=False):
+        row = self.db.execute("SELECT id FROM tracks WHERE provider = ? AND track_id = ?",
+                              (music_service, track_id)).fetchone()
+        if row:
+            return row[0]
+        if not create:
+            return None
+        return self.db.execute("INSERT INTO tracks (provider, track_id) VALUES (?, ?)",
+                               (music_service, track_id)).lastrowid
+
+    def has_track(self, music_service, track_id):
+        return self.get_track_rowid(music_service, track_id) is not None
+
+    def get_histogram(self, music_service, track_id):
+        """Return histogram { bpm(float): share(float) } or None if track is not in cache"""
+        row = self.db.execute("SELECT id, histogram FROM tracks WHERE provider = ? AND track_id = ?",
+                              (music_service, track_id)).fetchone()
+        if row is None:
+            return None
+        if row[1] is not None:
+            return decode_histogram(row[1])
+        return dict(self.db.execute("SELECT bpm, share FROM bins WHERE track = ?", (row[0],)))
+
+    def get_analysis(self, music_service, track_id):
+        """Return parameters of analysis which produced histogram of track, e.g. {"window": [start, end]}"""
+        row = self.db.execute("SELECT analysis FROM tracks WHERE provider = ? AND track_id = ?",
+                              (music_service, track_id)).fetchone()
+        return json.loads(row[0]) if row and row[0] else {}
+
+    def save_histogram(self, music_service, track_id, histogram, analysis=None, encoding=histogram_encoding):
+        """
+        Save histogram of track, replacing previously saved one
+        :param analysis: parameters of analysis which produced histogram, None to keep previously saved
+        """
+        rowid = self.get_track_rowid(music_service, track_id, create=True)
+        if analysis is not None:
+            self.db.execute("UPDATE tracks SET analysis = ? WHERE id = ?", (json.dumps(analysis), rowid))
+        self.db.execute("DELETE FROM bins WHERE track = ?", (rowid,))
+        if encoding == "bins":
+            self.db.execute("UPDATE tracks SET histogram = NULL WHERE id = ?", (rowid,))
+            self.db.executemany("INSERT INTO bins (track, bpm, share) VALUES (?, ?, ?)",
+                                [(rowid, float(bpm), float(share)) for bpm, share in histogram.items()])
+        else:
+            self.db.execute("UPDATE tracks SET histogram = ? WHERE id = ?", (encode_histogram(histogram, encoding), rowid))
+        self.written()
+
+    def insert_histograms(self, music_service, histograms, encoding=histogram_encoding):
+        """
+        Insert histograms of tracks which are not in cache yet, much faster than save_histogram() for many tracks
+        :param histograms: list of (track_id, histogram)
+        """
+        if encoding == "bins":
+            for track_id, histogram in histograms:
+                rowid = self.db.execute("INSERT INTO tracks (provider, track_id) VALUES (?, ?)",
+                                        (music_service, track_id)).lastrowid
+                self.db.executemany("INSERT INTO bins (track, bpm, share) VALUES (?, ?, ?)",
+                                    [(rowid, float(bpm), float(share)) for bpm, share in histogram.items()])
+        else:
+            self.db.executemany("INSERT INTO tracks (provider, track_id, histogram) VALUES (?, ?, ?)",
+                                [(music_service, track_id, encode_histogram(histogram, encoding))
+                                 for track_id, histogram in histograms])
+        self.written()
+
+    def save_audio_hash(self, music_service, track_id, audio_hash, seconds):
+        """Remember that histogram of track was calculated from audio with given digest in given seconds"""
+        rowid = self.get_track_rowid(music_service, track_id, create=True)
+        # digest of audio analyzed for track before (e.g. before its file was changed) is stale
+        self.db.execute("DELETE FROM audio_hashes WHERE track = ?", (rowid,))
+        self.db.execute("INSERT OR REPLACE INTO audio_hashes (hash, track, seconds) VALUES (?, ?, ?)",
+                        (audio_hash, rowid, seconds))
+        self.written()
+
+    def audio_hashes(self):
+        """Return list of (audio hash, provider, track_id, seconds of analysis) of all tracks, see save_audio_hash()"""
+        return self.db.execute("SELECT a.hash, t.provider, t.track_id, a.seconds FROM audio_hashes a"
+                               " JOIN tracks t ON t.id = a.track").fetchall()
+
+    def providers(self):
+        """Return list of music services having tracks in cache"""
+        return [row[0] for row in self.db.execute("SELECT DISTINCT provider FROM tracks")]
+
+    def track_ids(self, music_service):
+        """Iterate over ids of all cached tracks of music service"""
+        for row in self.db.execute("SELECT track_id FROM tracks WHERE provider = ?", (music_service,)):
+            yield row[0]
+
+    def count_tracks(self, music_service):
+        """Return count of cached tracks of music service"""
+        return self.db.execute("SELECT COUNT(*) FROM tracks WHERE provider = ?", (music_service,)).fetchone()[0]
+
+    def track_analyses(self, music_service):
+        """Iterate over (track_id, analysis) of all cached tracks of music service, see get_analysis()"""
+        for row in self.db.execute("SELECT track_id, analysis FROM tracks WHERE provider = ?", (music_service,)):
+            yield row[0], json.loads(row[1]) if row[1] else {}
+
+    def histograms(self, music_service):
+        """Iterate over (track_id, histogram) of all cached tracks of music service"""
+        for row in self.db.execute("SELECT track_id, histogram FROM tracks"
+                                   " WHERE provider = ? AND histogram IS NOT NULL", (music_service,)):
+            yield row[0], decode_histogram(row[1])
+        track_id = None
+        histogram = None
+        for row in self.db.execute("SELECT t.track_id, b.bpm, b.share FROM tracks t JOIN bins b ON b.track = t.id"
+                                   " WHERE t.provider = ? ORDER BY t.id", (music_service,)):
+            if row[0] != track_id:
+                if track_id is not None:
+                    yield track_id, histogram
+                track_id = row[0]
+                histogram = {}
+            histogram[row[1]] = row[2]
+        if track_id is not None:
+            yield track_id, histogram
+
+    def tracks_after(self, rowid, limit):
+        """Return list of (rowid, provider, track_id) of up to limit tracks with rowid greater than given, ordered by rowid"""
+        return self.db.execute("SELECT id, provider, track_id FROM tracks WHERE id > ? ORDER BY id LIMIT ?",
+                               (rowid, limit)).fetchall()
+
+    def track_rowids(self, music_service):
+        """Return list of (rowid, track_id) of all cached tracks of music service"""
+        return self.db.execute("SELECT id, track_id FROM tracks WHERE provider = ?", (music_service,)).fetchall()
+
+    def histogram_blobs(self, music_service):
+        """Return list of (track rowid, encoded histogram) of all cached tracks of music service having encoded histogram"""
+        return self.db.execute("SELECT id, histogram FROM tracks WHERE provider = ? AND histogram IS NOT NULL",
+                               (music_service,)).fetchall()
+
+    def histogram_bins(self, music_service):
+        """Return list of (track rowid, bpm, share) of all bins of all cached tracks of music service stored as bins"""
+        return self.db.execute("SELECT b.track, b.bpm, b.share FROM bins b JOIN tracks t ON t.id = b.track"
+                               " WHERE t.provider = ?", (music_service,)).fetchall()
+
+    def find_tracks(self, music_service, good_bpm, min_share):
+        """
+        Find tracks having sum of shares of "good" bpms >= min_share, using index on bpm
+        Only tracks having histogram stored as bins are searched (see histogram_encoding)
+        :param good_bpm: {"min": bpm_min, "max": bpm_max, "mult": [multiplier1, m2, ...]}
+        :return: list of track ids
+        """
+        ranges = " OR ".join(["b.bpm BETWEEN ? AND ?"] * len(good_bpm["mult"]))
+        params = [music_service]
+        for mult in good_bpm["mult"]:
+            params += [mult * good_bpm["min"], mult * good_bpm["max"]]
+        params.append(min_share)
+        return [row[0] for row in self.db.execute(
+            f"SELECT t.track_id FROM bins b JOIN tracks t ON t.id = b.track"
+            f" WHERE t.provider = ? AND ({ranges})"
+            f" GROUP BY b.track HAVING SUM(b.share) >= ? ORDER BY b.track", params)]
+
+    def get_track_playlists(self, music_service, track_id):
+        """Return set of ids of playlists where track is known to be"""
+        return set(row[0] for row in self.db.execute(
+            "SELECT p.playlist_id FROM playlist_tracks p JOIN tracks t ON t.id = p.track"
+            " WHERE t.provider = ? AND t.track_id = ?", (music_service, track_id)))
+
+    def add_track_playlist(self, music_service, track_id, playlist_id):
+        rowid = self.get_track_rowid(music_service, track_id, create=True)
+        self.db.execute("INSERT OR IGNORE INTO playlist_tracks (playlist_id, track) VALUES (?, ?)",
+                        (str(playlist_id), rowid))
+        self.written()
+
+    def __len__(self):
+        """Count of track records"""
+        return self.db.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+
+    def written(self):
+        self.uncommitted += 1
+        self.maybe_commit()
+
+    def maybe_commit(self):
+        """Commit if enough writes are pending or enough time passed since last commit"""
+        if self.uncommitted and (self.uncommitted >= self.commit_every
+                                 or time.monotonic() - self.last_commit >= self.commit_interval):
+            self.commit()
+
+    def commit(self):
+        if self.db is not None:
+            with tracer.span("commit", cat="db", writes=self.uncommitted):
+                self.db.commit()
+            debug(f"{self.whoami()}: committed {self.uncommitted} writes to {self.filename}")
+        self.uncommitted = 0
+        self.last_commit = time.monotonic()
+
+    def close(self):
+        if self.db is None:
+            return
+        self.commit()
+        self.db.close()
+        self.db = None
+        atexit.unregister(self.close)
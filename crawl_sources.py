@@ -0,0 +1,272 @@
+import json
+import atexit
+
+from logging import debug, info, warning, error
+
+from exceptions import *
+from whoami import *
+from config import *
+from checkpoint import *
+from music_api import music_service_mapping
+
+
+class CrawlSource(WhoamiObject):
+    """
+    Source of tracks to crawl: playlist, artist or station of music service, read track by track by get_next_track().
+    Position in playlist or artist is kept by CrawlCheckpoint, station keeps it by provider (e.g. StationSession),
+    tracks are saved as seen when they are done.
+    In sources file of bpmcrawld daemon source is described by dict, e.g.
+        {"service": "yandexmusic", "playlist": "LIKED", "interval": 3600, "priority": 2, "limit": 0}
+    with one of keys playlist (name, id or url; LIKED and PLOD for yandexmusic), artist (id)
+    or station (url, IFL for gmusic). Service must be one of music_service_mapping.
+    """
+    kinds = ("playlist", "artist", "station")
+
+    def __init__(self, music_service, kind, source_id, interval=crawl_source_interval,
+                 priority=crawl_source_priority, limit=0):
+        if kind not in self.kinds:
+            raise ExBpmCrawlGeneric(f"Unknown kind of crawl source: '{kind}'")
+        if priority <= 0:
+            raise ExBpmCrawlGeneric(f"Priority of crawl source must be positive, got {priority}")
+        self.music_service = music_service
+        self.kind = kind
+        self.source_id = source_id
+        self.interval = interval
+        self.priority = priority
+        self.limit = limit  # max tracks per crawl, 0 for no limit
+        self.api = None
+        self.known = None  # KnownTracks of music service
+        self.checkpoint = None
+        self.total = None  # count of tracks to crawl, if known
+        self.fetched = 0
+        self.unfinished = 0  # fetched tracks not done yet
+        self.exhausted = False  # source is crawled to the end
+        self.tracks = None  # tracks of playlist
+        self.position = 0  # index of next track in playlist
+        self.artist = None
+        self.next_run = 0  # time.monotonic() when crawl is due (for daemon)
+        self.stride = 0  # pass of stride scheduling (for daemon)
+
+    def __str__(self):
+        return f"{self.music_service}:{self.kind}:{self.source_id}"
+
+    @classmethod
+    def from_config(cls, config):
+        """Create source by dict from sources file"""
+        kinds = [kind for kind in cls.kinds if kind in config]
+        if "service" not in config or len(kinds) != 1:
+            raise ExBpmCrawlGeneric(f"Crawl source must have service and one of {', '.join(cls.kinds)}: {config}")
+        if config["service"] not in music_service_mapping:
+            raise ExBpmCrawlGeneric(f"Unknown music service provider '{config['service']}' of crawl source {config},"
+                                    f" known ones are: {', '.join(music_service_mapping)}")
+        return cls(config["service"], kinds[0], str(config[kinds[0]]),
+                   interval=config.get("interval", crawl_source_interval),
+                   priority=config.get("priority", crawl_source_priority), limit=config.get("limit", 0))
+
+    def open(self, api, known, db_file=tracks_histogram_db, resume=False, checkpoint_every=crawl_checkpoint_every):
+        """
+        Start crawl of source: load tracks of playlist, init artist pager or prepare station
+        :param api: logged in music provider
+        :param known: KnownTracks of music service
+        :param db_file: database of histograms, checkpoints of other databases are not resumed
+        :param resume: start from checkpoint of the last crawl, if it was not finished
+        """
+        self.api = api
+        self.known = known
+        self.checkpoint = None
+        self.total = None
+        self.fetched = 0
+        self.unfinished = 0
+        self.exhausted = False
+        saved = None
+        if self.kind == 'playlist':
+            playlist = api.get_playlist(self.source_id)
+            self.tracks = api.get_playlist_tracks(playlist) if playlist is not None else None
+            if self.tracks is None:
+                raise ExBpmCrawlPlaylistNotExists(f"Playlist not found: {self.source_id}")
+            self.position = 0
+            self.checkpoint = CrawlCheckpoint(self.music_service, self.kind, self.source_id, db_file, checkpoint_every)
+            self.checkpoint.snapshot = api.get_playlist_snapshot(playlist)
+            saved = self.checkpoint.load() if resume else None
+            if saved:
+                if saved["snapshot"] and saved["snapshot"] == self.checkpoint.snapshot:
+                    self.position = min(saved["cursor"]["index"], len(self.tracks))
+                else:
+                    self.position = self.get_playlist_resume_index(saved)
+            self.total = len(self.tracks) - self.position
+            info(f"Now crawling on playlist {self.source_id} ({len(self.tracks)} tracks"
+                 + (f", resuming from track {self.position})" if saved else ")"))
+        elif self.kind == 'artist':
+            self.artist = api.get_artist(self.source_id)
+            if not self.artist:
+                raise ExBpmCrawlGeneric(f"Failed to find artist with id {self.source_id}")
+            self.checkpoint = CrawlCheckpoint(self.music_service, self.kind, self.source_id, db_file, checkpoint_every)
+            saved = self.checkpoint.load() if resume else None
+            if saved:
+                info(f"Resuming artist {self.source_id} from page {saved['cursor']['page']},"
+                     f" track {saved['cursor']['idx']}")
+                api.artist_pager_init(self.artist, saved['cursor']['page'], saved['cursor']['idx'])
+            else:
+                api.artist_pager_init(self.artist)
+        else:
+            # this is what was for google music, there were "stations"
+            station = api.get_station_from_url(self.source_id)
+            api.station_prepare(station)
+            info(f"Now crawling on station {api.get_station_name(station)}")
+        if self.limit:
+            self.total = min(self.total or self.limit, self.limit)
+        # position is saved on exit whatever the reason is, checkpoint is removed when source is crawled to the end
+        atexit.register(self.close)
+
+    def get_playlist_cursor(self, index):
+        return {"index": index,
+                "track_id": self.api.get_track_id(self.tracks[index]) if index < len(self.tracks) else None}
+
+    def get_playlist_resume_index(self, saved):
+        """:return: index of track in playlist to resume crawl from by saved checkpoint"""
+        index, track_id = saved["cursor"]["index"], saved["cursor"]["track_id"]
+        if track_id is None:
+            # all tracks were fetched, only ones added to the end since then are left
+            return min(index, len(self.tracks))
+        if index < len(self.tracks) and self.api.get_track_id(self.tracks[index]) == track_id:
+            return index
+        # playlist was changed, track is searched by id
+        for index, track in enumerate(self.tracks):
+            if self.api.get_track_id(track) == track_id:
+                info(f"playlist was changed since checkpoint, resuming from track {track_id} at position {index}")
+                return index
+        warning(f"track {track_id} of checkpoint is not in playlist anymore, starting from the beginning")
+        return 0
+
+    def get_next_track(self):
+        """:return: next track, None if source is crawled to the end or limit of tracks is reached"""
+        if self.limit and self.fetched >= self.limit:
+            return None
+        cursor = next_cursor = None
+        if self.kind == 'playlist':
+            if self.position < len(self.tracks):
+                track = self.tracks[self.position]
+                cursor = self.get_playlist_cursor(self.position)
+                self.position += 1
+                next_cursor = self.get_playlist_cursor(self.position)
+            else:
+                track = None
+        elif self.kind == 'artist':
+            page, idx = self.api.artist_pager_get_position(self.artist)
+            cursor = {"page": page, "idx": idx}
+            track = self.api.artist_pager_get_next_track(self.artist)
+            page, idx = self.api.artist_pager_get_position(self.artist)
+            next_cursor = {"page": page, "idx": idx}
+        else:
+            track = self.api.station_get_next_track()
+        if not track:
+            self.exhausted = True
+            return None
+        self.fetched += 1
+        self.unfinished += 1
+        if self.checkpoint:
+            self.checkpoint.fetched(self.api.get_track_id(track), cursor, next_cursor)
+        return track
+
+    def done(self, track_id):
+        """Track got from this source is finished (found in cache, analyzed or failed)"""
+        self.unfinished -= 1
+        if self.checkpoint:
+            self.checkpoint.done(track_id)
+        elif self.kind == 'station':
+            self.api.station_mark_track_done(track_id)
+
+    def maybe_save(self):
+        """Save checkpoint if it's time to; must be called when results of done tracks are committed"""
+        if self.checkpoint:
+            self.checkpoint.maybe_save()
+        elif self.kind == 'station' and self.api:
+            self.api.station_save_session()
+
+    def close(self):
+        """Stop crawl: checkpoint is removed if source was crawled to the end, saved otherwise"""
+        if self.kind == 'artist' and self.api and self.artist:
+            self.api.artist_pager_close(self.artist)
+        if self.checkpoint:
+            if self.exhausted and not self.unfinished:
+                self.checkpoint.finish()
+            else:
+                self.checkpoint.save()
+            self.checkpoint = None
+        elif self.kind == 'station' and self.api:
+            self.api.station_save_session()
+        atexit.unregister(self.close)
+
+
+class CrawlScheduler(WhoamiObject):
+    """
+    Schedule of sources crawled by bpmcrawld daemon.
+    Source is due `interval` seconds after the start of its previous crawl (at once after start of daemon);
+    up to max_active sources are crawled at once, due sources with higher priority are started first.
+    Only one station of music service is crawled at a time, as provider plays one station at a time.
+    Tracks are taken from active sources by stride scheduling: source with priority 2 gives twice as many
+    tracks as source with priority 1. Source which is crawled to the end is draining until all its tracks are done.
+    """
+    def __init__(self, sources, max_active=crawl_active_sources):
+        self.sources = sources
+        self.max_active = max_active
+        self.active = []
+        self.draining = []
+
+    def start_due(self, now):
+        """:return: sources which crawl is to be started now, they are active since then"""
+        started = []
+        due = [x for x in self.sources if x.next_run <= now and x not in self.active and x not in self.draining]
+        for source in sorted(due, key=lambda x: -x.priority):
+            if len(self.active) >= self.max_active:
+                break
+            if source.kind == 'station' and any(x.kind == 'station' and x.music_service == source.music_service
+                                                for x in self.active):
+                continue
+            source.next_run = now + source.interval
+            # new source doesn't get all tracks until it catches up with sources that are crawled for long
+            source.stride = min((x.stride for x in self.active), default=0)
+            self.active.append(source)
+            started.append(source)
+        return started
+
+    def next_source(self):
+        """:return: active source to take next track from, None if there are no active sources"""
+        if not self.active:
+            return None
+        source = min(self.active, key=lambda x: x.stride)
+        source.stride += 1 / source.priority
+        return source
+
+    def finish(self, source):
+        """Source is crawled to the end (or failed): no more tracks are taken from it"""
+        self.active.remove(source)
+        self.draining.append(source)
+
+    def get_drained(self):
+        """:return: finished sources which tracks are all done, they are not tracked by scheduler anymore"""
+        drained = [x for x in self.draining if not x.unfinished]
+        self.draining = [x for x in self.draining if x.unfinished]
+        return drained
+
+    def get_wait(self, now):
+        """:return: seconds until the next source is due"""
+        waiting = [x.next_run for x in self.sources if x not in self.active and x not in self.draining]
+        return max(min(waiting, default=now + crawl_source_interval) - now, 0)
+
+
+def load_crawl_sources(filename):
+    """
+    Load sources of bpmcrawld daemon from json file: list of dicts described in CrawlSource
+    :return: list of CrawlSource
+    """
+    try:
+        with open(filename) as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ExBpmCrawlGeneric(f"Failed to load crawl sources from {filename}: {e}")
+    if not isinstance(config, list):
+        raise ExBpmCrawlGeneric(f"Crawl sources file {filename} must contain list of sources")
+    sources = [CrawlSource.from_config(x) for x in config]
+    info(f"Loaded {len(sources)} crawl sources from {filename}")
+    return sources
@@ -2,10 +2,12 @@
 
 import json
 import shutil
+import argparse
+import hashlib
+import sqlite3
 
-from sqlitedict import SqliteDict
+import sqlitedict
 
-import atexit
 import logging
 from logging import debug, info, warning, error
 
@@ -13,81 +15,243 @@ from exceptions import *
 from whoami import *
 from config import *
 
+# records are migrated by batches, each batch is one transaction together with checkpoint
+migration_batch_size = 5000
+migration_checkpoint_recordid = "bpmcrawl_migration_checkpoint"
 
-def get_cached_track(track_id):
-    with SqliteDict(tracks_histogram_db, autocommit=True) as cache:
+
+def record_checksum(provider, trackid, histogram):
+    """
+    Checksum of track record; sum of checksums of all records does not depend on order of records.
+    bpm and share are rounded to precision of histogram_codec, so it does not depend on encoding too.
+    """
+    bins = sorted((round(float(bpm) * histogram_bpm_scale), round(float(share) * histogram_share_scale))
+                  for bpm, share in histogram.items() if round(float(share) * histogram_share_scale))
+    digest = hashlib.blake2b(json.dumps([provider, trackid, bins]).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class Migration(WhoamiObject):
+    """
+    Migration of cache database to current version, made into new file by batches.
+    After every batch checkpoint (cursor in source, count and checksum of migrated records) is saved
+    to new file in the same transaction, so interrupted migration continues from where it stopped.
+    Child classes implement prepare() and migrate_batch().
+    """
+    from_versions = ()
+
+    def __init__(self, filename, db_version, batch_size=migration_batch_size):
+        self.filename = filename
+        self.new_filename = filename + ".new"
+        self.db_version = db_version
+        self.batch_size = batch_size
+        self.new_cache = None
+        self.checkpoint = None
+
+    def open_new_cache(self):
+        # commits are done by save_checkpoint() only, so batch and its checkpoint are in one transaction
+        return HistogramStore(self.new_filename, commit_every=sys.maxsize, commit_interval=float("inf"))
+
+    def prepare(self):
+        """Create new file and open it as self.new_cache"""
+        raise ExBpmCrawlGeneric(f"Internal error: Method {self.whoami()} is not implemented")
+
+    def migrate_batch(self):
+        """
+        Migrate next batch of records, advancing self.checkpoint
+        :return: count of source records read, 0 when all records are migrated
+        """
+        raise ExBpmCrawlGeneric(f"Internal error: Method {self.whoami()} is not implemented")
+
+    def load_checkpoint(self):
+        if not os.path.exists(self.new_filename):
+            return None
         try:
-            cached = json.loads(cache[track_id])
-        except KeyError:
+            cache = self.open_new_cache()
+            checkpoint = json.loads(cache.get_meta(migration_checkpoint_recordid) or "null")
+        except sqlite3.DatabaseError:
+            debug(f"{self.whoami()}: can't read checkpoint from {self.new_filename}", exc_info=True)
+            return None
+        if not checkpoint or checkpoint["from"] != self.db_version or checkpoint["to"] != cache_db_version:
+            cache.close()
             return None
+        self.new_cache = cache
+        return checkpoint
+
+    def save_checkpoint(self):
+        self.new_cache.set_meta(migration_checkpoint_recordid, json.dumps(self.checkpoint))
+        self.new_cache.commit()
+
+    def add_checksum(self, provider, trackid, histogram):
+        self.checkpoint["count"] += 1
+        self.checkpoint["checksum"] = (self.checkpoint["checksum"] + record_checksum(provider, trackid, histogram)) % 2**64
+
+    def run(self):
+        self.checkpoint = self.load_checkpoint()
+        if self.checkpoint:
+            info(f"resuming migration from checkpoint: {self.checkpoint['count']} records already migrated")
+        else:
+            if os.path.exists(self.new_filename):
+                os.unlink(self.new_filename)
+            self.checkpoint = {"from": self.db_version, "to": cache_db_version, "cursor": 0, "count": 0, "checksum": 0}
+            self.prepare()
+            self.save_checkpoint()
+        started = time.monotonic()
+        started_count = self.checkpoint["count"]
+        while self.migrate_batch():
+            self.save_checkpoint()
+            rate = (self.checkpoint["count"] - started_count) / max(time.monotonic() - started, 0.001)
+            info(f"migrated {self.checkpoint['count']} records ({rate:.0f} records/s)")
+        self.verify()
+        self.new_cache.set_meta(migration_checkpoint_recordid, None)
+        self.new_cache.close()
+        info(f"replacing file {self.filename} with new version, preserving old to {self.filename+'.bak'}")
+        shutil.move(self.filename, self.filename+".bak")
+        shutil.move(self.new_filename, self.filename)
+
+    def verify(self):
+        """Compare count and checksum of records in new file with ones counted while migrating"""
+        count = 0
+        checksum = 0
+        for provider in self.new_cache.providers():
+            for trackid, histogram in self.new_cache.histograms(provider):
+                count += 1
+                checksum = (checksum + record_checksum(provider, trackid, histogram)) % 2**64
+        if count != self.checkpoint["count"] or checksum != self.checkpoint["checksum"]:
+            raise ExBpmCrawlGeneric(
+                f"Migration check failed: migrated {self.checkpoint['count']} records with checksum {self.checkpoint['checksum']:016x},"
+                f" but {self.new_filename} has {count} records with checksum {checksum:016x}")
+        info(f"verified {count} records, checksum {checksum:016x}")
+
+
+class MigrationFromKeyValue(Migration):
+    """
+    Migrate from key-value (sqlitedict) versions 1-3 to relational version
+    histogram is encoded according to histogram_encoding, in_playlists goes to rows of playlist_tracks table
+    """
+    from_versions = (None, "2", "3")
+
+    def prepare(self):
+        self.new_cache = self.open_new_cache()  # this will create empty database
+
+    def read_records(self, after_rowid):
+        """
+        Read batch of records from old database, in order of rowid
+        :return: list of (rowid, provider, track_id, record), record is {"histogram": {...}, "in_playlists": [...]}
+                 provider is None for db version record
+        """
+        conn = sqlite3.connect(self.filename)
         try:
-            return cached["histogram"]
-        except KeyError:
-            error(f"{whoami()}: internal error loading data from cache for track {track_id}")
-            sys.exit(1)
+            rows = conn.execute('SELECT rowid, key, value FROM unnamed WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                                (after_rowid, self.batch_size)).fetchall()
+        finally:
+            conn.close()
+        records = []
+        for rowid, cacheid, value in rows:
+            if self.db_version is None:
+                # version 1: 'some_id': data, pickled
+                records.append((rowid, "gmusic", cacheid, {"histogram": sqlitedict.decode(value)}))
+            elif cacheid == cache_db_version_recordid:
+                records.append((rowid, None, None, None))
+            elif self.db_version == "2":
+                # version 2: 'some_id': { 'histogram': data }
+                # and only provider known for version 2 is gmusic
+                records.append((rowid, "gmusic", cacheid, json.loads(value)))
+            else:
+                # version 3: 'provider:some_id': { 'histogram': data, 'in_playlists': [...] }
+                records.append((rowid, get_track_provider_from_cache_id(cacheid), get_track_id_from_cache_id(cacheid),
+                                json.loads(value)))
+        return records
+
+    def migrate_batch(self):
+        records = self.read_records(self.checkpoint["cursor"])
+        for rowid, provider, trackid, record in records:
+            self.checkpoint["cursor"] = rowid
+            if provider is None:
+                continue
+            self.new_cache.save_histogram(provider, trackid, record["histogram"])
+            for playlist_id in record.get("in_playlists", []):
+                self.new_cache.add_track_playlist(provider, trackid, playlist_id)
+            self.add_checksum(provider, trackid, record["histogram"])
+        return len(records)
+
 
+class MigrationReencode(Migration):
+    """
+    Migrate from relational versions (4 and later) to current one, or just reencode histograms of current version
+    it adds columns which appeared in tracks table and tables which appeared since db version
+    (see tracks_added_columns and added_tables), and stores all histograms with current histogram_encoding
+    """
+    from_versions = ("4", "5", "6", "7")
+    # db version, column definition
+    tracks_added_columns = [
+        ("5", "histogram BLOB"),  # binary encoded histogram
+        ("6", "analysis TEXT"),  # parameters of analysis
+    ]
+    # db version, schema of tables
+    added_tables = [
+        ("7", cache_db_schema_audio_hashes),  # digests of analyzed audio
+    ]
 
-def save_cached_track(track_id, histogram):
-    """warning: for now, it will override all data saved for this track"""
-    with SqliteDict(tracks_histogram_db, autocommit=True) as cache:
-        cache[track_id] = json.dumps({"histogram": histogram})
+    def prepare(self):
+        shutil.copy(self.filename, self.new_filename)
+        self.new_cache = self.open_new_cache()
+        for version, column in self.tracks_added_columns:
+            if int(self.db_version) < int(version):
+                self.new_cache.db.execute(f"ALTER TABLE tracks ADD COLUMN {column}")
+        for version, schema in self.added_tables:
+            if int(self.db_version) < int(version):
+                self.new_cache.db.executescript(schema)
+        self.new_cache.set_version(cache_db_version)
+
+    def migrate_batch(self):
+        tracks = self.new_cache.tracks_after(self.checkpoint["cursor"], self.batch_size)
+        for rowid, provider, trackid in tracks:
+            histogram = self.new_cache.get_histogram(provider, trackid)
+            self.new_cache.save_histogram(provider, trackid, histogram)
+            self.add_checksum(provider, trackid, histogram)
+            self.checkpoint["cursor"] = rowid
+        return len(tracks)
+
+    def run(self):
+        super().run()
+        info(f"histograms are encoded as '{histogram_encoding}', compacting database")
+        conn = sqlite3.connect(self.filename)
+        conn.execute("VACUUM")
+        conn.close()
+
+
+migrations = [MigrationFromKeyValue, MigrationReencode]
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     logging.getLogger("sqlitedict").setLevel(logging.ERROR)
 
+    parser = argparse.ArgumentParser(
+        description=f'Convert cache database ({tracks_histogram_db}) to current version ({cache_db_version}).'
+                    f' If interrupted, next run will continue from where it stopped.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-e', '--reencode', default=False, action='store_true',
+                        help=f'Also store histograms of all tracks with current encoding ({histogram_encoding})')
+    parser.add_argument('-b', '--batch-size', default=migration_batch_size, type=int,
+                        help=f'Records per transaction')
+    args = parser.parse_args()
+
     os.makedirs(temp_dir, exist_ok=True)
     os.makedirs(os.path.dirname(tracks_histogram_db), exist_ok=True)
 
     db_version = get_cache_version()
-    if db_version == cache_db_version:
+    if db_version == cache_db_version and not args.reencode:
         info(f"db version is already current ({db_version})")
         sys.exit(0)
 
-    new_db = tracks_histogram_db + ".new"
-    def rm_tmp():
-        if os.path.exists(new_db):
-            os.unlink(new_db)
-    atexit.register(rm_tmp)
-
-    if (db_version == None) and (cache_db_version == "2"):
-        # migrate from v1 to v2
-        # it changes format to json, and moves cached data to "histogram" key of stored dict
-        rm_tmp()
-        get_cache_version(new_db)  # this will create empty database
-        with SqliteDict(tracks_histogram_db, autocommit=True) as old_cache:
-            with SqliteDict(new_db, autocommit=True, encode=json.dumps, decode=json.loads) as new_cache:
-                for trackid in old_cache:
-                    new_cache[trackid] = {"histogram": old_cache[trackid]}
-                if len(old_cache)+1 != len(new_cache):
-                    error(f"{whoami()}: internal error: len(old_cache)+1 ({len(old_cache)+1}) != len(new_cache) ({len(new_cache)})")
-                    sys.exit(1)
-                info(f"migrated {len(new_cache)-1} records")
-        info(f"replacing file {tracks_histogram_db} with new version, preserving old to {tracks_histogram_db+'.bak'}")
-        shutil.move(tracks_histogram_db, tracks_histogram_db+".bak")
-        shutil.move(new_db, tracks_histogram_db)
-    elif (db_version == "2") and (cache_db_version == "3"):
-        # migrate from v2 to v3
-        # it adds music service provider name to cache_id
-        #   was: 'some_id': { 'histogram': data }
-        #   now: 'provider:some_id': { 'histogram': data }
-        #   and only provider known for version 2 is gmusic, so it will be 'gmusic:some_id'
-        rm_tmp()
-        get_cache_version(new_db)  # this will create empty database
-        with SqliteDict(tracks_histogram_db, autocommit=True, encode=json.dumps, decode=json.loads) as old_cache:
-            with SqliteDict(new_db, autocommit=True, encode=json.dumps, decode=json.loads) as new_cache:
-                for trackid in old_cache:
-                    if trackid != cache_db_version_recordid:
-                        # db version record already was added when db was created
-                        new_cache["gmusic:"+trackid] = old_cache[trackid]
-                if len(old_cache) != len(new_cache):
-                    error(f"{whoami()}: internal error: len(old_cache)+1 ({len(old_cache)+1}) != len(new_cache) ({len(new_cache)})")
-                    sys.exit(1)
-                info(f"migrated {len(new_cache)-1} records")
-        info(f"replacing file {tracks_histogram_db} with new version, preserving old to {tracks_histogram_db+'.bak'}")
-        shutil.move(tracks_histogram_db, tracks_histogram_db+".bak")
-        shutil.move(new_db, tracks_histogram_db)
-    else:
+    migration = next((x for x in migrations if db_version in x.from_versions), None)
+    if not migration:
         error(f"don't know to migrate db from version {db_version} to {cache_db_version}")
         sys.exit(1)
+    try:
+        migration(tracks_histogram_db, db_version, args.batch_size).run()
+    except ExBpmCrawlGeneric as e:
+        error(str(e))
+        sys.exit(1)
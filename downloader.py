@@ -0,0 +1,118 @@
+import time
+import tempfile
+import threading
+import urllib.parse
+
+import requests
+import requests.adapters
+
+from logging import debug, info, warning, error
+
+from exceptions import *
+from whoami import *
+from config import *
+
+
+class BandwidthLimiter:
+    """
+    Token bucket of bytes per second, shared by all downloads from one host.
+    Burst is one second of traffic; taking more than is available makes debt, which is waited out by taker.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, nbytes):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.rate) - nbytes
+            self.updated = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class Downloader(WhoamiObject):
+    """
+    Downloads of tracks for all providers and threads of process: one requests session, so connections
+    to hosts are kept alive and reused (no TCP and TLS handshake per track), at most `concurrency` downloads at a time
+    (other callers wait), and optional bandwidth limit per host.
+    Files are written by big chunks through big buffer.
+    """
+    def __init__(self, concurrency=download_concurrency, host_bandwidth=download_host_bandwidth,
+                 chunk_size=download_chunk_size, buffer_size=download_buffer_size):
+        self.session = None
+        self.lock = threading.Lock()
+        self.limiters = {}
+        self.configure(concurrency, host_bandwidth, chunk_size, buffer_size)
+
+    def configure(self, concurrency=None, host_bandwidth=None, chunk_size=None, buffer_size=None):
+        """Change parameters of downloader, None keeps current value; must be called before downloads start"""
+        if concurrency is not None:
+            self.concurrency = concurrency
+        if host_bandwidth is not None:
+            self.host_bandwidth = host_bandwidth
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+        if buffer_size is not None:
+            self.buffer_size = buffer_size
+        self.slots = threading.BoundedSemaphore(self.concurrency)
+        self.limiters = {}
+        if self.session:
+            self.session.close()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.concurrency, pool_maxsize=self.concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get_limiter(self, url):
+        if not self.host_bandwidth:
+            return None
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            if host not in self.limiters:
+                self.limiters[host] = BandwidthLimiter(self.host_bandwidth)
+            return self.limiters[host]
+
+    def get_size(self, url):
+        """:return: size of file at url by HEAD request, 0 if unknown"""
+        r = self.session.head(url, allow_redirects=True)
+        if not r.ok:
+            # Content-Length of error page is not size of file
+            debug(f"{self.whoami()}: HEAD {url} failed with HTTP {r.status_code}, size is unknown")
+            return 0
+        return int(r.headers.get('Content-Length', 0))
+
+    def download(self, url, headers=None, suffix='.mp3'):
+        """
+        Download url to temp file
+        :param headers: headers of request, e.g. Range
+        :return: tempfile object (deleted upon close), its attribute partial is True if server returned only
+                 requested range
+        """
+        limiter = self.get_limiter(url)
+        file = tempfile.NamedTemporaryFile(mode='w+b', dir=temp_dir, prefix='track', suffix=suffix,
+                                           buffering=self.buffer_size)
+        try:
+            with self.slots:
+                with self.session.get(url, stream=True, headers=headers) as r:
+                    r.raise_for_status()
+                    file.partial = r.status_code == 206
+                    for chunk in r.iter_content(chunk_size=self.chunk_size):
+                        if limiter:
+                            limiter.take(len(chunk))
+                        file.write(chunk)
+            file.flush()
+        except BaseException:
+            file.close()
+            raise
+        return file
+
+    def close(self):
+        self.session.close()
+
+
+# downloader of this process
+downloader = Downloader()
@@ -3,3 +3,6 @@ class ExBpmCrawlGeneric(Exception):
 
 class ExBpmCrawlPlaylistNotExists(ExBpmCrawlGeneric):
     pass
+
+class ExBpmCrawlServiceUnavailable(ExBpmCrawlGeneric):
+    pass
@@ -14,6 +14,7 @@ import tempfile
 import requests
 import json
 import re
+import concurrent.futures
 
 import taglib
 from gmusicapi.clients import Mobileclient
@@ -34,12 +35,15 @@ results_max = 5
 
 playlist_name = "bpmcrawl-imported"
 cache_db = "data/map-local-gm.db"
-md5_cache_db = "data/map-local-gm-md5sums.db"
+fingerprint_cache_db = "data/map-local-gm-fingerprints.db"
+# threads calculating md5 and reading tags of files not in fingerprint cache
+fingerprint_workers = 8
+fingerprint_commit_every = 100
 
 if not cache_db.startswith(os.sep):
     cache_db = os.path.abspath(os.path.dirname(__file__)) + os.sep + cache_db
-if not md5_cache_db.startswith(os.sep):
-    md5_cache_db = os.path.abspath(os.path.dirname(__file__)) + os.sep + md5_cache_db
+if not fingerprint_cache_db.startswith(os.sep):
+    fingerprint_cache_db = os.path.abspath(os.path.dirname(__file__)) + os.sep + fingerprint_cache_db
 
 api = None
 
@@ -51,17 +55,73 @@ def md5(fname):
     return hash_md5.hexdigest()
 
 
-def cache_get(db, key):
-    with SqliteDict(db, autocommit=True) as cache:
-        try:
-            return json.loads(cache[key])
-        except KeyError:
-            return None
-
-
-def cache_save(db, key, value):
-    with SqliteDict(db, autocommit=True) as cache:
-        cache[key] = json.dumps(value)
+def read_tags(filename):
+    """:return: { 'ALBUM': ..., 'ARTIST': ..., 'TITLE': ... } with found tags only"""
+    tags_read = taglib.File(filename).tags
+    debug(f"read tags of {filename}: {tags_read}")
+    tags = {}
+    for field in ['ALBUM', 'ARTIST', 'TITLE']:
+        if field in tags_read and len(tags_read[field]):
+            tags[field] = tags_read[field][0]
+            try:
+                tags[field] = tags[field].encode('windows-1252').decode('windows-1251')
+            except UnicodeEncodeError:
+                pass
+    return tags
+
+
+def fingerprint(filename):
+    return {"md5": md5(filename), "tags": read_tags(filename)}
+
+
+def stat_key(filename):
+    """Key of file in fingerprint cache: file with the same device, inode, size and mtime is considered unchanged"""
+    st = os.stat(filename)
+    return f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+
+def fingerprint_files(files, fingerprints):
+    """
+    Generate (filename, fingerprint) for files in given order.
+    Fingerprints (md5 and tags) of files missing in cache are calculated in thread pool and saved to cache,
+    cached ones are returned without reading files.
+    :param files: list of (filename, stat key)
+    :param fingerprints: open SqliteDict of fingerprints, committed every fingerprint_commit_every new entries
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(fingerprint_workers)
+    uncommitted = 0
+    futures = {}
+    try:
+        futures = {key: executor.submit(fingerprint, filename) for filename, key in files if key not in fingerprints}
+        info(f"{len(files)} files found, {len(futures)} of them are new or changed")
+        for filename, key in files:
+            if key not in futures:
+                yield filename, json.loads(fingerprints[key])
+                continue
+            value = futures[key].result()
+            fingerprints[key] = json.dumps(value)
+            uncommitted += 1
+            if uncommitted >= fingerprint_commit_every:
+                fingerprints.commit()
+                uncommitted = 0
+            yield filename, value
+    finally:
+        # not started ones are cancelled (shutdown(cancel_futures=True) needs python 3.9)
+        for future in futures.values():
+            future.cancel()
+        executor.shutdown()
+        fingerprints.commit()
+
+
+def cache_get(cache, key):
+    try:
+        return json.loads(cache[key])
+    except KeyError:
+        return None
+
+
+def cache_save(cache, key, value):
+    cache[key] = json.dumps(value)
 
 
 if __name__ == '__main__':
@@ -139,37 +199,28 @@ if __name__ == '__main__':
     # load to playlist mode ends
     else:
         # file import mode
-        for dirname in sys.argv[1:]:
+        with SqliteDict(fingerprint_cache_db) as fingerprints, SqliteDict(cache_db, autocommit=True) as cache:
+            for dirname in sys.argv[1:]:
 
-            os.chdir(dirname)
+                os.chdir(dirname)
+
+                # only stat() of files here, they are read only if not found in fingerprint cache
+                files = []
+                for root, dirs, dir_files in os.walk(u"."):
+                    for orig_filename in dir_files:
+                        if not orig_filename.lower().endswith(".mp3"):
+                            continue
+                        filename = root + os.sep + orig_filename
+                        files.append((filename, stat_key(filename)))
 
-            for root, dirs, files in os.walk(u"."):
-                for orig_filename in files:
-                    if not orig_filename.lower().endswith(".mp3"):
-                        continue
-                    filename = root + os.sep + orig_filename
-                    track_md5 = cache_get(md5_cache_db, filename)
-                    if not track_md5:
-                        track_md5 = md5(filename)
-                        cache_save(md5_cache_db, filename, track_md5)
+                for filename, track_fingerprint in fingerprint_files(files, fingerprints):
+                    track_md5 = track_fingerprint["md5"]
 
-                    track_info = cache_get(cache_db, track_md5)
+                    track_info = cache_get(cache, track_md5)
                     if track_info:
                         debug(f"(from cache) {track_info}")
                     else:
-                        mp3 = taglib.File(filename)
-
-                        tags_read = mp3.tags
-
-                        debug(f"read tags: {tags_read}")
-                        tags = {}
-                        for field in ['ALBUM', 'ARTIST', 'TITLE']:
-                            if field in tags_read and len(tags_read[field]):
-                                tags[field] = tags_read[field][0]
-                                try:
-                                    tags[field] = tags[field].encode('windows-1252').decode('windows-1251')
-                                except UnicodeEncodeError:
-                                    pass
+                        tags = track_fingerprint["tags"]
                         debug(f"got info: {tags}")
 
                         track_info = {"filename": filename}
@@ -227,7 +278,7 @@ if __name__ == '__main__':
                         #debug(f"{search['song_hits']}")
                         #debug(f"{filename} ({len(search['song_hits'])} results)")
                         track_info["tracks"] = [x['track']['storeId'] for x in search['song_hits']]
-                        cache_save(cache_db, track_md5, track_info)
+                        cache_save(cache, track_md5, track_info)
                         debug(track_info)
         # file import mode ends
 
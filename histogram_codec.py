@@ -0,0 +1,106 @@
+import math
+import struct
+import numpy
+
+from exceptions import *
+
+#
+# Binary encoding of histograms { bpm: share } for cache database.
+# All values are little-endian uint16, so encoded histogram may be read by numpy.frombuffer without copying:
+#   bpm is fixed-point with step 0.1, share is fixed-point with step 0.0001.
+# First two bytes are header: format id (it is also version of format) and format parameter.
+#   format 1, sparse: parameter is 0, then (bpm, share) pairs
+#   format 2, dense: parameter is step between bins (in 0.1 bpm), then first bpm, then shares of bins from first bpm
+#
+
+histogram_format_sparse = 1
+histogram_format_dense = 2
+histogram_bpm_scale = 10
+histogram_share_scale = 10000
+
+histogram_dtype = numpy.dtype('<u2')
+
+
+def encode_histogram(histogram, encoding="sparse"):
+    """
+    Encode histogram to bytes
+    :param histogram: { bpm: share }
+    :param encoding: "sparse" or "dense"
+    """
+    bins = sorted((round(float(bpm) * histogram_bpm_scale), round(float(share) * histogram_share_scale))
+                  for bpm, share in histogram.items())
+    for bpm, share in bins:
+        if not (0 <= bpm <= 0xffff and 0 <= share <= 0xffff):
+            raise ExBpmCrawlGeneric(f"Can't encode histogram bin {bpm / histogram_bpm_scale}: {share / histogram_share_scale}")
+    if encoding == "sparse":
+        values = [histogram_format_sparse]
+        for bpm, share in bins:
+            values += [bpm, share]
+    elif encoding == "dense":
+        step = 0
+        for bpm, share in bins:
+            step = math.gcd(step, bpm - bins[0][0])
+        step = min(max(step, 1), 0xff)
+        if any((bpm - bins[0][0]) % step for bpm, share in bins):
+            step = 1
+        first = bins[0][0] if bins else 0
+        shares = [0] * ((bins[-1][0] - first) // step + 1 if bins else 0)
+        for bpm, share in bins:
+            shares[(bpm - first) // step] = share
+        values = [histogram_format_dense | (step << 8), first] + shares
+    else:
+        raise ExBpmCrawlGeneric(f"Unknown histogram encoding '{encoding}'")
+    return struct.pack(f"<{len(values)}H", *values)
+
+
+def decode_histogram_arrays(data):
+    """
+    Decode histogram to numpy arrays
+    :return: (bpms, shares), both float64
+    """
+    values = numpy.frombuffer(data, dtype=histogram_dtype)
+    if not len(values):
+        raise ExBpmCrawlGeneric(f"Can't decode histogram: no header")
+    histogram_format = values[0] & 0xff
+    if histogram_format == histogram_format_sparse:
+        pairs = values[1:].reshape(-1, 2)
+        bpms = pairs[:, 0]
+        shares = pairs[:, 1]
+    elif histogram_format == histogram_format_dense:
+        step = values[0] >> 8
+        shares = values[2:]
+        bpms = values[1] + step * numpy.arange(len(shares), dtype=numpy.int64)
+        nonzero = shares > 0
+        bpms = bpms[nonzero]
+        shares = shares[nonzero]
+    else:
+        raise ExBpmCrawlGeneric(f"Can't decode histogram: unknown format {histogram_format}")
+    return bpms / histogram_bpm_scale, shares / histogram_share_scale
+
+
+def decode_histogram(data):
+    """Decode histogram to dict { bpm(float): share(float) }"""
+    bpms, shares = decode_histogram_arrays(data)
+    return dict(zip(bpms.tolist(), shares.tolist()))
+
+
+def decode_histograms_arrays(blobs):
+    """
+    Decode many histograms at once
+    :param blobs: list of encoded histograms
+    :return: (counts, bpms, shares): count of bins of every histogram, and bins of all histograms one after another
+    """
+    if not len(blobs):
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0), numpy.zeros(0)
+    lengths = numpy.fromiter((len(x) for x in blobs), dtype=numpy.int64, count=len(blobs)) // 2
+    values = numpy.frombuffer(b"".join(blobs), dtype=histogram_dtype)
+    starts = numpy.cumsum(lengths) - lengths
+    if numpy.all(values[starts] == histogram_format_sparse):
+        # fast path: all histograms are sparse, so just drop headers and split pairs
+        mask = numpy.ones(len(values), dtype=bool)
+        mask[starts] = False
+        pairs = values[mask].reshape(-1, 2)
+        return (lengths - 1) // 2, pairs[:, 0] / histogram_bpm_scale, pairs[:, 1] / histogram_share_scale
+    decoded = [decode_histogram_arrays(x) for x in blobs]
+    return (numpy.fromiter((len(x[0]) for x in decoded), dtype=numpy.int64, count=len(decoded)),
+            numpy.concatenate([x[0] for x in decoded]), numpy.concatenate([x[1] for x in decoded]))
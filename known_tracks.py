@@ -0,0 +1,128 @@
+import math
+import hashlib
+import threading
+
+from logging import debug, info, warning, error
+
+from exceptions import *
+from whoami import *
+from config import *
+from calc_bpm import analysis_profiles
+
+
+class BloomFilter(WhoamiObject):
+    """Bloom filter of strings: no false negatives, false positives with probability about error_rate"""
+    def __init__(self, capacity, error_rate=known_tracks_bloom_error_rate):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        # double hashing: i-th hash is h1 + i*h2
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for pos in self.positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(key))
+
+
+class KnownTracks(WhoamiObject):
+    """
+    Ids of tracks of music service that already have histogram in cache, preloaded from HistogramStore.
+    Ids are kept in set while there are no more than max_set_size of them, then in bloom filter;
+    positive answer of bloom filter is checked against database, so answer is always exact.
+    Bloom filter is sized for all tracks of database (twice as many), and is rebuilt from database with doubled
+    capacity when more tracks are added to it, so false positives stay rare.
+    If profile is given, only tracks analyzed with current version of this analysis profile are known.
+    """
+    def __init__(self, store, music_service, max_set_size=known_tracks_max_set_size, profile=None):
+        self.store = store
+        self.music_service = music_service
+        self.max_set_size = max_set_size
+        self.profile = profile
+        self.tracks = set()
+        self.bloom = None
+        self.expected = store.count_tracks(music_service)  # so bloom filter made while loading fits all tracks
+        self.load()
+        info(f"Loaded {len(self)} known tracks of {music_service}" + (" (to bloom filter)" if self.bloom else ""))
+
+    def load(self):
+        for track_id, analysis in self.store.track_analyses(self.music_service):
+            if self.is_analysis_current(analysis):
+                self.add(track_id)
+
+    def add(self, track_id):
+        """Add track, its histogram must be saved to store already"""
+        if self.bloom is not None:
+            if self.bloom.count >= self.bloom.capacity:
+                debug(f"{self.whoami()}: bloom filter is full, rebuilding it for {2 * self.bloom.capacity} tracks")
+                self.bloom = BloomFilter(2 * self.bloom.capacity)
+                self.load()
+            self.bloom.add(track_id)
+            return
+        self.tracks.add(track_id)
+        if len(self.tracks) > self.max_set_size:
+            debug(f"{self.whoami()}: more than {self.max_set_size} known tracks, switching to bloom filter")
+            self.bloom = BloomFilter(2 * max(len(self.tracks), self.expected))
+            for known_id in self.tracks:
+                self.bloom.add(known_id)
+            self.tracks = None
+
+    def __contains__(self, track_id):
+        if self.bloom is None:
+            return track_id in self.tracks
+        if track_id not in self.bloom:
+            return False
+        return self.store.has_track(self.music_service, track_id) \
+            and self.is_analysis_current(self.store.get_analysis(self.music_service, track_id))
+
+    def is_analysis_current(self, analysis):
+        if self.profile is None:
+            return True
+        # histograms saved before profiles appeared were made as "accurate" version 1 does
+        analysis = {"profile": "accurate", "profile_version": 1, **analysis}
+        return analysis["profile"] == self.profile and analysis["profile_version"] == analysis_profiles[self.profile]["version"]
+
+    def __len__(self):
+        return len(self.tracks) if self.bloom is None else self.bloom.count
+
+
+class AudioHashIndex(WhoamiObject):
+    """
+    Tracks of all music services by digest of their analyzed audio (see calc_file_audio_hash), preloaded from
+    HistogramStore, so audio already analyzed under another track id (reissue, compilation, other service)
+    is not analyzed again. Used by pipeline threads, while new digests are added by the thread saving histograms.
+    """
+    def __init__(self, store):
+        self.lock = threading.Lock()
+        self.hashes = {}
+        self.track_hashes = {}  # (music_service, track_id) -> digest, to forget stale digest of reanalyzed track
+        for audio_hash, provider, track_id, seconds in store.audio_hashes():
+            self.hashes[audio_hash] = (provider, track_id, seconds)
+            self.track_hashes[(provider, track_id)] = audio_hash
+        info(f"Loaded {len(self.hashes)} audio hashes")
+
+    def add(self, audio_hash, music_service, track_id, seconds):
+        with self.lock:
+            stale = self.track_hashes.get((music_service, track_id))
+            if stale is not None and stale != audio_hash and self.hashes.get(stale, ())[:2] == (music_service, track_id):
+                del self.hashes[stale]
+            self.track_hashes[(music_service, track_id)] = audio_hash
+            self.hashes.setdefault(audio_hash, (music_service, track_id, seconds))
+
+    def get(self, audio_hash):
+        """:return: (music_service, track_id, seconds of analysis) of track with the same audio, or None"""
+        with self.lock:
+            return self.hashes.get(audio_hash)
+
+    def __len__(self):
+        return len(self.hashes)
@@ -0,0 +1,223 @@
+import os
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from logging import debug, info, warning, error
+
+from exceptions import *
+from whoami import *
+from tracing import *
+
+# upper bounds of histogram buckets, seconds
+metrics_buckets = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+metrics_help = {
+    "bpmcrawl_stage_seconds": "Time spent by crawl stages: fetch (getting next track from provider), stream_url"
+                              " (part of download), download, hash (of downloaded audio, for dedupe), decode, rhythm (beat tracking), histogram,"
+                              " provider_analysis (done by provider), db_read, db_write",
+    "bpmcrawl_download_bytes_total": "Bytes of downloaded tracks",
+    "bpmcrawl_tracks_total": "Tracks by result: processed (got from provider), cached (already analyzed), new, failed,"
+                             " duplicate (the same audio was analyzed for another track)",
+    "bpmcrawl_dedupe_saved_seconds_total": "Seconds of analysis saved by not analyzing already analyzed audio again",
+    "bpmcrawl_in_flight_tracks": "Tracks being downloaded or analyzed",
+    "bpmcrawl_api_requests_total": "Requests to API of music provider by result: ok, retried, failed",
+    "bpmcrawl_api_wait_seconds_total": "Seconds spent waiting for rate limit, backoff and Retry-After of provider API",
+}
+
+
+class Metrics(WhoamiObject):
+    """
+    Counters, gauges and histograms of process, rendered in Prometheus text format.
+    Metric is identified by name and labels, e.g. inc("bpmcrawl_tracks_total", result="new").
+    Metric type is defined by method used first for this name.
+    """
+    def __init__(self, buckets=metrics_buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.types = {}
+        self.values = {}  # (name, labels) -> value, or [bucket counts..., count, sum] for histograms
+
+    def key(self, name, metric_type, labels):
+        if self.types.setdefault(name, metric_type) != metric_type:
+            raise ExBpmCrawlGeneric(f"Internal error: metric {name} is {self.types[name]}, not {metric_type}")
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            key = self.key(name, "counter", labels)
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[self.key(name, "gauge", labels)] = value
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            key = self.key(name, "histogram", labels)
+            if key not in self.values:
+                self.values[key] = [0] * (len(self.buckets) + 2)
+            histogram = self.values[key]
+            for n, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[n] += 1
+            histogram[-2] += 1
+            histogram[-1] += value
+
+    def time(self, name, trace_args=None, **labels):
+        """
+        Context manager observing seconds spent in it
+        :param trace_args: args of trace span (e.g. id of track)
+        """
+        return MetricsTimer(self, name, labels, trace_args or {})
+
+    def get(self, name, **labels):
+        """Value of counter or gauge, sum of histogram; 0 if not set"""
+        with self.lock:
+            value = self.values.get((name, tuple(sorted(labels.items()))), 0)
+            return value[-1] if isinstance(value, list) else value
+
+    def get_sums(self, name, label):
+        """Values (sums for histograms) of metric by value of label: { label value: value }"""
+        with self.lock:
+            return {dict(labels)[label]: value[-1] if isinstance(value, list) else value
+                    for (metric, labels), value in self.values.items() if metric == name and label in dict(labels)}
+
+    def render(self):
+        """Metrics in Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for name in sorted(self.types):
+                if name in metrics_help:
+                    lines.append(f"# HELP {name} {metrics_help[name]}")
+                lines.append(f"# TYPE {name} {self.types[name]}")
+                for (metric, labels), value in sorted(self.values.items()):
+                    if metric != name:
+                        continue
+                    if self.types[name] != "histogram":
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+                        continue
+                    for bound, count in zip(self.buckets, value):
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {count}")
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {value[-2]}")
+                    lines.append(f"{name}_count{format_labels(labels)} {value[-2]}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def write_file(self, filename):
+        """Write metrics to file atomically (suitable for node_exporter textfile collector)"""
+        with open(filename + ".tmp", "w") as f:
+            f.write(self.render())
+        os.replace(filename + ".tmp", filename)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class MetricsTimer:
+    """Timer of metrics, it is also span of trace (named by stage label if there is one)"""
+    def __init__(self, metrics, name, labels, trace_args):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.span = tracer.span(labels.get("stage", name), **trace_args)
+
+    def __enter__(self):
+        self.span.__enter__()
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.monotonic() - self.started, **self.labels)
+        self.span.__exit__(exc_type, exc_value, traceback)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        debug(f"{self.__class__.__name__}: {self.address_string()} {format % args}")
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        content = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class MetricsExporter(WhoamiObject):
+    """
+    Export of metrics: HTTP endpoint /metrics on port (in background thread), and/or file rewritten every interval seconds
+    (by maybe_write(), called from main loop)
+    """
+    def __init__(self, metrics, port=None, filename=None, interval=15):
+        self.metrics = metrics
+        self.filename = filename
+        self.interval = interval
+        self.last_write = 0
+        self.server = None
+        if port:
+            self.server = ThreadingHTTPServer(("", port), MetricsRequestHandler)
+            self.server.daemon_threads = True
+            self.server.metrics = metrics
+            threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+            info(f"metrics are served at http://localhost:{port}/metrics")
+
+    def maybe_write(self):
+        if self.filename and time.monotonic() - self.last_write >= self.interval:
+            self.write()
+
+    def write(self):
+        if self.filename:
+            self.metrics.write_file(self.filename)
+            self.last_write = time.monotonic()
+
+    def close(self):
+        self.write()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class ProgressLog(WhoamiObject):
+    """Periodic log line with throughput and ETA of crawl"""
+    def __init__(self, metrics, interval=60, total=None):
+        """:param total: count of tracks to process, None if unknown (ETA is not shown then)"""
+        self.metrics = metrics
+        self.interval = interval
+        self.total = total
+        self.started = time.monotonic()
+        self.last_log = self.started
+
+    def maybe_log(self):
+        if self.interval and time.monotonic() - self.last_log >= self.interval:
+            self.log()
+
+    def log(self):
+        self.last_log = time.monotonic()
+        elapsed = self.last_log - self.started
+        tracks = self.metrics.get_sums("bpmcrawl_tracks_total", "result")
+        processed = tracks.get("processed", 0)
+        rate = processed / elapsed if elapsed else 0
+        analyzed = tracks.get("new", 0) + tracks.get("failed", 0)
+        stages = ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in
+                           sorted(self.metrics.get_sums("bpmcrawl_stage_seconds", "stage").items(), key=lambda x: -x[1]))
+        eta = ""
+        if self.total and rate:
+            left = max(self.total - processed, 0) / rate
+            eta = f", ETA {int(left // 3600)}:{int(left % 3600 // 60):02d}:{int(left % 60):02d}"
+        info(f"progress: {processed}{'/' + str(self.total) if self.total else ''} tracks processed"
+             f" ({tracks.get('new', 0)} new, {tracks.get('failed', 0)} failed, {tracks.get('cached', 0)} cached,"
+             f" {tracks.get('duplicate', 0)} duplicate),"
+             f" {rate * 3600:.0f} tracks/h, {analyzed / elapsed * 3600 if elapsed else 0:.0f} analyzed/h{eta};"
+             f" time by stages: {stages}")
+
+
+# metrics of this process
+metrics = Metrics()
@@ -5,10 +5,18 @@ import requests
 import tempfile
 import time
 import datetime
+import sqlite3
+import atexit
+import threading
+import concurrent.futures
+import collections
 
 from exceptions import *
 from config import *
 from calc_bpm import *
+from metrics import *
+from downloader import *
+from ratelimit import *
 
 from gmusicapi.clients import Mobileclient
 import gmusicapi.exceptions
@@ -17,6 +25,7 @@ from spotipy.oauth2 import SpotifyOAuth
 from spotipy.exceptions import *
 
 import yandex_music
+from yandex_music.utils.difference import Difference
 
 music_service_mapping = None  # it is really initialized at the end of this file
 
@@ -30,6 +39,13 @@ def get_music_provider(music_service, provider_logging_level=logging.CRITICAL):
 class MusicproviderBase(WhoamiObject):
     music_service = None
     provider_logging_level = None
+    analyze_locally = True  # True if histogram is calculated from file got by download_track()
+    api_retryable_errors = ()  # errors of provider library after which request may be retried (see ratelimit.py)
+    api_nonretryable_errors = ()  # errors of provider library which are not retried, though they are retryable ones
+    limiter = None
+    playlist_add_batch_size = 100  # max tracks added to playlist by one add_tracks_batch_to_playlist() call
+    artist_page_size = artist_page_size
+    artist_pagers = None  # ArtistPager by artist id
 
     def __str__(self):
         return self.__repr__()
@@ -40,6 +56,8 @@ class MusicproviderBase(WhoamiObject):
         if self.music_service != music_service:
             raise ExBpmCrawlGeneric(f"Internal error: tried to init {self.__class__.__name__} with wrong service provider '{self.music_service}'")
         self.set_provider_logging_level(provider_logging_level)
+        self.limiter = get_rate_limiter(music_service, self.api_retryable_errors, self.api_nonretryable_errors)
+        self.artist_pagers = {}
 
     def set_provider_logging_level(self, provider_logging_level):
         self.provider_logging_level = provider_logging_level
@@ -79,6 +97,14 @@ class MusicproviderBase(WhoamiObject):
         """
         raise ExBpmCrawlGeneric(f"Internal error: Method {self.whoami()} is not implemented")
 
+    def get_playlist_snapshot(self, playlist):
+        """
+        Get version of playlist contents, it changes with every change of them
+        :param playlist: playlist object
+        :return: snapshot id (revision), None if provider doesn't have it
+        """
+        return None
+
     def add_track_to_playlist(self, playlist, track_id):
         """
         Add track to existing playlist
@@ -87,6 +113,40 @@ class MusicproviderBase(WhoamiObject):
         """
         raise ExBpmCrawlGeneric(f"Internal error: Method {self.whoami()} is not implemented")
 
+    def add_tracks_to_playlist(self, playlist, track_ids):
+        """
+        Add tracks to existing playlist by batches of playlist_add_batch_size tracks.
+        Playlist object stays usable for next changes, it is not needed to reload it.
+        :param playlist: playlist returned by get_or_create_playlist()
+        :param track_ids: list of track ids
+        :return: list of ids of added tracks (errors are logged)
+        """
+        added = []
+        for start in range(0, len(track_ids), self.playlist_add_batch_size):
+            batch = track_ids[start:start + self.playlist_add_batch_size]
+            try:
+                added += self.add_tracks_batch_to_playlist(playlist, batch)
+            except ExBpmCrawlGeneric as e:
+                error(f"{self.whoami()}: failed to add {len(batch)} tracks to playlist: {e}")
+        return added
+
+    def add_tracks_batch_to_playlist(self, playlist, track_ids):
+        """
+        Add up to playlist_add_batch_size tracks to playlist, by one request if provider's API allows it
+        (by add_track_to_playlist() for every track otherwise)
+        :return: list of ids of added tracks
+        """
+        added = []
+        for track_id in track_ids:
+            try:
+                if self.add_track_to_playlist(playlist, track_id):
+                    added.append(track_id)
+                else:
+                    error(f"failed to add track {track_id} to playlist (no reason given)")
+            except ExBpmCrawlGeneric as e:
+                error(f"failed to add track {track_id}: {e}")
+        return added
+
     def get_station_from_url(self, url):
         """
         Get station object (in format of provider) from station name/URL
@@ -122,6 +182,22 @@ class MusicproviderBase(WhoamiObject):
         """
         raise ExBpmCrawlGeneric(f"Internal error: Method {self.whoami()} is not implemented")
 
+    def station_mark_track_done(self, track_id):
+        """
+        Called when track got from station is finished (found in cache, analyzed or failed)
+        :param track_id: track id
+        :return: Nothing
+        """
+        pass
+
+    def station_save_session(self):
+        """
+        Save state of station playback kept between runs (e.g. seen tracks) for tracks marked as done;
+        called when results of done tracks are committed
+        :return: Nothing
+        """
+        pass
+
     def get_track_id(self, track):
         """
         Get track id for given track. Track id is used to save track info to cache databse.
@@ -130,11 +206,23 @@ class MusicproviderBase(WhoamiObject):
         """
         raise ExBpmCrawlGeneric(f"Internal error: Method {self.whoami()} is not implemented")
 
-    def download_track(self, track):
+    def get_track_duration(self, track):
+        """
+        Get duration of track
+        :param track: track returned by station_get_next_track, or track of playlist
+        :return: duration in seconds, None if unknown
+        """
+        return None
+
+    def download_track(self, track, window=None):
         """
         Download track to file and return Tempfile object.
         File will be deleted upon close!
+        If window is given, provider may download only part of track covering it.
+        Returned object has attribute analysis_window: part of file to analyze, it is
+        window if whole track was downloaded, or None if file contains only part of track.
         :param track: track returned by station_get_next_track, or track of playlist
+        :param window: (start, end) in seconds, part of track which will be analyzed
         :return: tempfile object with track data
         """
         raise ExBpmCrawlGeneric(f"Internal error: Method {self.whoami()} is not implemented")
@@ -147,6 +235,23 @@ class MusicproviderBase(WhoamiObject):
         """
         raise ExBpmCrawlGeneric(f"Internal error: Method {self.whoami()} is not implemented")
 
+    def is_track_changed(self, track):
+        """
+        Check if track was changed since its histogram was saved, so cached histogram is stale
+        :param track: track returned by station_get_next_track, or track of playlist
+        :return: True if track should be analyzed again
+        """
+        return False
+
+    def mark_track_analyzed(self, track_id):
+        """
+        Called when histogram of track is saved or found in cache.
+        Providers which track changes of tracks (see is_track_changed) remember state of track here.
+        :param track_id: track id
+        :return: Nothing
+        """
+        pass
+
     def get_artist(self, artist_id):
         """
         Get artist object for given artist id
@@ -155,21 +260,37 @@ class MusicproviderBase(WhoamiObject):
         """
         raise ExBpmCrawlGeneric(f"Internal error: Method {self.whoami()} is not implemented")
 
-    def artist_pager_init(self, artist):
+    def get_artist_id(self, artist):
         """
-        Init tracks pager for artist
+        Get id of artist
         :param artist: artist object
-        :return: Nothing
+        :return: artist id
         """
         raise ExBpmCrawlGeneric(f"Internal error: Method {self.whoami()} is not implemented")
 
-    def artist_pager_load_page(self, artist, page_num=0):
+    def artist_pager_init(self, artist, page_num=0, idx=0):
         """
-        Get page of tracks for artist
+        Init tracks pager for artist, it starts loading the first page in background
         :param artist: artist object
-        :param page_num: page number (default 0)
+        :param page_num: page to start from (default 0)
+        :param idx: index of track in page to start from (default 0)
         :return: Nothing
         """
+        artist_id = self.get_artist_id(artist)
+        if artist_id in self.artist_pagers:
+            self.artist_pagers[artist_id].close()
+        self.artist_pagers[artist_id] = ArtistPager(
+            lambda page_num, page_size: self.artist_pager_load_page(artist, page_num, page_size),
+            self.artist_page_size, page_num, idx)
+
+    def artist_pager_load_page(self, artist, page_num=0, page_size=artist_page_size):
+        """
+        Get page of tracks for artist (called by ArtistPager in its thread)
+        :param artist: artist object
+        :param page_num: page number (default 0)
+        :param page_size: tracks per page
+        :return: list of tracks, empty after the last page
+        """
         raise ExBpmCrawlGeneric(f"Internal error: Method {self.whoami()} is not implemented")
 
     def artist_pager_get_next_track(self, artist):
@@ -178,15 +299,151 @@ class MusicproviderBase(WhoamiObject):
         :param artist: artist object
         :return: Track object or None if end of list reached
         """
-        raise ExBpmCrawlGeneric(f"Internal error: Method {self.whoami()} is not implemented")
+        return self.artist_pagers[self.get_artist_id(artist)].get_next_track()
+
+    def artist_pager_get_position(self, artist):
+        """
+        Get position of pager for artist, to start from it later by artist_pager_init
+        :param artist: artist object
+        :return: (page number, index of next track in page)
+        """
+        return self.artist_pagers[self.get_artist_id(artist)].get_position()
+
+    def artist_pager_close(self, artist):
+        """
+        Drop pager for artist, page being loaded in background is not waited for
+        :param artist: artist object
+        :return: Nothing
+        """
+        pager = self.artist_pagers.pop(self.get_artist_id(artist), None)
+        if pager:
+            pager.close()
+
+
+class ArtistPager(WhoamiObject):
+    """
+    Tracks of artist, loaded page by page by load_page(page_num, page_size), which returns empty list after the last page.
+    Next page is loaded in background thread while tracks of current one are crawled,
+    so crawl doesn't wait for provider at the page boundaries.
+    Thread is daemon, so page being loaded (maybe retried for long) doesn't keep process from exit.
+    """
+    def __init__(self, load_page, page_size=artist_page_size, page_num=0, idx=0):
+        self.load_page = load_page
+        self.page_size = page_size
+        self.page = page_num
+        self.idx = idx  # index of next track in page
+        self.tracks = None  # tracks of current page, None until it's loaded
+        self.closed = False
+        self.next_page = self.start_load(page_num)
+
+    def start_load(self, page_num):
+        """:return: future of tracks of page, loaded in background thread"""
+        future = concurrent.futures.Future()
+        threading.Thread(target=self.load, args=(page_num, future), name=f"artist-pager-{page_num}", daemon=True).start()
+        return future
+
+    def load(self, page_num, future):
+        if not future.set_running_or_notify_cancel():
+            return
+        debug(f"{self.whoami()}: loading page {page_num} ({self.page_size} per page)")
+        try:
+            future.set_result(list(self.load_page(page_num, self.page_size)))
+        except BaseException as e:
+            future.set_exception(e)
+
+    def wait_page(self):
+        """:return: tracks of current page, they are loaded (or being loaded) already; next page starts loading"""
+        tracks = self.next_page.result()
+        if tracks and not self.closed:
+            self.next_page = self.start_load(self.page + 1)
+        return tracks
+
+    def get_next_track(self):
+        """:return: next track, None after the last one"""
+        if self.tracks is None:
+            self.tracks = self.wait_page()
+        while self.idx >= len(self.tracks):
+            if not self.tracks:
+                return None
+            self.page += 1
+            self.idx = 0
+            self.tracks = self.wait_page()
+        self.idx += 1
+        return self.tracks[self.idx - 1]
+
+    def get_position(self):
+        """:return: (page number, index of next track in page)"""
+        return self.page, self.idx
+
+    def close(self):
+        """Stop prefetch of next pages"""
+        self.closed = True
+        self.next_page.cancel()
+
+
+class StationSession(WhoamiObject):
+    """
+    Tracks seen while playing station, kept between runs, so next run continues the playback.
+    Ids are checked against set of all seen ones, but only last recent_size of them are given to service
+    as recently played, so cost of every track doesn't grow with the session.
+    Ids are appended to file (one per line) by save() when their tracks are done and results are committed,
+    so tracks which were in work when process died are played again by next run;
+    delete the file to start station from scratch.
+    """
+    def __init__(self, music_service, station_id, recent_size=station_recent_size, dirname=station_sessions_dir):
+        os.makedirs(dirname, exist_ok=True)
+        station_name = re.sub(r'[^\w.-]', '_', str(station_id))
+        self.filename = os.path.join(dirname, f"{music_service}-{station_name}.txt")
+        self.seen = set()
+        self.recent = collections.deque(maxlen=recent_size)
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                for line in f:
+                    track_id = line.rstrip("\n")
+                    if track_id:
+                        self.seen.add(track_id)
+                        self.recent.append(track_id)
+            info(f"{self.whoami()}: continuing station session of {len(self.seen)} seen tracks ({self.filename})")
+        self.file = open(self.filename, "a", buffering=1)
+        self.done_ids = []  # ids of done tracks, not saved yet
+
+    def __contains__(self, track_id):
+        return track_id in self.seen
+
+    def __len__(self):
+        return len(self.seen)
+
+    def add(self, track_id):
+        self.seen.add(track_id)
+        self.recent.append(track_id)
+
+    def done(self, track_id):
+        """Track is finished (found in cache, analyzed or failed), it's saved as seen by next save()"""
+        self.done_ids.append(track_id)
+
+    def save(self):
+        if self.done_ids:
+            self.file.write("".join(f"{track_id}\n" for track_id in self.done_ids))
+            self.done_ids = []
+
+    def get_recent(self):
+        """:return: list of ids of recently seen tracks, the oldest first"""
+        return list(self.recent)
+
+    def close(self):
+        self.save()
+        self.file.close()
 
 
 class MusicProviderGoogle(MusicproviderBase):
     music_service = 'gmusic'
     gmusic_client_id = gmusic_client_id
+    # CallFailure is raised for client errors and failed calls too, only HTTP 429 and 5xx ones are retried
+    # (status is found in its message, see get_error_status in ratelimit.py)
     api = None
     station_current = None  # current station
-    station_recently_played = None  # list of tracks already seen from current station
+    station_recently_played = None  # StationSession of current station: tracks already seen from it
+    station_seen_batches = 0  # batches of tracks in a row got from station without unseen tracks
     station_current_tracks = None  # list of tracks got last time from station
     station_current_unseen = None  # count of tracks in current tracks list that were unseen in this playback session
     station_now_playing = None  # index of 'currently playing' track (points to track returned by last station_get_next_track call)
@@ -195,7 +452,7 @@ class MusicProviderGoogle(MusicproviderBase):
         # log in to google music suppressing it's debugging messages
         oldloglevel = logging.getLogger().level
         logging.getLogger().setLevel(logging.ERROR)
-        self.api = Mobileclient(debug_logging=False)
+        self.api = RateLimitedClient(Mobileclient(debug_logging=False), self.limiter)
         logging.getLogger("gmusicapi.Mobileclient1").setLevel(logging.WARNING)
         rv = self.api.oauth_login(self.gmusic_client_id)
         logging.getLogger().setLevel(oldloglevel)
@@ -250,6 +507,18 @@ class MusicProviderGoogle(MusicproviderBase):
         else:
             return False
 
+    def add_tracks_batch_to_playlist(self, playlist, track_ids):
+        # ids of playlist entries are returned, not of tracks, so partial success can't be told apart
+        try:
+            added = self.api.add_songs_to_playlist(playlist["id"], track_ids)
+        except Exception as e:
+            debug(f"{self.whoami()}: got exception:", exc_info=True)
+            raise ExBpmCrawlGeneric(str(e))
+        if len(added) != len(track_ids):
+            warning(f"{self.whoami()}: only {len(added)} of {len(track_ids)} tracks were added to playlist")
+            return []
+        return track_ids
+
     def get_station_from_url(self, url):
         if url == "IFL":
             return {"id": "IFL", "name": "I'm Feeling Lucky"}
@@ -266,12 +535,23 @@ class MusicProviderGoogle(MusicproviderBase):
         return station['name']
 
     def station_prepare(self, station):
-        self.station_recently_played = []
+        if self.station_recently_played is not None:
+            self.station_recently_played.close()
+        self.station_recently_played = StationSession(self.music_service, station['id'])
+        self.station_seen_batches = 0
         self.station_current_tracks = None
         self.station_current_unseen = 0
         self.station_now_playing = None
         self.station_current = station
 
+    def station_mark_track_done(self, track_id):
+        if self.station_recently_played is not None:
+            self.station_recently_played.done(track_id)
+
+    def station_save_session(self):
+        if self.station_recently_played is not None:
+            self.station_recently_played.save()
+
     def station_get_next_track(self):
         need_new_tracks = False
         if self.station_current_tracks is None:
@@ -281,6 +561,10 @@ class MusicProviderGoogle(MusicproviderBase):
                 self.station_now_playing += 1
                 if self.station_now_playing >= len(self.station_current_tracks):
                     if self.station_current_unseen == 0:
+                        self.station_seen_batches += 1
+                    else:
+                        self.station_seen_batches = 0
+                    if self.station_seen_batches >= station_seen_batches_to_stop:
                         # all played tracks already seen, so probably we've seen all tracks of station, let's stop it
                         debug(f"{self.whoami()}: all played tracks were already seen, stopping this playback cycle")
                         return None
@@ -295,13 +579,13 @@ class MusicProviderGoogle(MusicproviderBase):
                         continue
                     else:
                         self.station_current_unseen += 1
-                        self.station_recently_played.append(track_id)
+                        self.station_recently_played.add(track_id)
                         debug(f"{self.whoami()}: (level 1) returning next track {track_id}, station_current_unseen=={self.station_current_unseen}")
                         return track
         # here we are only if we need more tracks from station
         debug(f"{self.whoami()}: getting new set of tracks")
         self.station_current_tracks = self.api.get_station_tracks(self.station_current['id'], num_tracks=25,
-                                                                  recently_played_ids=self.station_recently_played)
+                                                                  recently_played_ids=self.station_recently_played.get_recent())
         self.station_current_unseen = 0
         self.station_now_playing = 0
         if not self.station_current_tracks or len(self.station_current_tracks) == 0:
@@ -319,7 +603,7 @@ class MusicProviderGoogle(MusicproviderBase):
                 continue
             else:
                 self.station_current_unseen += 1
-                self.station_recently_played.append(track_id)
+                self.station_recently_played.add(track_id)
                 debug(f"{self.whoami()}: (level 2) returning next track {track_id}, station_current_unseen=={self.station_current_unseen}")
                 return track
         debug(f"{self.whoami()}: (level 2) reached end of list, stopping this playback cycle")
@@ -328,17 +612,26 @@ class MusicProviderGoogle(MusicproviderBase):
     def get_track_id(self, track):
         return track['storeId']
 
-    def download_track(self, track):
-        file = tempfile.NamedTemporaryFile(mode='w+b', dir=temp_dir, prefix='track', suffix='.mp3')
-        stream_url = self.api.get_stream_url(self.get_track_id(track), quality='low')
-        with requests.get(stream_url, stream=True) as r:
-            r.raise_for_status()
-            for chunk in r.iter_content(chunk_size=8192):
-                # If you have chunk encoded response uncomment if
-                # and set chunk_size parameter to None.
-                # if chunk:
-                file.write(chunk)
-        file.flush()
+    def get_track_duration(self, track):
+        if 'durationMillis' in track:
+            return int(track['durationMillis']) / 1000
+        return None
+
+    def download_track(self, track, window=None):
+        with metrics.time("bpmcrawl_stage_seconds", stage="stream_url"):
+            stream_url = self.api.get_stream_url(self.get_track_id(track), quality='low')
+        headers = {}
+        duration = self.get_track_duration(track)
+        if window and duration:
+            # request only bytes of window, assuming constant bitrate
+            size = downloader.get_size(stream_url)
+            if size:
+                headers['Range'] = f"bytes={int(size * window[0] / duration)}-{int(size * window[1] / duration)}"
+        file = downloader.download(stream_url, headers)
+        file.analysis_window = window
+        if file.partial:
+            debug(f"{self.whoami()}: downloaded only {headers['Range']} of track {self.get_track_id(track)}")
+            file.analysis_window = None
         return file
 
     def get_track_id(self, track):
@@ -354,6 +647,7 @@ class MusicProviderGoogle(MusicproviderBase):
 
 class MusicProviderSpotify(MusicproviderBase):
     music_service = 'spotify'
+    analyze_locally = False  # histogram is got from spotify's audio analysis
     api = None
     spotify_scopes = [
         "playlist-read-collaborative",
@@ -366,7 +660,7 @@ class MusicProviderSpotify(MusicproviderBase):
         "user-follow-read",
         "user-read-recently-played",
     ]
-    playlist_get_fields = ['id', 'name', 'uri']
+    playlist_get_fields = ['id', 'name', 'uri', 'snapshot_id']
 
     def set_provider_logging_level(self, provider_logging_level):
         super(MusicproviderYandexMusic, self).set_provider_logging_level(provider_logging_level)
@@ -375,7 +669,10 @@ class MusicProviderSpotify(MusicproviderBase):
     def login(self):
         logging.getLogger("spotipy").setLevel(logging.CRITICAL)
         try:
-            self.api = spotipy.Spotify(auth_manager=SpotifyOAuth(open_browser=False, scope=" ".join(self.spotify_scopes)))
+            # plain session: retries of spotipy are disabled, they are done by rate limiter honouring Retry-After
+            self.api = RateLimitedClient(spotipy.Spotify(
+                auth_manager=SpotifyOAuth(open_browser=False, scope=" ".join(self.spotify_scopes)),
+                requests_session=requests.Session()), self.limiter)
             self.api.me()  # or else it will try to log in upon first request
             return self.api
         except Exception as e:
@@ -434,14 +731,21 @@ class MusicProviderSpotify(MusicproviderBase):
             tracks.extend(result['items'])
         return tracks
 
+    def get_playlist_snapshot(self, playlist):
+        return playlist.get('snapshot_id')
+
     def add_track_to_playlist(self, playlist, track_id):
+        return bool(self.add_tracks_batch_to_playlist(playlist, [track_id]))
+
+    def add_tracks_batch_to_playlist(self, playlist, track_ids):
+        # up to 100 items per request are allowed by Spotify API (see playlist_add_batch_size)
         try:
-            self.api.playlist_add_items(playlist['id'], [track_id])
+            self.api.playlist_add_items(playlist['id'], track_ids)
         except Exception as e:
             debug(f"{self.whoami()}: got exception:", exc_info=True)
             raise ExBpmCrawlGeneric(str(e))
         else:
-            return True
+            return track_ids
 
     def get_station_from_url(self, url):
         raise ExBpmCrawlGeneric(f"Stations are not implemented (and not needed) for Spotify")
@@ -458,7 +762,10 @@ class MusicProviderSpotify(MusicproviderBase):
     def get_track_id(self, track):
         return track['track']['id']
 
-    def download_track(self, track):
+    def get_track_duration(self, track):
+        return track['track']['duration_ms'] / 1000
+
+    def download_track(self, track, window=None):
         raise ExBpmCrawlGeneric(f"Internal error: Method {self.whoami()} is not implemented")
 
     def calc_bpm_histogram(self, track):
@@ -466,14 +773,7 @@ class MusicProviderSpotify(MusicproviderBase):
         debug(f"{self.whoami()}: getting audio analysis for {track_id}")
         try:
             histogram = {}
-            try:
-                analysis = self.api.audio_analysis(track_id)
-            except Exception as e:
-                # sometimes it is just good to wait and retry and it will magically appear
-                # do this rather than immediately fall back to mp3 file analysis
-                warning(f"failed to get audio analysis from spotify for {track_id}, will retry")
-                time.sleep(10)
-                analysis = self.api.audio_analysis(track_id)
+            analysis = self.api.audio_analysis(track_id)
             for section in analysis['sections']:
                 if float(section['tempo_confidence']) > 0:
                     tempo = round(float(section['tempo']), 1)
@@ -495,8 +795,32 @@ class MusicProviderSpotify(MusicproviderBase):
         debug(f"{self.whoami()}: histogram({track_id}): {histogram}")
         return histogram
 
-    def artist_pager_init(self, artist):
-        self.artist_pager_load(artist, 0)
+    artist_page_size = min(artist_page_size, 50)  # albums per page, 50 is the most spotify gives at once
+
+    def get_artist(self, artist_id):
+        return self.api.artist(artist_id)
+
+    def get_artist_id(self, artist):
+        return artist['id']
+
+    def get_album_tracks(self, album_id):
+        tracks = []
+        result = self.api.album_tracks(album_id, limit=50)
+        tracks.extend(result['items'])
+        while result['next']:
+            result = self.api.next(result)
+            tracks.extend(result['items'])
+        return tracks
+
+    def artist_pager_load_page(self, artist, page_num=0, page_size=artist_page_size):
+        # page is a page of artist's albums, their tracks are fetched concurrently
+        albums = self.api.artist_albums(artist['id'], album_type='album,single', limit=page_size,
+                                        offset=page_num * page_size)['items']
+        debug(f"{self.whoami()}: got {len(albums)} albums of artist {artist['id']} (page {page_num})")
+        with concurrent.futures.ThreadPoolExecutor(artist_album_fetch_workers) as executor:
+            albums_tracks = list(executor.map(self.get_album_tracks, [album['id'] for album in albums]))
+        # tracks are wrapped as items of playlist, see get_track_id
+        return [{'track': track} for tracks in albums_tracks for track in tracks]
 
 
 class MusicproviderYandexMusic(MusicproviderBase):
@@ -512,9 +836,14 @@ class MusicproviderYandexMusic(MusicproviderBase):
 
     music_service = 'yandexmusic'
     token_env_var = 'YM_TOKEN'
+    api_retryable_errors = (yandex_music.exceptions.NetworkError, yandex_music.exceptions.TimedOutError)
+    # client errors are subclasses of NetworkError
+    api_nonretryable_errors = (yandex_music.exceptions.BadRequestError, yandex_music.exceptions.NotFoundError)
+    # what Track.download() of yandex_music downloads by default
+    download_codec = 'mp3'
+    download_bitrate = 192
     token = None
     client = None
-    artist_pager = {}
 
     def __init__(self, music_service, provider_logging_level=logging.CRITICAL):
 
@@ -536,7 +865,10 @@ class MusicproviderYandexMusic(MusicproviderBase):
 
     def login(self):
         try:
-            self.client = yandex_music.Client(self.token).init()
+            self.client = yandex_music.Client(self.token)
+            # all requests of client and of objects got from it go through its request object
+            self.client._request = RateLimitedClient(self.client._request, self.limiter)
+            self.client.init()
         except yandex_music.exceptions.UnauthorizedError as e:
             raise ExBpmCrawlGeneric(
                 f"Failed to log in to {self.music_service}: {e}\n"
@@ -619,6 +951,9 @@ class MusicproviderYandexMusic(MusicproviderBase):
                 tracks = self.client.tracks(track_ids)
         return tracks
 
+    def get_playlist_snapshot(self, playlist):
+        return getattr(playlist, 'revision', None)
+
     def add_track_to_playlist(self, playlist, track_id):
         """
         Add track to existing playlist
@@ -640,6 +975,34 @@ class MusicproviderYandexMusic(MusicproviderBase):
         else:
             return False
 
+    def add_tracks_batch_to_playlist(self, playlist, track_ids):
+        """Insert tracks by one change of playlist; album ids needed for it are got by one request, too"""
+        inserts = []
+        try:
+            tracks = self.client.tracks(track_ids)
+        except Exception as e:
+            debug(f"{self.whoami()}: got exception:", exc_info=True)
+            raise ExBpmCrawlGeneric(str(e))
+        for track in tracks:
+            try:
+                inserts.append({'id': track.id, 'album_id': track.albums[0].id})
+            except (IndexError, TypeError):
+                error(f"Failed to get album id for track {track.id} ({track.title})")
+        if not inserts:
+            return []
+        diff = Difference().add_insert(0, inserts)
+        try:
+            updated = self.client.users_playlists_change(playlist.kind, diff.to_json(), playlist.revision, playlist.owner.uid)
+        except Exception as e:
+            # e.g. revision of playlist was changed by someone else
+            debug(f"{self.whoami()}: got exception:", exc_info=True)
+            raise ExBpmCrawlGeneric(str(e))
+        if not updated:
+            return []
+        # next change must be made to the new revision
+        playlist.revision = updated.revision
+        return [str(x['id']) for x in inserts]
+
     def get_track_id(self, track):
         """
         Get track id for given track. Track id is used to save track info to cache databse.
@@ -648,24 +1011,36 @@ class MusicproviderYandexMusic(MusicproviderBase):
         """
         return f"{track.id}"
 
-    def download_track(self, track):
+    def get_track_duration(self, track):
+        if getattr(track, 'duration_ms', None):
+            return track.duration_ms / 1000
+        return None
+
+    def download_track(self, track, window=None):
         """
         Download track to file and return Tempfile object.
         File will be deleted upon close!
+        Whole track is downloaded, window is applied on analysis.
         :param track: track returned by station_get_next_track, or track of playlist
+        :param window: (start, end) in seconds, part of track which will be analyzed
         :return: tempfile object with track data
         """
-        file = tempfile.NamedTemporaryFile(mode='w+b', dir=temp_dir, prefix='track', suffix='.mp3')
         try:
             try:
-                track.download(file.name)
+                download_info = track.get_specific_download_info(self.download_codec, self.download_bitrate)
             except AttributeError:
                 debug(f"{self.whoami()}: warning: probably got TrackShort object (normally I need to get a list of full track objects! say to author!), trying to get full Track object.")
                 track = track.fetchTrack()
-                track.download(file.name)
+                download_info = track.get_specific_download_info(self.download_codec, self.download_bitrate)
+            if download_info is None:
+                raise ExBpmCrawlGeneric(f"No {self.download_codec} {self.download_bitrate} kbps download of '{track.title}'")
+            with metrics.time("bpmcrawl_stage_seconds", stage="stream_url"):
+                url = download_info.get_direct_link()
         except yandex_music.exceptions.UnauthorizedError:
             info(f"Yandex prohibited track download of '{track.title}'")
             return None
+        file = downloader.download(url)
+        file.analysis_window = window
         return file
 
     def calc_bpm_histogram(self, track):
@@ -688,29 +1063,301 @@ class MusicproviderYandexMusic(MusicproviderBase):
             raise ExBpmCrawlGeneric(f"Artist not found for id {artist_id}")
         return artists[0]
 
-    def artist_pager_init(self, artist):
-        self.artist_pager_load_page(artist, 0)
+    def get_artist_id(self, artist):
+        return artist.id
 
-    def artist_pager_load_page(self, artist, page_num=0):
+    def artist_pager_load_page(self, artist, page_num=0, page_size=artist_page_size):
         debug(f"loading artist {artist.id}'s tracks page {page_num}")
-        self.artist_pager[artist.id] = {'page': page_num, 'idx': 0, 'tracks': []}
-        self.artist_pager[artist.id]['tracks'] = artist.get_tracks(self.artist_pager[artist.id]['page'], 50)
+        return artist.get_tracks(page_num, page_size).tracks
+
+
+class MusicProviderSynthetic(MusicproviderBase):
+    """
+    Client of synthetic music service (see synth_service.py), for benchmarks without real services.
+    Catalogue playlist is named "catalogue", station is "IFL", artist ids are like a00001.
+    """
+    music_service = 'synthetic'
+    url_env_var = 'SYNTH_MUSIC_URL'
+    url = None
+    session = None
+    station_current = None
+    station_page = None
+    station_tracks = None
 
-    def artist_pager_get_next_track(self, artist):
+    def __init__(self, music_service, provider_logging_level=logging.CRITICAL):
+        super(MusicProviderSynthetic, self).__init__(music_service, provider_logging_level)
+        self.url = os.environ.get(self.url_env_var, None)
+        if not self.url:
+            raise ExBpmCrawlGeneric(f"You need to set {self.url_env_var} environment variable to url of synth_service.py")
+
+    def api_request(self, method, path, **kwargs):
+        """Request to service API, through rate limiter"""
+        def request():
+            r = self.session.request(method, self.url + path, **kwargs)
+            r.raise_for_status()
+            return r.json()
         try:
-            track = self.artist_pager[artist.id]['tracks'][self.artist_pager[artist.id]['idx']]
-            self.artist_pager[artist.id]['idx'] += 1
-            return track
-        except IndexError:
-            if self.artist_pager[artist.id]['idx'] == 0:
+            return self.limiter.call(request)
+        except requests.RequestException as e:
+            raise ExBpmCrawlGeneric(f"Failed to get {path} from {self.music_service}: {e}")
+
+    def login(self):
+        self.session = requests.Session()
+        info(f"{self.whoami()}: connected to {self.api_request('GET', '/')}")
+
+    def get_playlist(self, playlist_id_uri_name):
+        for playlist in self.api_request('GET', '/playlists'):
+            if playlist_id_uri_name in (playlist["id"], playlist["name"]):
+                return self.api_request('GET', f"/playlists/{playlist['id']}")
+        return None
+
+    def get_or_create_my_playlist(self, playlist_name):
+        playlist = self.get_playlist(playlist_name)
+        if not playlist:
+            debug(f"{self.whoami()}: playlist {playlist_name} not found, creating it...")
+            playlist = self.api_request('POST', '/playlists', json={"name": playlist_name})
+            playlist = self.api_request('GET', f"/playlists/{playlist['id']}")
+        return playlist
+
+    def get_playlist_tracks(self, playlist):
+        return playlist["tracks"]
+
+    def add_track_to_playlist(self, playlist, track_id):
+        return bool(self.add_tracks_batch_to_playlist(playlist, [track_id]))
+
+    def add_tracks_batch_to_playlist(self, playlist, track_ids):
+        added = self.api_request('POST', f"/playlists/{playlist['id']}/tracks", json={"track_ids": track_ids})["added"]
+        return track_ids if added == len(track_ids) else []
+
+    def get_station_from_url(self, url):
+        return {"id": url, "name": url}
+
+    def get_station_name(self, station):
+        return station["name"]
+
+    def station_prepare(self, station):
+        self.station_current = station
+        self.station_page = -1
+        self.station_tracks = []
+
+    def station_get_next_track(self):
+        if not self.station_tracks:
+            self.station_page += 1
+            self.station_tracks = self.api_request('GET', f"/stations/{self.station_current['id']}",
+                                                   params={"page": self.station_page})
+            if not self.station_tracks:
                 return None
-            else:
-                self.artist_pager_load_page(artist, self.artist_pager[artist.id]['page']+1)
-                return self.artist_pager_get_next_track(artist)
+        return self.station_tracks.pop(0)
+
+    def get_track_id(self, track):
+        return track["id"]
+
+    def get_track_duration(self, track):
+        return track["seconds"]
+
+    def download_track(self, track, window=None):
+        headers = {}
+        if window:
+            # request only bytes of window, assuming constant bitrate
+            size = track["size"]
+            headers['Range'] = f"bytes={int(size * window[0] / track['seconds'])}-{int(size * window[1] / track['seconds'])}"
+        file = downloader.download(f"{self.url}/tracks/{track['id']}/audio", headers)
+        file.analysis_window = None if file.partial else window
+        return file
+
+    def calc_bpm_histogram(self, track):
+        file = self.download_track(track)
+        histogram = calc_file_bpm_histogram(file.name, file.analysis_window)
+        file.close()
+        return histogram
+
+    def get_artist(self, artist_id):
+        return self.api_request('GET', f"/artists/{artist_id}")
+
+    def get_artist_id(self, artist):
+        return artist['id']
+
+    def artist_pager_load_page(self, artist, page_num=0, page_size=artist_page_size):
+        debug(f"loading artist {artist['id']}'s tracks page {page_num}")
+        return self.api_request('GET', f"/artists/{artist['id']}/tracks", params={"page": page_num, "size": page_size})
+
+
+class LocalTrackFile:
+    """File of local track, analyzed in place: no temp copy, close() does nothing"""
+    temporary = False
+
+    def __init__(self, name, analysis_window=None):
+        self.name = name
+        self.analysis_window = analysis_window
+
+    def close(self):
+        pass
+
+
+class MusicProviderLocal(MusicproviderBase):
+    """
+    Audio files of local directories.
+    Playlist is directory (all audio files of tree) or m3u file; playlists created by bpmcrawl-pick are m3u files
+    in local_playlists_dir. Track id is absolute path of file.
+    Directories are scanned incrementally: state (inode, size, mtime) of every analyzed file is saved to local_scan_db,
+    and files with unchanged state are skipped by next scans.
+    """
+    music_service = 'local'
+    scan_db = None
+    scan_commit_every = 500
+    scan_uncommitted = 0
+    scanned = None  # path -> state got by last scan, for files not analyzed yet
+
+    def login(self):
+        os.makedirs(os.path.dirname(local_scan_db), exist_ok=True)
+        self.scan_db = sqlite3.connect(local_scan_db)
+        self.scan_db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, inode INTEGER NOT NULL,"
+                             " size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL)")
+        self.scanned = {}
+        atexit.register(self.scan_db.commit)
+
+    def get_playlist(self, playlist_id_uri_name):
+        path = os.path.abspath(os.path.expanduser(playlist_id_uri_name))
+        if os.path.isdir(path):
+            return {"id": path, "name": playlist_id_uri_name, "type": "dir"}
+        if not os.path.isfile(path):
+            path = os.path.join(os.path.abspath(local_playlists_dir), f"{playlist_id_uri_name}.m3u")
+        if os.path.isfile(path):
+            return {"id": path, "name": playlist_id_uri_name, "type": "m3u"}
+        return None
+
+    def get_or_create_my_playlist(self, playlist_name):
+        playlist = self.get_playlist(playlist_name)
+        if not playlist:
+            path = os.path.join(os.path.abspath(local_playlists_dir), f"{playlist_name}.m3u")
+            debug(f"{self.whoami()}: playlist {playlist_name} not found, creating {path}")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write("#EXTM3U\n")
+            playlist = {"id": path, "name": playlist_name, "type": "m3u"}
+        return playlist
+
+    def get_playlist_tracks(self, playlist):
+        """All audio files of m3u playlist, or new and changed audio files of directory tree"""
+        if playlist["type"] == "m3u":
+            with open(playlist["id"]) as f:
+                paths = [x.strip() for x in f if x.strip() and not x.startswith("#")]
+            base = os.path.dirname(playlist["id"])
+            return [self.make_track(os.path.join(base, x)) for x in paths]
+        started = time.monotonic()
+        files = scan_audio_files(playlist["id"])
+        tracks = []
+        for path, state in files:
+            stored = self.scan_db.execute("SELECT inode, size, mtime_ns FROM files WHERE path = ?", (path,)).fetchone()
+            if stored == state:
+                continue
+            self.scanned[path] = state
+            tracks.append({"id": path, "state": state, "changed": stored is not None})
+        info(f"{self.whoami()}: scanned {len(files)} files in {time.monotonic() - started:.1f} s,"
+             f" {len(tracks)} of them are new or changed")
+        return tracks
+
+    def make_track(self, path):
+        """Track of m3u playlist, its file may be missing"""
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return {"id": path, "state": None, "changed": False}
+        return {"id": path, "state": (st.st_ino, st.st_size, st.st_mtime_ns), "changed": False}
+
+    def add_track_to_playlist(self, playlist, track_id):
+        return bool(self.add_tracks_batch_to_playlist(playlist, [track_id]))
+
+    def add_tracks_batch_to_playlist(self, playlist, track_ids):
+        if playlist["type"] != "m3u":
+            raise ExBpmCrawlGeneric(f"Can't add tracks to directory {playlist['id']}, only to m3u playlist")
+        with open(playlist["id"], "a") as f:
+            f.write("".join(f"{x}\n" for x in track_ids))
+        return track_ids
+
+    def get_station_from_url(self, url):
+        raise ExBpmCrawlGeneric(f"Stations are not supported for local files, use -p directory")
+
+    def get_station_name(self, station):
+        raise ExBpmCrawlGeneric(f"Stations are not supported for local files, use -p directory")
+
+    def station_prepare(self, station):
+        raise ExBpmCrawlGeneric(f"Stations are not supported for local files, use -p directory")
+
+    def station_get_next_track(self):
+        raise ExBpmCrawlGeneric(f"Stations are not supported for local files, use -p directory")
+
+    def get_track_id(self, track):
+        return track["id"]
+
+    def download_track(self, track, window=None):
+        """File is not copied, it is analyzed in place"""
+        return LocalTrackFile(track["id"], window)
+
+    def calc_bpm_histogram(self, track):
+        return calc_file_bpm_histogram(track["id"])
+
+    def is_track_changed(self, track):
+        return track.get("changed", False)
+
+    def mark_track_analyzed(self, track_id):
+        state = self.scanned.pop(track_id, None)
+        if state is None:
+            return
+        self.scan_db.execute("INSERT OR REPLACE INTO files (path, inode, size, mtime_ns) VALUES (?, ?, ?, ?)",
+                             (track_id, *state))
+        self.scan_uncommitted += 1
+        if self.scan_uncommitted >= self.scan_commit_every:
+            self.scan_db.commit()
+            self.scan_uncommitted = 0
+
+
+def scan_directory(dirname):
+    """
+    Scan one directory
+    :return: (subdirectories, [(path, (inode, size, mtime_ns))] of audio files)
+    """
+    dirs = []
+    files = []
+    try:
+        with os.scandir(dirname) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    elif entry.name.lower().endswith(local_audio_extensions) and entry.is_file():
+                        st = entry.stat()
+                        files.append((entry.path, (st.st_ino, st.st_size, st.st_mtime_ns)))
+                except OSError as e:
+                    warning(f"can't stat {entry.path}: {e}")
+    except OSError as e:
+        warning(f"can't scan {dirname}: {e}")
+    return dirs, files
+
+
+def scan_audio_files(root, workers=local_scan_workers):
+    """
+    Find audio files in directory tree, directories are scanned in parallel threads (stat() of files on slow or
+    network disks takes most of time, and it does not hold GIL)
+    :return: list of (path, (inode, size, mtime_ns)), sorted by path
+    """
+    files = []
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        pending = {executor.submit(scan_directory, os.path.abspath(root))}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                dirs, dir_files = future.result()
+                files.extend(dir_files)
+                pending |= {executor.submit(scan_directory, x) for x in dirs}
+    return sorted(files)
 
 
 music_service_mapping = {
     'gmusic': MusicProviderGoogle,
     'spotify': MusicProviderSpotify,
     'yandexmusic': MusicproviderYandexMusic,
+    'synthetic': MusicProviderSynthetic,
+    'local': MusicProviderLocal,
 }
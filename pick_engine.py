@@ -0,0 +1,69 @@
+import numpy
+
+from logging import debug, info, warning, error
+
+from exceptions import *
+from whoami import *
+from config import *
+from histogram_codec import *
+
+# shares are summed in other order than by get_good_bpms, so sums may differ in the last bits;
+# tracks within tolerance below min_share are picked, caller checks them by get_good_bpms
+pick_share_tolerance = 1e-9
+
+
+class HistogramMatrix(WhoamiObject):
+    """
+    Histograms of all cached tracks of music service, loaded to numpy arrays for scoring them all at once.
+    Bins are kept as sparse matrix (row of track, column of bpm, share), columns are distinct bpm values:
+    histograms are sparse (tens of bins out of hundreds or thousands of possible bpm values),
+    so dense tracks x bpm matrix would be mostly zeros and would not fit in memory for big databases.
+    """
+    def __init__(self, track_ids, rows, bpms, shares):
+        """
+        :param track_ids: list of track ids, index in it is row number
+        :param rows: row number of track for every bin
+        :param bpms: bpm for every bin
+        :param shares: share for every bin
+        """
+        self.track_ids = track_ids
+        self.rows = numpy.asarray(rows, dtype=numpy.int32)
+        self.columns, inverse = numpy.unique(numpy.asarray(bpms, dtype=numpy.float64), return_inverse=True)
+        self.bin_columns = inverse.astype(numpy.int32)
+        self.shares = numpy.asarray(shares, dtype=numpy.float64)
+
+    @classmethod
+    def from_store(cls, store, music_service):
+        rowids = store.track_rowids(music_service)
+        track_ids = [x[1] for x in rowids]
+        row_by_rowid = {x[0]: n for n, x in enumerate(rowids)}
+        # encoded histograms are decoded all at once
+        blobs = store.histogram_blobs(music_service)
+        counts, blob_bpms, blob_shares = decode_histograms_arrays([x[1] for x in blobs])
+        blob_rows = numpy.repeat(numpy.fromiter((row_by_rowid[x[0]] for x in blobs), dtype=numpy.int32, count=len(blobs)), counts)
+        bins = store.histogram_bins(music_service)
+        rows = numpy.fromiter((row_by_rowid[x[0]] for x in bins), dtype=numpy.int32, count=len(bins))
+        bpms = numpy.fromiter((x[1] for x in bins), dtype=numpy.float64, count=len(bins))
+        shares = numpy.fromiter((x[2] for x in bins), dtype=numpy.float64, count=len(bins))
+        debug(f"{cls.__name__}: loaded {len(blob_bpms) + len(bins)} bins of {len(track_ids)} tracks of {music_service}")
+        return cls(track_ids, numpy.concatenate([blob_rows, rows]), numpy.concatenate([blob_bpms, bpms]),
+                   numpy.concatenate([blob_shares, shares]))
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    def good_columns(self, good_bpm):
+        """Mask of bpm columns that fall into good_bpm range with any of multipliers"""
+        mask = numpy.zeros(len(self.columns), dtype=bool)
+        for mult in good_bpm["mult"]:
+            mask |= (self.columns >= mult * good_bpm["min"]) & (self.columns <= mult * good_bpm["max"])
+        return mask
+
+    def good_shares(self, good_bpm):
+        """Summary share of "good" bpms for every track (format of good_bpm is as in get_good_bpms)"""
+        weights = numpy.where(self.good_columns(good_bpm)[self.bin_columns], self.shares, 0)
+        return numpy.bincount(self.rows, weights=weights, minlength=len(self.track_ids))
+
+    def pick(self, good_bpm, min_share):
+        """Return list of ids of tracks having summary share of "good" bpms >= min_share (see pick_share_tolerance)"""
+        return [self.track_ids[n] for n in numpy.nonzero(self.good_shares(good_bpm) >= min_share - pick_share_tolerance)[0]]
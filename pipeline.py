@@ -0,0 +1,252 @@
+import os
+import time
+import queue
+import signal
+import threading
+import multiprocessing
+
+from logging import debug, info, warning, error
+
+from exceptions import *
+from whoami import *
+from config import *
+from calc_bpm import *
+from metrics import *
+from tracing import *
+
+
+def init_pool_worker(profile):
+    """Initializer of analysis process pool"""
+    # workers are stopped by main process when queued tracks are done, so signals sent to the whole process group
+    # (Ctrl-C, stop of service) don't kill them with tracks in work
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    init_analysis_worker(profile)
+
+
+class TempBytesBudget(WhoamiObject):
+    """
+    Accounting of bytes occupied in temp_dir by downloaded but not yet analyzed tracks.
+    Size of track is not known until it is downloaded, so new download is allowed to start
+    while used bytes are below the limit (or nothing is downloaded at all).
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def wait_for_room(self):
+        with self.cond:
+            while self.used and self.used >= self.max_bytes:
+                debug(f"{self.whoami()}: {self.used} bytes in temp dir, waiting for analysis to free some")
+                self.cond.wait()
+
+    def acquire(self, nbytes):
+        with self.cond:
+            self.used += nbytes
+
+    def release(self, nbytes):
+        with self.cond:
+            self.used -= nbytes
+            self.cond.notify_all()
+
+
+class CrawlPipeline(WhoamiObject):
+    """
+    Download and analysis stages of crawler, each in own thread(s).
+    Tracks are fed by put() (fetch stage is the caller), results are got by get_results().
+    Download queue holds up to `prefetch` tracks, so next tracks are downloaded while current one is analyzed.
+    Tracks are downloaded by `downloads` threads (downloads at a time are also limited by shared downloader).
+    Analysis is done in process pool if workers > 1, or in analysis thread otherwise.
+    Results are returned to the caller, so only the caller's thread works with database.
+    If window_seconds is set, only this part of track is downloaded (if provider supports it) and analyzed.
+    Time spent by stages is observed to metrics as bpmcrawl_stage_seconds.
+    If dedupe (AudioHashIndex) is given, digest of every downloaded file is looked up there, and tracks
+    with already analyzed audio are not analyzed.
+    One pipeline may be shared by tracks of several providers (bpmcrawld daemon): then api is None,
+    and api of every track is given to put().
+    """
+    def __init__(self, api, workers=1, prefetch=2, max_temp_bytes=temp_dir_max_bytes, profile=analysis_profile,
+                 window_seconds=analysis_window_seconds, window_position=analysis_window_position, metrics=metrics,
+                 dedupe=None, downloads=download_concurrency):
+        self.api = api
+        self.dedupe = dedupe
+        self.metrics = metrics
+        self.profile = profile
+        self.window_seconds = window_seconds
+        self.window_position = window_position
+        self.pool = None
+        analyze_locally = api.analyze_locally if api else True
+        if analyze_locally and workers > 1:
+            info(f"Starting {workers} analysis workers")
+            self.pool = multiprocessing.Pool(workers, initializer=init_pool_worker, initargs=(profile,))
+        self.budget = TempBytesBudget(max_temp_bytes)
+        self.download_queue = queue.Queue(maxsize=prefetch)
+        self.analysis_queue = queue.Queue(maxsize=prefetch)
+        self.results = queue.Queue()
+        self.in_flight = 0
+        self.analysis_threads = []
+        for n in range(workers if analyze_locally else 1):
+            self.analysis_threads.append(threading.Thread(target=self.analysis_stage, name=f"analysis-{n}", daemon=True))
+        self.download_threads = []
+        for n in range(downloads if analyze_locally else 1):
+            self.download_threads.append(threading.Thread(target=self.download_stage, name=f"download-{n}", daemon=True))
+        for thread in self.download_threads:
+            thread.start()
+        for thread in self.analysis_threads:
+            thread.start()
+
+    def put(self, track_id, track, api=None, source=None):
+        """
+        Queue track for download and analysis, blocks if download queue is full
+        :param api: provider of track, default is provider of pipeline
+        :param source: anything, it's returned with result of track (e.g. source of track)
+        """
+        self.in_flight += 1
+        self.metrics.set("bpmcrawl_in_flight_tracks", self.in_flight)
+        tracer.add_async("b", "track", track_id, track_id=track_id)
+        self.download_queue.put((track_id, track, api or self.api, source))
+
+    def get_results(self):
+        """
+        Get results for tracks analyzed so far
+        :return: list of (track_id, histogram, analysis, audio, source); histogram is None on failure,
+                 analysis is parameters of analysis to save with histogram,
+                 audio is None or {"hash": digest of audio, "seconds": seconds of analysis}, or
+                 {"hash": ..., "same_as": (music_service, track_id)} if histogram is None because the same audio
+                 was already analyzed; source is the one given to put()
+        """
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                break
+        self.in_flight -= len(results)
+        self.metrics.set("bpmcrawl_in_flight_tracks", self.in_flight)
+        return results
+
+    def observe_timings(self, timings, finished=None, **args):
+        """
+        Observe seconds of stages to metrics and trace
+        :param finished: time.monotonic() when the last of stages finished, they are traced if it is given
+                         (stages went one after another in order of timings)
+        """
+        started = finished - sum(timings.values()) if finished else None
+        for stage, seconds in timings.items():
+            self.metrics.observe("bpmcrawl_stage_seconds", seconds, stage=stage)
+            if finished:
+                tracer.add_span(stage, "stage", started, seconds, **args)
+                started += seconds
+
+    def close(self):
+        """Finish all queued tracks, stop threads and workers; returns the rest of results"""
+        for thread in self.download_threads:
+            self.download_queue.put(None)
+        for thread in self.download_threads:
+            thread.join()
+        for thread in self.analysis_threads:
+            self.analysis_queue.put(None)
+        for thread in self.analysis_threads:
+            thread.join()
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+        return self.get_results()
+
+    def download_stage(self):
+        while True:
+            item = self.download_queue.get()
+            if item is None:
+                break
+            track_id, track, api, source = item
+            file = None
+            size = 0
+            window = get_analysis_window(api.get_track_duration(track), self.window_seconds, self.window_position)
+            if api.analyze_locally:
+                self.budget.wait_for_room()
+                try:
+                    with self.metrics.time("bpmcrawl_stage_seconds", {"track_id": track_id}, stage="download"):
+                        file = api.download_track(track, window)
+                except Exception as e:
+                    debug(f"{self.whoami()}: got exception:", exc_info=True)
+                    error(f"Failed to download track {track_id}: {e}")
+                if not file:
+                    tracer.add_async("e", "track", track_id)
+                    self.results.put((track_id, None, None, None, source))
+                    continue
+                debug(f"{self.whoami()}: got track {track_id} to {file.name}")
+                if getattr(file, "temporary", True):
+                    # local files are analyzed in place, they don't take temp dir space
+                    size = os.path.getsize(file.name)
+                    self.metrics.inc("bpmcrawl_download_bytes_total", size)
+                    self.budget.acquire(size)
+            audio = None
+            if file and self.dedupe is not None:
+                audio = self.find_same_audio(api.music_service, track_id, file)
+                if audio and "same_as" in audio:
+                    file.close()
+                    self.budget.release(size)
+                    analysis = {**get_analysis_params(self.profile), "same_audio_as": ":".join(audio["same_as"])}
+                    if window:
+                        analysis["window"] = list(window)
+                    tracer.add_async("e", "track", track_id)
+                    self.results.put((track_id, None, analysis, audio, source))
+                    continue
+            self.analysis_queue.put((track_id, track, api, source, file, size, window, audio))
+
+    def find_same_audio(self, music_service, track_id, file):
+        """
+        Calculate digest of downloaded file and look for already analyzed track with the same one
+        (other than this track itself, which is analyzed again e.g. after its file was changed)
+        :return: {"hash": digest} or {"hash": digest, "same_as": (music_service, track_id)}, None on error
+        """
+        try:
+            with self.metrics.time("bpmcrawl_stage_seconds", {"track_id": track_id}, stage="hash"):
+                audio_hash = calc_file_audio_hash(file.name, file.analysis_window, self.profile)
+        except OSError as e:
+            warning(f"Failed to calculate audio hash of track {track_id}: {e}")
+            return None
+        same = self.dedupe.get(audio_hash)
+        if not same or same[:2] == (music_service, track_id):
+            return {"hash": audio_hash}
+        debug(f"{self.whoami()}: track {track_id} has the same audio as {same[0]}:{same[1]}")
+        return {"hash": audio_hash, "same_as": same[:2], "saved_seconds": same[2] or 0}
+
+    def analysis_stage(self):
+        while True:
+            item = self.analysis_queue.get()
+            if item is None:
+                break
+            track_id, track, api, source, file, size, window, audio = item
+            histogram = None
+            analysis = {}
+            started = time.monotonic()
+            try:
+                if file is None:
+                    # analysis is done by provider
+                    with tracer.span("provider_analysis", track_id=track_id):
+                        histogram = api.calc_bpm_histogram(track)
+                    self.observe_timings({"provider_analysis": time.monotonic() - started})
+                elif self.pool:
+                    histogram, timings = self.pool.apply(calc_file_bpm_histogram_timed, (file.name, file.analysis_window, self.profile))
+                    self.observe_timings(timings, time.monotonic(), track_id=track_id, worker="pool")
+                else:
+                    with tracer.span("analyze", track_id=track_id):
+                        histogram, timings = calc_file_bpm_histogram_timed(file.name, file.analysis_window, self.profile)
+                    self.observe_timings(timings, time.monotonic(), track_id=track_id)
+                if audio:
+                    audio["seconds"] = sum(timings.values())
+                if file is not None:
+                    analysis = get_analysis_params(self.profile)
+                    if window:
+                        analysis["window"] = list(window)
+            except Exception as e:
+                debug(f"{self.whoami()}: got exception:", exc_info=True)
+                error(f"Got error instead of histogram: {e}")
+            finally:
+                if file:
+                    file.close()
+                    self.budget.release(size)
+            tracer.add_async("e", "track", track_id)
+            self.results.put((track_id, histogram, analysis, audio, source))
@@ -0,0 +1,190 @@
+import re
+import time
+import random
+import threading
+import email.utils
+
+import requests
+
+from logging import debug, info, warning, error
+
+from exceptions import *
+from whoami import *
+from config import *
+from metrics import *
+
+#
+# Limits of requests to API of music provider: token bucket shared by all threads of process,
+# retries of failed requests with jittered exponential backoff (or as long as server asked by Retry-After),
+# and circuit breaker which stops requests for a while after many consecutive failures.
+#
+
+
+def get_error_status(e):
+    """:return: (HTTP status, seconds of Retry-After) of exception of API request, None for unknown"""
+    status = getattr(e, "http_status", None)  # SpotifyException
+    headers = getattr(e, "headers", None)
+    response = getattr(e, "response", None)  # requests.HTTPError
+    if status is None and response is not None:
+        status = response.status_code
+        headers = response.headers
+    if status is None:
+        # error wrapping requests.HTTPError by its message only, e.g. gmusicapi CallFailure
+        match = re.search(r'\b([1-5]\d\d) (Client|Server) Error', str(e))
+        if match:
+            status = int(match.group(1))
+    return status, parse_retry_after((headers or {}).get("Retry-After"))
+
+
+def parse_retry_after(value):
+    """:return: seconds to wait by value of Retry-After header (seconds or HTTP date), None if not given"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter(WhoamiObject):
+    """
+    Rate limiter of API of one music provider.
+    call() waits for token, makes request and retries it on errors of service: HTTP 429 and 5xx,
+    connection errors and provider specific errors given as retryable_errors (except ones given as nonretryable_errors,
+    e.g. subclasses of retryable ones for client errors); other errors are raised at once.
+    After breaker_failures consecutive failed requests circuit is open for breaker_seconds: calls raise
+    ExBpmCrawlServiceUnavailable without requests, then one request is let through, and its success closes circuit.
+    """
+    def __init__(self, name, rate, burst, retries=provider_api_retries, backoff=provider_backoff_seconds,
+                 backoff_max=provider_backoff_max_seconds, breaker_failures=provider_breaker_failures,
+                 breaker_seconds=provider_breaker_seconds, retryable_errors=(), nonretryable_errors=()):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.breaker_failures = breaker_failures
+        self.breaker_seconds = breaker_seconds
+        self.retryable_errors = (requests.ConnectionError, requests.Timeout) + tuple(retryable_errors)
+        self.nonretryable_errors = tuple(nonretryable_errors)
+        self.lock = threading.Lock()
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0  # set by Retry-After, all requests wait
+        self.failures = 0  # consecutive
+        self.open_until = 0
+        self.probing = False
+
+    def wait(self, seconds):
+        if seconds > 0:
+            metrics.inc("bpmcrawl_api_wait_seconds_total", seconds, provider=self.name)
+            time.sleep(seconds)
+
+    def acquire(self):
+        """Wait for token; raise ExBpmCrawlServiceUnavailable if circuit is open"""
+        with self.lock:
+            now = time.monotonic()
+            if self.open_until:
+                if now < self.open_until or self.probing:
+                    raise ExBpmCrawlServiceUnavailable(
+                        f"{self.name}: too many failed requests, not trying for {max(self.open_until - now, 0):.0f} s")
+                self.probing = True
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst) - 1
+            self.updated = now
+            wait = max(-self.tokens / self.rate, self.paused_until - now, 0)
+        self.wait(wait)
+
+    def succeeded(self):
+        with self.lock:
+            if self.open_until:
+                info(f"{self.whoami()}: {self.name} is available again")
+            self.failures = 0
+            self.open_until = 0
+            self.probing = False
+
+    def failed(self, retry_after=None):
+        with self.lock:
+            now = time.monotonic()
+            self.failures += 1
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            if self.probing or self.failures >= self.breaker_failures:
+                if not self.probing:
+                    warning(f"{self.whoami()}: {self.failures} failed requests to {self.name} in a row,"
+                            f" pausing requests for {self.breaker_seconds} s")
+                self.open_until = now + self.breaker_seconds
+                self.probing = False
+
+    def is_retryable(self, e):
+        """:return: (True if request may be retried, seconds of Retry-After or None)"""
+        if isinstance(e, self.nonretryable_errors):
+            return False, None
+        status, retry_after = get_error_status(e)
+        if status is not None:
+            return status == 429 or status >= 500, retry_after
+        return isinstance(e, self.retryable_errors), None
+
+    def call(self, func, *args, **kwargs):
+        """Call func (making request to API) with rate limit and retries"""
+        for attempt in range(self.retries + 1):
+            self.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                retryable, retry_after = self.is_retryable(e)
+                if not retryable:
+                    self.succeeded()  # service is alive, request is wrong
+                    raise
+                self.failed(retry_after)
+                if attempt == self.retries:
+                    metrics.inc("bpmcrawl_api_requests_total", provider=self.name, result="failed")
+                    raise
+                metrics.inc("bpmcrawl_api_requests_total", provider=self.name, result="retried")
+                delay = max(min(self.backoff * 2 ** attempt, self.backoff_max) * random.uniform(0.5, 1),
+                            retry_after or 0)
+                debug(f"{self.whoami()}: {self.name} request failed ({e}), retrying in {delay:.1f} s")
+                self.wait(delay)
+                continue
+            self.succeeded()
+            metrics.inc("bpmcrawl_api_requests_total", provider=self.name, result="ok")
+            return result
+
+
+class RateLimitedClient:
+    """Proxy of API client object of provider library, calling its methods through rate limiter"""
+    def __init__(self, client, limiter):
+        self._client = client
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        value = getattr(self._client, name)
+        if not callable(value) or name.startswith("_"):
+            return value
+
+        def limited(*args, **kwargs):
+            return self._limiter.call(value, *args, **kwargs)
+        return limited
+
+    def __repr__(self):
+        return f"RateLimitedClient({self._client!r})"
+
+
+# rate limiters of this process, by music service
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(music_service, retryable_errors=(), nonretryable_errors=()):
+    """Return rate limiter of music service (one for all its clients in process), see provider_rate_limits"""
+    with rate_limiters_lock:
+        if music_service not in rate_limiters:
+            limits = provider_rate_limits.get(music_service, provider_rate_limits["default"])
+            rate_limiters[music_service] = RateLimiter(music_service, limits["rate"], limits["burst"],
+                                                       retryable_errors=retryable_errors,
+                                                       nonretryable_errors=nonretryable_errors)
+        return rate_limiters[music_service]
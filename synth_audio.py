@@ -0,0 +1,120 @@
+#
+# Synthetic audio with known tempo, for benchmarks (no music services needed)
+#
+
+import os
+import numpy
+
+from essentia.standard import MonoWriter
+
+from logging import debug, info, warning, error
+
+from exceptions import *
+
+synth_sample_rate = 44100
+
+# kinds of synthetic tracks; "bpms" of track are tempos which are right answers for it
+synth_kinds = ["click", "drums", "tempo_change", "half_time"]
+
+
+def synth_hit(kind, rng):
+    """Samples of one drum hit"""
+    if kind == "click":
+        n = int(0.01 * synth_sample_rate)
+        return numpy.sin(2 * numpy.pi * 1000 * numpy.arange(n) / synth_sample_rate) * numpy.exp(-numpy.arange(n) / (n / 4))
+    if kind == "kick":
+        n = int(0.15 * synth_sample_rate)
+        t = numpy.arange(n) / synth_sample_rate
+        return numpy.sin(2 * numpy.pi * (50 + 100 * numpy.exp(-t * 30)) * t) * numpy.exp(-t * 20)
+    if kind == "snare":
+        n = int(0.12 * synth_sample_rate)
+        return 0.6 * rng.uniform(-1, 1, n) * numpy.exp(-numpy.arange(n) / (n / 5))
+    if kind == "hihat":
+        n = int(0.03 * synth_sample_rate)
+        return 0.25 * rng.uniform(-1, 1, n) * numpy.exp(-numpy.arange(n) / (n / 6))
+    raise ExBpmCrawlGeneric(f"Unknown hit kind '{kind}'")
+
+
+def synth_pattern(audio, start, end, bpm, pattern, rng):
+    """
+    Put pattern of hits to audio from start to end (in samples)
+    :param pattern: list of (beat offset, hit kind) for one bar of 4 beats
+    """
+    beat = 60 / bpm * synth_sample_rate
+    bar = 0
+    while start + bar * 4 * beat < end:
+        for offset, kind in pattern:
+            pos = int(start + (bar * 4 + offset) * beat)
+            if pos >= end:
+                break
+            hit = synth_hit(kind, rng)
+            hit = hit[:len(audio) - pos]
+            audio[pos:pos + len(hit)] += hit
+        bar += 1
+
+
+def synth_track(kind, bpm, seconds, seed=0):
+    """
+    Generate synthetic track
+    :param kind: one of synth_kinds
+    :return: (audio, bpms): mono float32 samples and list of right tempos
+    """
+    rng = numpy.random.default_rng(seed)
+    n = int(seconds * synth_sample_rate)
+    audio = numpy.zeros(n, dtype=numpy.float64)
+    drums = [(0, "kick"), (1, "snare"), (2, "kick"), (3, "snare")] + [(x / 2, "hihat") for x in range(8)]
+    if kind == "click":
+        synth_pattern(audio, 0, n, bpm, [(x, "click") for x in range(4)], rng)
+    elif kind == "drums":
+        synth_pattern(audio, 0, n, bpm, drums, rng)
+    elif kind == "tempo_change":
+        # first half at bpm, second half 20% faster
+        synth_pattern(audio, 0, n // 2, bpm, drums, rng)
+        synth_pattern(audio, n // 2, n, bpm * 1.2, drums, rng)
+    elif kind == "half_time":
+        # hihats keep bpm, kick and snare feel like bpm/2
+        synth_pattern(audio, 0, n, bpm, [(0, "kick"), (2, "snare")] + [(x, "hihat") for x in range(4)], rng)
+    else:
+        raise ExBpmCrawlGeneric(f"Unknown synthetic track kind '{kind}'")
+    audio += 0.01 * rng.standard_normal(n)
+    audio /= max(numpy.abs(audio).max(), 1e-9)
+    return (0.8 * audio).astype(numpy.float32), synth_track_bpms(kind, bpm)
+
+
+def write_synth_track(filename, kind, bpm, seconds, seed=0):
+    """Generate synthetic track and write it to file, format is taken from file extension (mp3, ogg, flac, wav)"""
+    audio, bpms = synth_track(kind, bpm, seconds, seed)
+    MonoWriter(filename=filename, format=os.path.splitext(filename)[1][1:], sampleRate=synth_sample_rate)(audio)
+    return bpms
+
+
+def generate_corpus(dirname, kinds=synth_kinds, bpms=(90, 128, 174), lengths=(60,), codecs=("mp3",)):
+    """
+    Generate files of synthetic tracks (existing files are not regenerated)
+    :return: list of {"filename", "kind", "bpm", "seconds", "codec", "bpms"}
+    """
+    os.makedirs(dirname, exist_ok=True)
+    corpus = []
+    seed = 0
+    for kind in kinds:
+        for bpm in bpms:
+            for seconds in lengths:
+                for codec in codecs:
+                    seed += 1
+                    filename = os.path.join(dirname, f"{kind}-{bpm}-{seconds}s.{codec}")
+                    audio_bpms = synth_track_bpms(kind, bpm)
+                    if not os.path.exists(filename):
+                        debug(f"generating {filename}")
+                        write_synth_track(filename, kind, bpm, seconds, seed)
+                    corpus.append({"filename": filename, "kind": kind, "bpm": bpm, "seconds": seconds,
+                                   "codec": codec, "bpms": audio_bpms})
+    return corpus
+
+
+def synth_track_bpms(kind, bpm):
+    """Right tempos of synthetic track, same as synth_track() returns"""
+    if kind == "tempo_change":
+        return [bpm, round(bpm * 1.2, 1)]
+    if kind == "half_time":
+        return [bpm, bpm / 2]
+    return [bpm]
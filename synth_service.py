@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+
+#
+# Synthetic music service for benchmarks: catalogue of synthetic tracks (see synth_audio.py) served by local HTTP server
+# with configurable latency, bandwidth and error rate. Client of it is MusicProviderSynthetic in music_api.py.
+#
+# API (all responses are json, except audio):
+#   GET  /                                  service info
+#   GET  /playlists                         list of playlists: [{id, name}]
+#   POST /playlists {name}                  create playlist
+#   GET  /playlists/<id>                    playlist with tracks: {id, name, tracks: [track, ...]}
+#   POST /playlists/<id>/tracks {track_ids} add tracks to playlist
+#   GET  /stations/<id>?page=N              page of station tracks, empty list after the last page
+#   GET  /artists/<id>                      artist: {id, name}
+#   GET  /artists/<id>/tracks?page=N&size=M page of artist tracks
+#   GET  /tracks/<id>/audio                 audio file of track, supports Range header
+#   GET  /stats                             counters of served requests
+#
+
+import os
+import re
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import logging
+from logging import debug, info, warning, error
+
+from exceptions import *
+from whoami import *
+from synth_audio import *
+
+synth_corpus_dir = 'data/synth-service'
+synth_station_page_size = 25
+synth_catalogue_playlist = "catalogue"
+
+
+class SynthCatalogue(WhoamiObject):
+    """
+    Tracks, artists, stations and playlists of synthetic service.
+    Audio files are generated once per (kind, bpm, length), tracks reuse them, so catalogue may be big.
+    """
+    def __init__(self, tracks=1000, artists=50, kinds=synth_kinds, bpms=(90, 128, 174), lengths=(60,),
+                 codec="mp3", corpus_dir=synth_corpus_dir, seed=0):
+        self.corpus = generate_corpus(corpus_dir, kinds, bpms, lengths, [codec])
+        rng = random.Random(seed)
+        self.tracks = {}
+        for n in range(tracks):
+            audio = rng.choice(self.corpus)
+            track_id = f"t{n:07d}"
+            self.tracks[track_id] = {
+                "id": track_id,
+                "title": f"{audio['kind']} {audio['bpm']} #{n}",
+                "artist": f"a{n % artists:05d}",
+                "seconds": audio["seconds"],
+                "size": os.path.getsize(audio["filename"]),
+                "bpms": audio["bpms"],
+                "filename": audio["filename"],
+            }
+        self.artists = {}
+        for track in self.tracks.values():
+            self.artists.setdefault(track["artist"], []).append(track["id"])
+        # station IFL plays all tracks in random order
+        station = list(self.tracks)
+        rng.shuffle(station)
+        self.stations = {"IFL": station}
+        self.playlists = {"1": {"id": "1", "name": synth_catalogue_playlist, "tracks": list(self.tracks)}}
+        self.lock = threading.Lock()
+
+    def public_track(self, track_id):
+        track = self.tracks[track_id]
+        return {x: track[x] for x in ("id", "title", "artist", "seconds", "size")}
+
+    def get_playlist(self, playlist_id):
+        with self.lock:
+            playlist = self.playlists[playlist_id]
+            return {"id": playlist["id"], "name": playlist["name"],
+                    "tracks": [self.public_track(x) for x in playlist["tracks"]]}
+
+    def create_playlist(self, name):
+        with self.lock:
+            playlist_id = str(len(self.playlists) + 1)
+            self.playlists[playlist_id] = {"id": playlist_id, "name": name, "tracks": []}
+            return {"id": playlist_id, "name": name}
+
+    def add_playlist_tracks(self, playlist_id, track_ids):
+        with self.lock:
+            unknown = [x for x in track_ids if x not in self.tracks]
+            if unknown:
+                raise ExBpmCrawlGeneric(f"Unknown tracks: {unknown[:10]}")
+            self.playlists[playlist_id]["tracks"].extend(track_ids)
+            return len(track_ids)
+
+
+class SynthRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    chunk_size = 16384
+
+    def log_message(self, format, *args):
+        debug(f"{self.__class__.__name__}: {self.address_string()} {format % args}")
+
+    def handle(self):
+        try:
+            super().handle()
+        except ConnectionError as e:
+            # clients drop keep-alive connections when they exit
+            debug(f"{self.__class__.__name__}: {self.address_string()}: {e}")
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_HEAD(self):
+        self.handle_request("HEAD")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def handle_request(self, method):
+        service = self.server.service
+        started = time.monotonic()
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        path = url.path.rstrip("/")
+        body = None
+        if method == "POST":
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"null")
+        is_audio = re.match(r"^/tracks/([^/]+)/audio$", path)
+        service.delay()
+        if path != "/stats" and service.should_fail():
+            service.count("errors")
+            self.send_json({"error": "synthetic error"}, 503)
+            return
+        try:
+            if is_audio:
+                sent = self.send_audio(method, is_audio.group(1))
+                service.count("downloads", download_bytes=sent, download_seconds=time.monotonic() - started)
+                return
+            self.send_json(self.route(method, path, query, body))
+        except KeyError as e:
+            self.send_json({"error": f"not found: {e}"}, 404)
+        except ExBpmCrawlGeneric as e:
+            self.send_json({"error": str(e)}, 400)
+        service.count("api_requests", api_seconds=time.monotonic() - started)
+
+    def route(self, method, path, query, body):
+        service = self.server.service
+        catalogue = service.catalogue
+        page = int(query.get("page", 0))
+        if path == "":
+            return {"name": "synthetic", "tracks": len(catalogue.tracks)}
+        if path == "/stats":
+            return service.get_stats()
+        if path == "/playlists":
+            if method == "POST":
+                return catalogue.create_playlist(body["name"])
+            with catalogue.lock:
+                return [{"id": x["id"], "name": x["name"]} for x in catalogue.playlists.values()]
+        m = re.match(r"^/playlists/([^/]+)(/tracks)?$", path)
+        if m:
+            if m.group(2) and method == "POST":
+                service.count("playlist_add_requests", playlist_adds=len(body["track_ids"]))
+                return {"added": catalogue.add_playlist_tracks(m.group(1), body["track_ids"])}
+            service.count("playlist_loads")
+            return catalogue.get_playlist(m.group(1))
+        m = re.match(r"^/stations/([^/]+)$", path)
+        if m:
+            station = catalogue.stations[m.group(1)]
+            page_tracks = station[page * synth_station_page_size:(page + 1) * synth_station_page_size]
+            return [catalogue.public_track(x) for x in page_tracks]
+        m = re.match(r"^/artists/([^/]+)(/tracks)?$", path)
+        if m:
+            artist_tracks = catalogue.artists[m.group(1)]
+            if not m.group(2):
+                return {"id": m.group(1), "name": f"Artist {m.group(1)}", "tracks": len(artist_tracks)}
+            size = int(query.get("size", 50))
+            return [catalogue.public_track(x) for x in artist_tracks[page * size:(page + 1) * size]]
+        raise KeyError(path)
+
+    def send_json(self, data, status=200):
+        content = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_audio(self, method, track_id):
+        """Send audio of track (or its range), throttled to bandwidth of service; returns count of bytes sent"""
+        track = self.server.service.catalogue.tracks[track_id]
+        size = track["size"]
+        start, end = 0, size - 1
+        status = 200
+        m = re.match(r"^bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if m:
+            start = int(m.group(1))
+            end = min(int(m.group(2)) if m.group(2) else end, end)
+            status = 206
+        self.send_response(status)
+        self.send_header("Content-Type", "audio/mpeg")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if method == "HEAD":
+            return 0
+        bandwidth = self.server.service.bandwidth
+        started = time.monotonic()
+        sent = 0
+        with open(track["filename"], "rb") as f:
+            f.seek(start)
+            while sent < end - start + 1:
+                chunk = f.read(min(self.chunk_size, end - start + 1 - sent))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if bandwidth:
+                    ahead = sent / bandwidth - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        return sent
+
+
+class SynthMusicService(WhoamiObject):
+    """
+    HTTP server of synthetic music service, runs in background thread
+    :param latency: seconds added to every request
+    :param bandwidth: bytes per second for every audio download, 0 for unlimited
+    :param error_rate: share of requests answered with 503
+    """
+    def __init__(self, catalogue, host="127.0.0.1", port=0, latency=0.05, bandwidth=0, error_rate=0, seed=0):
+        self.catalogue = catalogue
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.server = ThreadingHTTPServer((host, port), SynthRequestHandler)
+        self.server.daemon_threads = True
+        self.server.service = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def should_fail(self):
+        with self.lock:
+            return self.rng.random() < self.error_rate
+
+    def count(self, name, **values):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+            for key, value in values.items():
+                self.stats[key] = self.stats.get(key, 0) + value
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="synth-service", daemon=True)
+        self.thread.start()
+        info(f"synthetic music service with {len(self.catalogue.tracks)} tracks is at {self.url}")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        description=f'Run synthetic music service; use it with "-s synthetic" and SYNTH_MUSIC_URL environment variable',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--port', default=8765, type=int,
+                        help=f'Port to listen')
+    parser.add_argument('-t', '--tracks', default=1000, type=int,
+                        help=f'Tracks in catalogue')
+    parser.add_argument('--artists', default=50, type=int,
+                        help=f'Artists in catalogue')
+    parser.add_argument('-L', '--lengths', default=[60], nargs='+', type=int,
+                        help=f'Lengths of tracks, seconds')
+    parser.add_argument('--latency', default=50, type=float,
+                        help=f'Latency of every request, ms')
+    parser.add_argument('--bandwidth', default=0, type=float,
+                        help=f'Download bandwidth of every connection, KB/s, 0 for unlimited')
+    parser.add_argument('--error-rate', default=0, type=float,
+                        help=f'Share of requests failed with HTTP 503')
+    parser.add_argument('-d', '--debug', default=False, action='store_true',
+                        help=f'Enable debugging output')
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    catalogue = SynthCatalogue(args.tracks, args.artists, lengths=args.lengths)
+    service = SynthMusicService(catalogue, port=args.port, latency=args.latency / 1000,
+                                bandwidth=args.bandwidth * 1024, error_rate=args.error_rate)
+    service.start()
+    try:
+        service.thread.join()
+    except KeyboardInterrupt:
+        service.stop()
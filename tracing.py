@@ -0,0 +1,168 @@
+import os
+import time
+import json
+import pstats
+import cProfile
+import threading
+import contextlib
+
+from logging import debug, info, warning, error
+
+from exceptions import *
+from whoami import *
+
+#
+# Timeline of process in Chrome trace-event format (open it in https://ui.perfetto.dev or chrome://tracing).
+# Timestamps are of monotonic clock, which is common for all processes of the machine,
+# so spans measured in worker processes may be put to the same timeline.
+#
+
+
+def trace_timestamp(monotonic=None):
+    """Timestamp of trace event, microseconds"""
+    return (time.monotonic() if monotonic is None else monotonic) * 1000000
+
+
+class TraceSpan:
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.profile = None
+
+    def __enter__(self):
+        if self.tracer.pstats_dir and self.cat == "stage":
+            self.profile = self.tracer.start_profile(self.name)
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.monotonic() - self.started
+        if self.profile:
+            self.tracer.stop_profile(self.profile)
+        if exc_type is not None:
+            self.args["error"] = repr(exc_value)
+        self.tracer.add_span(self.name, self.cat, self.started, duration, **self.args)
+
+
+class Tracer(WhoamiObject):
+    """
+    Recorder of trace events: spans (name, category, start, duration, args) per thread of process.
+    Does nothing until start() is called, so spans may be left in code.
+    If pstats_dir is given, spans of category "stage" are also profiled by cProfile, and stats of every
+    stage are saved to pstats_dir/<stage>.pstats (nested stage spans are counted in the outer one).
+    """
+    def __init__(self):
+        self.enabled = False
+        self.pstats_dir = None
+        self.events = []
+        self.threads = {}
+        self.profiles = {}  # stage -> list of cProfile.Profile
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def start(self, pstats_dir=None):
+        self.enabled = True
+        self.pstats_dir = pstats_dir
+        self.events = []
+
+    def span(self, name, cat="stage", **args):
+        """Context manager recording span"""
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return TraceSpan(self, name, cat, args)
+
+    def add_span(self, name, cat, started, duration, tid=None, **args):
+        """
+        Record span measured elsewhere
+        :param started: time.monotonic() of start
+        :param tid: name of timeline (thread) to put span to, current thread by default
+        """
+        if not self.enabled:
+            return
+        event = {"name": name, "cat": cat, "ph": "X", "ts": trace_timestamp(started),
+                 "dur": duration * 1000000, "pid": os.getpid(), "tid": self.get_tid(tid), "args": args}
+        with self.lock:
+            self.events.append(event)
+
+    def add_async(self, phase, name, id, cat="track", **args):
+        """Record begin ("b") or end ("e") of span which may start and end in different threads"""
+        if not self.enabled:
+            return
+        event = {"name": name, "cat": cat, "ph": phase, "id": str(id), "ts": trace_timestamp(),
+                 "pid": os.getpid(), "tid": self.get_tid(), "args": args}
+        with self.lock:
+            self.events.append(event)
+
+    def get_tid(self, name=None):
+        if name is None:
+            name = threading.current_thread().name
+        with self.lock:
+            return self.threads.setdefault(name, len(self.threads) + 1)
+
+    def start_profile(self, stage):
+        if getattr(self.local, "profiling", False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # only one profiler may be active at a time in some python versions
+            debug(f"{self.whoami()}: can't profile stage {stage}: {e}")
+            return None
+        self.local.profiling = True
+        with self.lock:
+            self.profiles.setdefault(stage, []).append(profile)
+        return profile
+
+    def stop_profile(self, profile):
+        profile.disable()
+        self.local.profiling = False
+
+    def save(self, filename):
+        """Write trace to filename (and pstats to pstats_dir)"""
+        if not self.enabled:
+            return
+        with self.lock:
+            events = list(self.events)
+            threads = dict(self.threads)
+            profiles = {stage: list(x) for stage, x in self.profiles.items()}
+        metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+                    for name, tid in threads.items()]
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, f)
+        info(f"trace of {len(events)} events is written to {filename}")
+        if self.pstats_dir and profiles:
+            os.makedirs(self.pstats_dir, exist_ok=True)
+            for stage, stage_profiles in profiles.items():
+                pstats.Stats(*stage_profiles).dump_stats(os.path.join(self.pstats_dir, f"{stage}.pstats"))
+            info(f"profiles of stages {sorted(profiles)} are written to {self.pstats_dir}")
+
+
+class TracedProvider:
+    """Proxy of music provider recording span of every method call (except of ones which only read track object)"""
+    untraced = {"get_track_id", "get_track_duration", "get_playlist_id", "get_station_name", "is_track_changed",
+                "mark_track_analyzed", "get_playlist_snapshot", "get_artist_id", "artist_pager_get_position",
+                "station_mark_track_done", "station_save_session"}
+
+    def __init__(self, api, tracer):
+        self._api = api
+        self._tracer = tracer
+
+    def __getattr__(self, name):
+        value = getattr(self._api, name)
+        if not callable(value) or name.startswith("_") or name in self.untraced:
+            return value
+
+        def traced(*args, **kwargs):
+            with self._tracer.span(f"{self._api.music_service}.{name}", cat="api"):
+                return value(*args, **kwargs)
+        return traced
+
+    def __repr__(self):
+        return f"TracedProvider({self._api!r})"
+
+
+# tracer of this process
+tracer = Tracer()